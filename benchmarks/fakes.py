@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+#
+"""
+基准测试用的本地服务, 只实现 storagekit 用到的接口, 不校验签名:
+FakeS3Server    S3 兼容 (path-style): put/get/head/delete, list_objects v1/v2, 批量删除, 分片上传
+FakeOSSServer   OSS (IP endpoint 时 oss2 使用 path-style): put/get/head/delete, list_objects, 批量删除, 分片上传
+FakeESServer    Elasticsearch 6.x: index, _bulk, _search, _count, 不对查询条件求值
+"""
+import bisect
+import hashlib
+import json
+import sys
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+
+class ObjectStore(object):
+    """
+    按 bucket 保存对象, 维护有序的 key 列表用于前缀列举
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, ({}, []))
+
+    def put(self, bucket, key, body):
+        objects, keys = self.bucket(bucket)
+        meta = {'body': body, 'etag': hashlib.md5(body).hexdigest(), 'mtime': time.time()}
+        with self.lock:
+            if key not in objects:
+                bisect.insort(keys, key)
+            objects[key] = meta
+        return meta
+
+    def get(self, bucket, key):
+        return self.bucket(bucket)[0].get(key)
+
+    def delete(self, bucket, key):
+        objects, keys = self.bucket(bucket)
+        with self.lock:
+            if objects.pop(key, None) is not None:
+                del keys[bisect.bisect_left(keys, key)]
+
+    def list(self, bucket, prefix='', delimiter='', start_after='', max_keys=1000):
+        """
+        返回 (对象 [(key, meta)], 公共前缀 [prefix], 是否截断, 下一页的起始 key)
+        """
+        objects, keys = self.bucket(bucket)
+        contents, prefixes = [], []
+        with self.lock:
+            i = bisect.bisect_right(keys, start_after) if start_after else bisect.bisect_left(keys, prefix)
+            last = None
+            while i < len(keys) and keys[i].startswith(prefix):
+                if len(contents) + len(prefixes) >= max_keys:
+                    return contents, prefixes, True, last
+                key = keys[i]
+                pos = key.find(delimiter, len(prefix)) if delimiter else -1
+                if pos >= 0:
+                    common = key[:pos + len(delimiter)]
+                    prefixes.append(common)
+                    # 跳过同一个公共前缀下的其余 key
+                    i = bisect.bisect_left(keys, common + '\U0010ffff')
+                    last = common
+                    continue
+                contents.append((key, objects[key]))
+                last = key
+                i += 1
+        return contents, prefixes, False, None
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分两次写入, 不关闭 Nagle 时小响应会被延迟 ACK 拖慢 40ms
+    disable_nagle_algorithm = True
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        parts = urlsplit(self.path)
+        self.query = {k: v[0] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+        bucket, _, key = parts.path.lstrip('/').partition('/')
+        return unquote(bucket), unquote(key)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def respond(self, status, body=b'', headers=None, content_type='application/xml'):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def object_headers(self, meta):
+        return {
+            'ETag': '"%s"' % meta['etag'],
+            'Last-Modified': formatdate(meta['mtime'], usegmt=True),
+        }
+
+    def send_object(self, meta, extra_headers=None):
+        body = meta['body']
+        status = 200
+        headers = self.object_headers(meta)
+        headers.update(extra_headers or {})
+        byte_range = self.headers.get('Range')
+        if byte_range and byte_range.startswith('bytes='):
+            start, _, end = byte_range[len('bytes='):].partition('-')
+            start = int(start or 0)
+            end = min(int(end), len(body) - 1) if end else len(body) - 1
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(body))
+            body = body[start:end + 1]
+            status = 206
+        self.respond(status, body, headers, content_type='application/octet-stream')
+
+    def head_object(self, meta):
+        if meta is None:
+            return self.respond(404, headers=self.error_headers())
+        # HEAD 响应的 Content-Length 是对象大小, 没有响应体
+        self.send_response(200)
+        for name, value in self.object_headers(meta).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(meta['body'])))
+        self.end_headers()
+
+    def error(self, status, code, message=''):
+        body = '<?xml version="1.0" encoding="UTF-8"?><Error><Code>%s</Code><Message>%s</Message>' \
+               '<RequestId>%s</RequestId></Error>' % (code, escape(message), uuid.uuid4().hex)
+        self.respond(status, body, self.error_headers())
+
+    def error_headers(self):
+        return {}
+
+    def delete_keys(self, bucket):
+        root = ElementTree.fromstring(self.read_body())
+        # 去掉命名空间, S3 的请求体带 xmlns
+        keys = [el.text for el in root.iter() if el.tag.rsplit('}', 1)[-1] == 'Key']
+        quiet = any(el.text == 'true' for el in root.iter() if el.tag.rsplit('}', 1)[-1] == 'Quiet')
+        for key in keys:
+            self.store.delete(bucket, key)
+        deleted = '' if quiet else ''.join('<Deleted><Key>%s</Key></Deleted>' % escape(k) for k in keys)
+        return '<?xml version="1.0" encoding="UTF-8"?><DeleteResult>%s</DeleteResult>' % deleted
+
+    def multipart(self, bucket, key):
+        """
+        处理分片上传的请求, 不是分片上传的请求返回 False
+        """
+        q, store = self.query, self.store
+        xml = '<?xml version="1.0" encoding="UTF-8"?><%s>%s</%s>'
+        if self.command == 'POST' and 'uploads' in q:
+            upload_id = uuid.uuid4().hex
+            store.uploads[upload_id] = {}
+            body = '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>' % (bucket, escape(key), upload_id)
+            self.respond(200, xml % ('InitiateMultipartUploadResult', body, 'InitiateMultipartUploadResult'),
+                         self.error_headers())
+            return True
+        if 'uploadId' not in q:
+            return False
+        parts = store.uploads.get(q['uploadId'])
+        if parts is None:
+            self.read_body()
+            self.error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+        elif self.command == 'PUT':
+            data = self.read_body()
+            parts[int(q['partNumber'])] = data
+            self.respond(200, headers=dict({'ETag': '"%s"' % hashlib.md5(data).hexdigest()}, **self.error_headers()))
+        elif self.command == 'GET':
+            rows = ''.join(
+                '<Part><PartNumber>%d</PartNumber><LastModified>%s</LastModified><ETag>"%s"</ETag>'
+                '<Size>%d</Size></Part>' % (n, time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+                                            hashlib.md5(parts[n]).hexdigest(), len(parts[n]))
+                for n in sorted(parts)
+            )
+            body = '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId><IsTruncated>false</IsTruncated>' \
+                   '<NextPartNumberMarker>%d</NextPartNumberMarker>%s' \
+                   % (bucket, escape(key), q['uploadId'], max(parts or [0]), rows)
+            self.respond(200, xml % ('ListPartsResult', body, 'ListPartsResult'), self.error_headers())
+        elif self.command == 'POST':
+            root = ElementTree.fromstring(self.read_body())
+            numbers = [int(el.text) for el in root.iter() if el.tag.rsplit('}', 1)[-1] == 'PartNumber']
+            meta = store.put(bucket, key, b''.join(parts[n] for n in numbers))
+            del store.uploads[q['uploadId']]
+            body = '<Bucket>%s</Bucket><Key>%s</Key><ETag>"%s"</ETag>' % (bucket, escape(key), meta['etag'])
+            self.respond(200, xml % ('CompleteMultipartUploadResult', body, 'CompleteMultipartUploadResult'),
+                         dict(self.object_headers(meta), **self.error_headers()))
+        elif self.command == 'DELETE':
+            del store.uploads[q['uploadId']]
+            self.respond(204, headers=self.error_headers())
+        return True
+
+    def do_PUT(self):
+        bucket, key = self.parse()
+        if self.multipart(bucket, key):
+            return
+        body = self.read_body()
+        if not key:
+            self.store.bucket(bucket)
+            return self.respond(200, headers=self.error_headers())
+        meta = self.store.put(bucket, key, body)
+        self.respond(200, headers=dict(self.object_headers(meta), **self.error_headers()))
+
+    def do_DELETE(self):
+        bucket, key = self.parse()
+        if self.multipart(bucket, key):
+            return
+        self.store.delete(bucket, key)
+        self.respond(204, headers=self.error_headers())
+
+
+class S3Handler(FakeHandler):
+
+    def do_GET(self):
+        bucket, key = self.parse()
+        if self.multipart(bucket, key):
+            return
+        if not key:
+            return self.list_objects(bucket)
+        meta = self.store.get(bucket, key)
+        if meta is None:
+            return self.error(404, 'NoSuchKey', 'The specified key does not exist.')
+        self.send_object(meta)
+
+    def do_HEAD(self):
+        bucket, key = self.parse()
+        if not key:
+            return self.respond(200)
+        self.head_object(self.store.get(bucket, key))
+
+    def do_POST(self):
+        bucket, key = self.parse()
+        if self.multipart(bucket, key):
+            return
+        if 'delete' not in self.query:
+            return self.error(501, 'NotImplemented')
+        self.respond(200, self.delete_keys(bucket))
+
+    def list_objects(self, bucket):
+        q = self.query
+        v2 = q.get('list-type') == '2'
+        start_after = q.get('continuation-token') if v2 else q.get('marker')
+        contents, prefixes, truncated, last = self.store.list(
+            bucket, prefix=q.get('prefix', ''), delimiter=q.get('delimiter', ''),
+            start_after=start_after or q.get('start-after', ''), max_keys=int(q.get('max-keys', 1000))
+        )
+        rows = ['<Name>%s</Name><Prefix>%s</Prefix><MaxKeys>%s</MaxKeys><IsTruncated>%s</IsTruncated>'
+                % (bucket, escape(q.get('prefix', '')), q.get('max-keys', 1000), str(truncated).lower())]
+        if truncated:
+            rows.append('<NextContinuationToken>%s</NextContinuationToken>' % escape(last) if v2
+                        else '<NextMarker>%s</NextMarker>' % escape(last))
+        if v2:
+            rows.append('<KeyCount>%d</KeyCount>' % (len(contents) + len(prefixes)))
+        for key, meta in contents:
+            rows.append(
+                '<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>"%s"</ETag>'
+                '<Size>%d</Size><StorageClass>STANDARD</StorageClass></Contents>'
+                % (escape(key), time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(meta['mtime'])),
+                   meta['etag'], len(meta['body']))
+            )
+        for prefix in prefixes:
+            rows.append('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' % escape(prefix))
+        self.respond(200, '<?xml version="1.0" encoding="UTF-8"?>'
+                          '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">%s'
+                          '</ListBucketResult>' % ''.join(rows))
+
+
+class OSSHandler(FakeHandler):
+
+    def error_headers(self):
+        return {'x-oss-request-id': uuid.uuid4().hex}
+
+    def object_headers(self, meta):
+        headers = super().object_headers(meta)
+        headers['x-oss-object-type'] = 'Normal'
+        headers.update(self.error_headers())
+        return headers
+
+    def do_GET(self):
+        bucket, key = self.parse()
+        if self.multipart(bucket, key):
+            return
+        if not key:
+            return self.list_objects(bucket)
+        meta = self.store.get(bucket, key)
+        if meta is None:
+            return self.error(404, 'NoSuchKey', 'The specified key does not exist.')
+        self.send_object(meta)
+
+    def do_HEAD(self):
+        bucket, key = self.parse()
+        self.head_object(self.store.get(bucket, key))
+
+    def do_POST(self):
+        bucket, key = self.parse()
+        if self.multipart(bucket, key):
+            return
+        if 'delete' not in self.query:
+            return self.error(501, 'NotImplemented')
+        self.respond(200, self.delete_keys(bucket), self.error_headers())
+
+    def list_objects(self, bucket):
+        q = self.query
+        contents, prefixes, truncated, last = self.store.list(
+            bucket, prefix=q.get('prefix', ''), delimiter=q.get('delimiter', ''),
+            start_after=q.get('marker', ''), max_keys=int(q.get('max-keys', 100))
+        )
+        rows = ['<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker><MaxKeys>%s</MaxKeys>'
+                '<Delimiter>%s</Delimiter><IsTruncated>%s</IsTruncated>'
+                % (bucket, escape(q.get('prefix', '')), escape(q.get('marker', '')), q.get('max-keys', 100),
+                   escape(q.get('delimiter', '')), str(truncated).lower())]
+        if truncated:
+            rows.append('<NextMarker>%s</NextMarker>' % escape(last))
+        for key, meta in contents:
+            rows.append(
+                '<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>"%s"</ETag>'
+                '<Type>Normal</Type><Size>%d</Size><StorageClass>Standard</StorageClass></Contents>'
+                % (escape(key), time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(meta['mtime'])),
+                   meta['etag'].upper(), len(meta['body']))
+            )
+        for prefix in prefixes:
+            rows.append('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' % escape(prefix))
+        self.respond(200, '<?xml version="1.0" encoding="UTF-8"?><ListBucketResult>%s</ListBucketResult>'
+                     % ''.join(rows), self.error_headers())
+
+
+class ESHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    indices = None
+    scrolls = None
+    lock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def index_doc(self, index, doc):
+        with self.lock:
+            docs = self.indices.setdefault(index, [])
+            doc_id = uuid.uuid4().hex
+            docs.append((doc_id, doc))
+        return doc_id
+
+    def matched(self, index):
+        # 支持逗号分隔和 * 通配的索引名, 与 get_search_kwargs 生成的一致
+        docs = []
+        with self.lock:
+            for pattern in index.split(','):
+                if pattern.endswith('*'):
+                    names = [n for n in self.indices if n.startswith(pattern[:-1])]
+                else:
+                    names = [pattern] if pattern in self.indices else []
+                for name in names:
+                    docs.extend((name, doc_id, doc) for doc_id, doc in self.indices[name])
+        return docs
+
+    def do_HEAD(self):
+        index = urlsplit(self.path).path.strip('/')
+        self.respond(200 if index in self.indices or not index else 404, {})
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_PUT(self):
+        index = urlsplit(self.path).path.strip('/').split('/')[0]
+        with self.lock:
+            self.indices.setdefault(index, [])
+        self.read_body()
+        self.respond(200, {'acknowledged': True, 'index': index})
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        path = [p for p in parts.path.split('/') if p]
+        body = self.read_body()
+        if not path:
+            return self.respond(200, {'version': {'number': '6.8.0'}, 'tagline': 'You Know, for Search'})
+        if path[-1] == '_bulk':
+            return self.bulk(body)
+        if path[:2] == ['_search', 'scroll']:
+            # scroll_id 可以在路径、body 或参数中
+            request = json.loads(body) if body else {}
+            return self.scroll_page(path[2] if len(path) > 2 else request.get('scroll_id') or query.get('scroll_id'))
+        if path[-1] in ('_search', '_count'):
+            docs = self.matched(path[0] if len(path) > 1 else '*')
+            if path[-1] == '_count':
+                return self.respond(200, {'count': len(docs)})
+            request = json.loads(body) if body else {}
+            size = int(query.get('size', request.get('size', 10)))
+            hits = [{'_index': name, '_type': 'doc', '_id': doc_id, '_source': doc}
+                    for name, doc_id, doc in self.sort(docs, request.get('sort'))]
+            if 'scroll' in query:
+                scroll_id = uuid.uuid4().hex
+                with self.lock:
+                    self.scrolls[scroll_id] = (hits, size)
+                return self.scroll_page(scroll_id, total=len(hits))
+            return self.respond(200, {
+                'took': 1, 'timed_out': False,
+                'hits': {'total': len(docs), 'max_score': None, 'hits': hits[:size]},
+            })
+        if len(path) >= 2:
+            doc_id = self.index_doc(path[0], json.loads(body))
+            return self.respond(201, {'_index': path[0], '_id': doc_id, 'result': 'created'})
+        self.respond(400, {'error': 'unsupported request'})
+
+    @staticmethod
+    def sort(docs, sort):
+        # 只支持按一个 _source 字段排序, _doc 保持写入顺序
+        if isinstance(sort, list):
+            sort = sort[0] if sort else None
+        if not isinstance(sort, dict):
+            return docs
+        field, order = next(iter(sort.items()))
+        if isinstance(order, dict):
+            order = order.get('order', 'asc')
+        return sorted(docs, key=lambda d: d[2].get(field), reverse=order == 'desc')
+
+    def scroll_page(self, scroll_id, total=None):
+        with self.lock:
+            state = self.scrolls.get(scroll_id)
+            if state is None:
+                return self.respond(404, {'error': {'type': 'search_context_missing_exception'}, 'status': 404})
+            hits, size = state
+            self.scrolls[scroll_id] = (hits[size:], size)
+        return self.respond(200, {
+            '_scroll_id': scroll_id, 'took': 1, 'timed_out': False,
+            'hits': {'total': len(hits) if total is None else total, 'max_score': None, 'hits': hits[:size]},
+        })
+
+    def do_DELETE(self):
+        path = [p for p in urlsplit(self.path).path.split('/') if p]
+        body = self.read_body()
+        request = json.loads(body) if body else {}
+        scroll_ids = path[2].split(',') if len(path) > 2 else request.get('scroll_id') or []
+        if isinstance(scroll_ids, str):
+            scroll_ids = [scroll_ids]
+        with self.lock:
+            for scroll_id in scroll_ids:
+                self.scrolls.pop(scroll_id, None)
+        self.respond(200, {'succeeded': True, 'num_freed': len(scroll_ids)})
+
+    def bulk(self, body):
+        lines = body.decode('utf-8').splitlines()
+        items = []
+        for action_line, source in zip(lines[0::2], lines[1::2]):
+            action, meta = next(iter(json.loads(action_line).items()))
+            doc_id = self.index_doc(meta.get('_index'), json.loads(source))
+            items.append({action: {'_index': meta.get('_index'), '_id': doc_id, 'status': 201}})
+        self.respond(200, {'took': 1, 'errors': False, 'items': items})
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端关闭连接池时的连接重置不是错误
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeServer(object):
+    """
+    在后台线程运行的 HTTP 服务, 端口为 0 时自动分配, 可以作为上下文管理器使用
+    """
+    handler = None
+
+    def __init__(self, host='127.0.0.1', port=0):
+        handler = type(self.handler.__name__, (self.handler,), self.handler_attrs())
+        self.server = QuietHTTPServer((host, port), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def handler_attrs(self):
+        return {'store': ObjectStore()}
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class FakeS3Server(FakeServer):
+    handler = S3Handler
+
+
+class FakeOSSServer(FakeServer):
+    handler = OSSHandler
+
+
+class FakeESServer(FakeServer):
+    handler = ESHandler
+
+    def handler_attrs(self):
+        return {'indices': {}, 'scrolls': {}, 'lock': threading.Lock()}
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+"""
+对本地的 S3/OSS/ES 替身服务运行基准测试, 结果以 JSON 输出:
+
+    python benchmarks/run.py --sizes 1024,1048576 --concurrency 1,8 --output result.json
+
+每组结果包含 backend, operation, size, concurrency, ops, ops_per_sec, p50, p99 (秒)
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+import storagekit  # noqa: E402
+from fakes import FakeESServer, FakeOSSServer, FakeS3Server  # noqa: E402
+
+
+def percentile(samples, p):
+    return samples[min(int(len(samples) * p), len(samples) - 1)] if samples else None
+
+
+def measure(func, items, concurrency):
+    """
+    用 concurrency 个线程对每个 item 调用 func, 返回 (总耗时, 排序后的单次延迟)
+    """
+    def timed(item):
+        start = time.perf_counter()
+        resp = func(item)
+        if isinstance(resp, dict) and resp.get('status') == 'failure':
+            raise RuntimeError(resp['errmsg'])
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(timed, items))
+    return time.perf_counter() - start, latencies
+
+
+def result(backend, operation, size, concurrency, elapsed, latencies):
+    return {
+        'backend': backend, 'operation': operation, 'size': size, 'concurrency': concurrency,
+        'ops': len(latencies), 'ops_per_sec': len(latencies) / elapsed if elapsed else None,
+        'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99),
+    }
+
+
+def bench_object_storage(name, storage, sizes, concurrency_levels, ops):
+    results = []
+    for size in sizes:
+        data = os.urandom(size)
+        for concurrency in concurrency_levels:
+            prefix = 'bench/%d-%d/' % (size, concurrency)
+            keys = ['%s%06d' % (prefix, i) for i in range(ops)]
+            for operation, func in (
+                ('put', lambda key: storage.put_object(key, data)),
+                ('get', storage.get_object),
+                ('head', storage.head_object),
+                ('list', lambda _: storage.list_objects(prefix=prefix)),
+                ('delete', storage.delete_object),
+            ):
+                elapsed, latencies = measure(func, keys, concurrency)
+                results.append(result(name, operation, size, concurrency, elapsed, latencies))
+    return results
+
+
+def bench_log_storage(storage, batch_sizes, concurrency_levels, ops):
+    results = []
+    for batch_size in batch_sizes:
+        command = {
+            'user': 'admin', 'asset': 'web-01', 'system_user': 'root', 'input': 'ls -al',
+            'output': 'x' * 128, 'risk_level': 0, 'session': 'bench', 'timestamp': time.time(),
+        }
+        batch = [dict(command) for _ in range(batch_size)]
+        for concurrency in concurrency_levels:
+            elapsed, latencies = measure(
+                lambda _: storage.bulk_save(batch), range(ops), concurrency
+            )
+            results.append(result('es', 'bulk_save', batch_size, concurrency, elapsed, latencies))
+            elapsed, latencies = measure(lambda _: storage.filter(), range(ops), concurrency)
+            results.append(result('es', 'filter', batch_size, concurrency, elapsed, latencies))
+            elapsed, latencies = measure(
+                lambda _: sum(1 for _ in storage.iter_filter(page_size=batch_size)), range(ops), concurrency
+            )
+            results.append(result('es', 'iter_filter', batch_size, concurrency, elapsed, latencies))
+    return results
+
+
+def parse_ints(value):
+    return [int(x) for x in value.split(',') if x]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='storagekit offline benchmark')
+    parser.add_argument('--backends', default='s3,oss,es,memory,local')
+    parser.add_argument('--sizes', type=parse_ints, default=[1024, 64 * 1024, 1024 * 1024],
+                        help='object sizes in bytes')
+    parser.add_argument('--batch-sizes', type=parse_ints, default=[100, 1000],
+                        help='documents per bulk_save')
+    parser.add_argument('--concurrency', type=parse_ints, default=[1, 8, 32])
+    parser.add_argument('--ops', type=int, default=200, help='operations per measurement')
+    parser.add_argument('--output', help='write JSON to this file instead of stdout')
+    args = parser.parse_args()
+    backends = args.backends.split(',')
+
+    results = []
+    credentials = {'ACCESS_KEY': 'bench', 'SECRET_KEY': 'bench', 'BUCKET': 'bench',
+                   'POOL_SIZE': max(args.concurrency), 'MAX_POOL_CONNECTIONS': max(args.concurrency)}
+    if 's3' in backends:
+        with FakeS3Server() as server:
+            storage = storagekit.create_object_storage(
+                dict(credentials, TYPE='s3', REGION='us-east-1', ENDPOINT=server.endpoint)
+            )
+            results.extend(bench_object_storage('s3', storage, args.sizes, args.concurrency, args.ops))
+    if 'oss' in backends:
+        with FakeOSSServer() as server:
+            storage = storagekit.create_object_storage(dict(credentials, TYPE='oss', ENDPOINT=server.endpoint))
+            results.extend(bench_object_storage('oss', storage, args.sizes, args.concurrency, args.ops))
+    for kind in ('memory', 'local'):
+        if kind in backends:
+            root = tempfile.mkdtemp()
+            try:
+                storage = storagekit.create_object_storage({'TYPE': kind, 'ROOT': root})
+                results.extend(bench_object_storage(kind, storage, args.sizes, args.concurrency, args.ops))
+            finally:
+                shutil.rmtree(root)
+    if 'es' in backends:
+        with FakeESServer() as server:
+            storage = storagekit.create_log_storage(
+                {'TYPE': 'es', 'HOSTS': [server.endpoint], 'POOL_SIZE': max(args.concurrency)}
+            )
+            results.extend(bench_log_storage(storage, args.batch_sizes, args.concurrency, args.ops))
+
+    report = {
+        'version': storagekit.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'params': {'sizes': args.sizes, 'batch_sizes': args.batch_sizes,
+                   'concurrency': args.concurrency, 'ops': args.ops},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
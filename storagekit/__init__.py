@@ -3,30 +3,112 @@
 
 __version__ = '0.0.21'
 
-from .oss import OSSStorage
-from .s3 import S3Storage
-from .azure import AzureStorage
-from .es import ESStorage
-from .multi import MultiObjectStorage
-
-
-def get_object_storage(config):
-    if config.get("TYPE") in ["s3", "ceph", "swift"]:
-        return S3Storage(config)
-    elif config.get("TYPE") == "oss":
-        return OSSStorage(config)
-    elif config.get("TYPE") == "azure":
-        return AzureStorage(config)
-    else:
+import importlib
+
+from .registry import registry
+
+# 后端在第一次使用时才导入, 避免 import storagekit 时加载 boto3/oss2/azure/elasticsearch
+object_storage_backends = {
+    's3': 'storagekit.s3:S3Storage',
+    'ceph': 'storagekit.s3:S3Storage',
+    'swift': 'storagekit.s3:S3Storage',
+    'oss': 'storagekit.oss:OSSStorage',
+    'azure': 'storagekit.azure:AzureStorage',
+    'memory': 'storagekit.memory:MemoryStorage',
+    'local': 'storagekit.local:LocalStorage',
+}
+
+log_storage_backends = {
+    'es': 'storagekit.es:ESStorage',
+    'elasticsearch': 'storagekit.es:ESStorage',
+}
+
+lazy_exports = {
+    'OSSStorage': 'storagekit.oss:OSSStorage',
+    'S3Storage': 'storagekit.s3:S3Storage',
+    'AzureStorage': 'storagekit.azure:AzureStorage',
+    'ESStorage': 'storagekit.es:ESStorage',
+    'MemoryStorage': 'storagekit.memory:MemoryStorage',
+    'LocalStorage': 'storagekit.local:LocalStorage',
+    'MultiObjectStorage': 'storagekit.multi:MultiObjectStorage',
+    'AsyncObjectStorage': 'storagekit.aio:AsyncObjectStorage',
+    'AsyncLogStorage': 'storagekit.aio:AsyncLogStorage',
+    'CachedObjectStorage': 'storagekit.cache:CachedObjectStorage',
+}
+
+
+def load_backend(backend):
+    """
+    backend 为类或 'module:Class' 字符串
+    """
+    if not isinstance(backend, str):
+        return backend
+    module_name, _, name = backend.partition(':')
+    return getattr(importlib.import_module(module_name), name)
+
+
+def register_object_storage(kind, backend):
+    """
+    注册第三方对象存储后端, backend 为类或 'module:Class', 之后 TYPE 为 kind 的配置使用它
+    """
+    object_storage_backends[kind] = backend
+
+
+def register_log_storage(kind, backend):
+    log_storage_backends[kind] = backend
+
+
+def instrument_storage(storage, config):
+    """
+    配置了 METRICS (metrics.MetricsSink 实例) 时记录每个操作的延迟、字节数和错误
+    """
+    if config.get("METRICS") is not None:
+        from .metrics import instrument
+        instrument(storage, config["METRICS"])
+    return storage
+
+
+def create_object_storage(config):
+    backend = object_storage_backends.get(config.get("TYPE"))
+    if backend is None:
         raise Exception("Not found proper storage")
+    return instrument_storage(load_backend(backend)(config), config)
 
 
-def get_log_storage(config):
-    if config.get("TYPE") in ("es", "elasticsearch"):
-        return ESStorage(config)
-    else:
+def create_log_storage(config):
+    backend = log_storage_backends.get(config.get("TYPE"))
+    if backend is None:
         raise Exception("Not found proper storage")
+    return instrument_storage(load_backend(backend)(config), config)
+
+
+def get_object_storage(config, shared=True):
+    """
+    相同配置返回同一个共享实例, shared=False 时每次新建
+    """
+    if not shared:
+        return create_object_storage(config)
+    return registry.get('object', config, create_object_storage)
+
+
+def get_log_storage(config, shared=True):
+    if not shared:
+        return create_log_storage(config)
+    return registry.get('log', config, create_log_storage)
+
+
+def get_multi_object_storage(configs, **kwargs):
+    from .multi import MultiObjectStorage
+    return MultiObjectStorage(configs, **kwargs)
+
+
+def __getattr__(name):
+    if name not in lazy_exports:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = load_backend(lazy_exports[name])
+    globals()[name] = value
+    return value
 
 
-def get_multi_object_storage(configs):
-    return MultiObjectStorage(configs)
+def __dir__():
+    return sorted(set(globals()) | set(lazy_exports))
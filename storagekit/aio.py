@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncStorage(object):
+    """
+    在有界线程池上执行阻塞的存储方法, 同时执行的调用数不超过 max_concurrency
+    """
+
+    def __init__(self, storage, max_concurrency=32, executor=None):
+        self.storage = storage
+        self.max_concurrency = max_concurrency
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_concurrency)
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # 在事件循环中第一次使用时创建, 兼容旧版本 asyncio 的 loop 绑定
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def run(self, method, *args, **kwargs):
+        func = getattr(self.storage, method) if isinstance(method, str) else method
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def gather(self, method, args_list, return_exceptions=False):
+        """
+        对 args_list 中的每组参数调用 method, 按顺序返回结果, 并发数受 max_concurrency 限制
+        """
+        tasks = [
+            self.run(method, *(args if isinstance(args, (list, tuple)) else (args,)))
+            for args in args_list
+        ]
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+
+    async def as_completed(self, method, args_list):
+        """
+        按完成顺序返回 (参数, 结果)
+        """
+        async def call(args):
+            params = args if isinstance(args, (list, tuple)) else (args,)
+            return args, await self.run(method, *params)
+
+        for future in asyncio.as_completed([call(args) for args in args_list]):
+            yield await future
+
+    def close(self):
+        if self.own_executor:
+            self.executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+
+class AsyncObjectStorage(AsyncStorage):
+
+    async def list_objects(self, **kwargs):
+        return await self.run('list_objects', **kwargs)
+
+    async def delete_object(self, key):
+        return await self.run('delete_object', key)
+
+    async def delete_objects(self, key_list):
+        return await self.run('delete_objects', key_list)
+
+    async def exists_object(self, key):
+        return await self.run('exists_object', key)
+
+    async def head_object(self, key):
+        return await self.run('head_object', key)
+
+    async def put_object(self, key, data):
+        return await self.run('put_object', key, data)
+
+    async def get_object(self, key, **kwargs):
+        return await self.run('get_object', key, **kwargs)
+
+    async def create_folder(self, key):
+        return await self.run('create_folder', key)
+
+    async def delete_folder(self, key):
+        return await self.run('delete_folder', key)
+
+    async def upload_file(self, src, target, **kwargs):
+        return await self.run('upload_file', src, target, **kwargs)
+
+    async def download_file(self, src, target, **kwargs):
+        return await self.run('download_file', src, target, **kwargs)
+
+    async def list_buckets(self, **kwargs):
+        return await self.run('list_buckets', **kwargs)
+
+    async def create_bucket(self, bucket=None, **kwargs):
+        return await self.run('create_bucket', bucket, **kwargs)
+
+    async def delete_bucket(self, bucket=None):
+        return await self.run('delete_bucket', bucket)
+
+    async def get_bucket(self, bucket=None):
+        return await self.run('get_bucket', bucket)
+
+    async def put_objects(self, items):
+        """
+        items 为 (key, data) 列表, 按顺序返回每个 put_object 的结果
+        """
+        return await self.gather('put_object', list(items))
+
+    async def get_objects(self, keys):
+        return await self.gather('get_object', list(keys))
+
+    async def exists_objects(self, keys):
+        return await self.gather('exists_object', list(keys))
+
+
+class AsyncLogStorage(AsyncStorage):
+    """
+    安装了带 AsyncElasticsearch 的 elasticsearch 版本时, save/count/filter 使用原生异步客户端,
+    其余方法仍然在线程池上执行
+    """
+
+    def __init__(self, storage, max_concurrency=32, executor=None, async_client=None):
+        super().__init__(storage, max_concurrency=max_concurrency, executor=executor)
+        if async_client is None and hasattr(storage, 'es'):
+            try:
+                from elasticsearch import AsyncElasticsearch
+                async_client = AsyncElasticsearch(**storage.client_kwargs)
+            except ImportError:
+                pass
+        self.async_client = async_client
+
+    async def save(self, command):
+        if self.async_client is None or getattr(self.storage, 'writer', None):
+            return await self.run('save', command)
+        storage = self.storage
+        # 分区索引第一次使用时 get_index 会同步创建索引, 不能在事件循环中执行
+        index = await self.run(storage.get_index, command["timestamp"])
+        async with self.semaphore:
+            return await self.async_client.index(
+                index=index,
+                doc_type=storage.doc_type, body=storage.make_data(command)
+            )
+
+    async def bulk_save(self, command_set, raise_on_error=True, **kwargs):
+        return await self.run('bulk_save', command_set, raise_on_error=raise_on_error, **kwargs)
+
+    async def filter(self, date_from=None, date_to=None,
+                     user=None, asset=None, system_user=None,
+                     input=None, session=None, risk_level=None, org_id=None):
+        if self.async_client is None:
+            return await self.run(
+                'filter', date_from=date_from, date_to=date_to, user=user, asset=asset,
+                system_user=system_user, input=input, session=session,
+                risk_level=risk_level, org_id=org_id
+            )
+        storage = self.storage
+        match, exact = storage.make_filter(
+            user=user, asset=asset, system_user=system_user, input=input,
+            session=session, risk_level=risk_level, org_id=org_id
+        )
+        body = storage.get_query_body(match, exact, date_from, date_to)
+        kwargs = storage.get_search_kwargs(date_from, date_to)
+        async with self.semaphore:
+            data = await self.async_client.search(body=body, size=0, **kwargs)
+            total = data["hits"]["total"]
+            # ES 7 以后 total 是 {"value": n, "relation": "eq"}
+            if isinstance(total, dict):
+                total = total["value"]
+            data = await self.async_client.search(body=body, size=total, **kwargs)
+        return data["hits"]
+
+    async def count(self, date_from=None, date_to=None,
+                    user=None, asset=None, system_user=None,
+                    input=None, session=None):
+        if self.async_client is None:
+            return await self.run(
+                'count', date_from=date_from, date_to=date_to, user=user, asset=asset,
+                system_user=system_user, input=input, session=session
+            )
+        storage = self.storage
+        match, exact = storage.make_filter(
+            user=user, asset=asset, system_user=system_user, input=input, session=session
+        )
+        body = storage.get_query_body(match, exact, date_from, date_to)
+        del body["sort"]
+        async with self.semaphore:
+            data = await self.async_client.count(body=body, **storage.get_search_kwargs(date_from, date_to))
+        return data["count"]
+
+    async def aggregate(self, **kwargs):
+        return await self.run('aggregate', **kwargs)
+
+    async def close_async(self):
+        if self.async_client is not None:
+            await self.async_client.close()
+
+    async def __aexit__(self, *args):
+        await self.close_async()
+        self.close()
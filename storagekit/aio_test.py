@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import storagekit
+from fakes import FakeESServer
+
+
+class TestAsyncObjectStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.memory = storagekit.get_object_storage({'TYPE': 'memory'}, shared=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_memory(self):
+        async def main():
+            async with storagekit.AsyncObjectStorage(self.memory, max_concurrency=4) as storage:
+                self.assertEqual((await storage.put_object('k', b'v'))['status'], 'success')
+                self.assertEqual(bytes((await storage.get_object('k'))['data']['body']), b'v')
+                self.assertEqual((await storage.head_object('k'))['data']['size'], 1)
+                results = await storage.put_objects([('a', b'1'), ('b', b'2'), ('c', b'3')])
+                self.assertEqual([r['status'] for r in results], ['success'] * 3)
+                bodies = [bytes(r['data']['body']) for r in await storage.get_objects(['c', 'a', 'b'])]
+                self.assertEqual(bodies, [b'3', b'1', b'2'])
+                await storage.delete_object('k')
+                exists = await storage.exists_objects(['k', 'a'])
+                self.assertEqual([r['status'] for r in exists], ['failure', 'success'])
+            return storage
+        storage = asyncio.run(main())
+        # 自己创建的线程池在退出时关闭
+        self.assertRaises(RuntimeError, storage.executor.submit, time.time)
+
+    def test_local_files(self):
+        local = storagekit.get_object_storage({'TYPE': 'local', 'ROOT': self.tmp, 'BUCKET': 'b'}, shared=False)
+        src = os.path.join(self.tmp, 'src')
+        target = os.path.join(self.tmp, 'out', 'dst')
+        with open(src, 'wb') as f:
+            f.write(b'data')
+
+        async def main():
+            async with storagekit.AsyncObjectStorage(local) as storage:
+                self.assertEqual((await storage.upload_file(src, 'f'))['status'], 'success')
+                self.assertEqual((await storage.download_file('f', target))['status'], 'success')
+                keys = [row['key'] for row in (await storage.list_objects())['data']]
+                self.assertEqual(keys, ['f'])
+        asyncio.run(main())
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+
+    def test_gather_and_as_completed(self):
+        def work(i):
+            if i == 2:
+                raise ValueError(i)
+            time.sleep(0.01 * (3 - i))
+            return i * 10
+
+        async def main():
+            async with storagekit.AsyncObjectStorage(self.memory) as storage:
+                self.assertEqual(await storage.run(work, 1), 10)
+                results = await storage.gather(work, [0, 1, 2], return_exceptions=True)
+                self.assertEqual(results[:2], [0, 10])
+                self.assertIsInstance(results[2], ValueError)
+                with self.assertRaises(ValueError):
+                    await storage.gather(work, [(1,), (2,)])
+                return [pair async for pair in storage.as_completed(work, [0, 1])]
+        self.assertEqual(asyncio.run(main()), [(1, 10), (0, 0)])
+
+    def test_semaphore(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def work(i):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+            return i
+
+        async def main(executor):
+            # 共享的线程池比 max_concurrency 大, 并发数由信号量限制
+            async with storagekit.AsyncObjectStorage(self.memory, max_concurrency=2, executor=executor) as storage:
+                return await storage.gather(work, range(8))
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            self.assertEqual(asyncio.run(main(executor)), list(range(8)))
+            # 传入的线程池不会被关闭
+            self.assertEqual(executor.submit(work, 9).result(), 9)
+        self.assertEqual(state['peak'], 2)
+
+
+class FakeAsyncES(object):
+    """
+    只记录调用的异步客户端, 用来测试 AsyncElasticsearch 可用时的路径
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.calls = []
+        self.closed = False
+
+    async def index(self, **kwargs):
+        self.calls.append(('index', kwargs))
+        return self.storage.es.index(**kwargs)
+
+    async def search(self, **kwargs):
+        self.calls.append(('search', kwargs))
+        return self.storage.es.search(**kwargs)
+
+    async def count(self, **kwargs):
+        self.calls.append(('count', kwargs))
+        return self.storage.es.count(**kwargs)
+
+    async def close(self):
+        self.closed = True
+
+
+class TestAsyncLogStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeESServer().start()
+        self.storage = storagekit.get_log_storage(
+            {'TYPE': 'es', 'HOSTS': [self.server.endpoint], 'INDEX_PARTITION': 'day'}, shared=False
+        )
+
+    def tearDown(self):
+        self.storage.close()
+        self.server.stop()
+
+    def command(self, i):
+        return {
+            'user': 'admin', 'asset': 'web-01', 'system_user': 'root', 'input': 'ls %d' % i,
+            'output': 'ok', 'risk_level': 0, 'session': 's', 'timestamp': time.time() - i,
+        }
+
+    def test_executor_fallback(self):
+        async def main():
+            async with storagekit.AsyncLogStorage(self.storage) as storage:
+                # 固定的 elasticsearch 6.x 没有 AsyncElasticsearch, 所有方法都在线程池上执行
+                self.assertIsNone(storage.async_client)
+                await storage.gather('save', [(self.command(i),) for i in range(3)])
+                report = await storage.bulk_save([self.command(i) for i in range(3, 5)])
+                self.assertEqual(report['success'], 2)
+                self.assertEqual(await storage.count(), 5)
+                self.assertEqual(len((await storage.filter())['hits']), 5)
+        asyncio.run(main())
+
+    def test_async_client(self):
+        client = FakeAsyncES(self.storage)
+
+        async def main():
+            async with storagekit.AsyncLogStorage(self.storage, async_client=client) as storage:
+                await storage.save(self.command(0))
+                self.assertEqual(await storage.count(), 1)
+                self.assertEqual(len((await storage.filter())['hits']), 1)
+        asyncio.run(main())
+        self.assertEqual([name for name, _ in client.calls], ['index', 'count', 'search', 'search'])
+        # 索引名在线程池中由 get_index 得到, 分区索引已经创建
+        self.assertEqual(client.calls[0][1]['index'], self.storage.get_index(time.time()))
+        self.assertTrue(client.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
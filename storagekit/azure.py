@@ -1,11 +1,44 @@
 # -*- coding: utf-8 -*-
 #
 
+import io
 import os
+import time
 
+import requests
+from azure.common import AzureMissingResourceHttpError
 from azure.storage.blob import BlockBlobService
+from azure.storage.blob.models import BlobPrefix
 
-from .base import ObjectStorage
+from .base import ObjectStorage, ObjectReader
+from .utils import ProgressMeter, bounded_map, make_http_adapter
+
+
+class BlobRangeStream(object):
+    """
+    按 chunk_size 分段请求 blob 的 [start, end] 范围, 不需要一次读入整个 blob
+    """
+
+    def __init__(self, storage, key, start, end, chunk_size):
+        self.storage = storage
+        self.key = key
+        self.offset = start
+        self.end = end
+        self.chunk_size = chunk_size
+        self.buffer = b''
+
+    def read(self, size=None):
+        if size is None:
+            size = self.end - self.offset + 1 + len(self.buffer)
+        while len(self.buffer) < size and self.offset <= self.end:
+            end = min(self.offset + max(self.chunk_size, size) - 1, self.end)
+            blob = self.storage.client.get_blob_to_bytes(
+                self.storage.container_name, self.key, start_range=self.offset, end_range=end
+            )
+            self.buffer += blob.content
+            self.offset = end + 1
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
 
 
 class AzureStorage(ObjectStorage):
@@ -15,72 +48,296 @@ class AzureStorage(ObjectStorage):
         self.account_key = config.get("ACCOUNT_KEY", None)
         self.container_name = config.get("CONTAINER_NAME", None)
         self.endpoint_suffix = config.get("ENDPOINT_SUFFIX", 'core.chinacloudapi.cn')
+        self.pool_size = config.get("POOL_SIZE", 10)
+        self.keep_alive = config.get("KEEP_ALIVE", True)
+        # 单个 blob 上传下载时的并发连接数, 以及分块上传的块大小
+        self.max_connections = config.get("MAX_CONNECTIONS", 4)
+        self.block_size = config.get("BLOCK_SIZE", BlockBlobService.MAX_BLOCK_SIZE)
+        # 大于 single_put_size 的 blob 分块上传, 大于 single_get_size 的 blob 分段并发下载
+        self.single_put_size = config.get("SINGLE_PUT_SIZE", BlockBlobService.MAX_SINGLE_PUT_SIZE)
+        self.single_get_size = config.get("SINGLE_GET_SIZE", BlockBlobService.MAX_SINGLE_GET_SIZE)
 
         if self.account_name and self.account_key:
+            self.session = requests.Session()
+            adapter = make_http_adapter(self.pool_size, self.keep_alive)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
             self.client = BlockBlobService(
                 account_name=self.account_name, account_key=self.account_key,
-                endpoint_suffix=self.endpoint_suffix
+                endpoint_suffix=self.endpoint_suffix, request_session=self.session
             )
+            self.client.MAX_BLOCK_SIZE = self.block_size
+            self.client.MAX_CHUNK_GET_SIZE = self.block_size
+            self.client.MAX_SINGLE_PUT_SIZE = self.single_put_size
+            self.client.MAX_SINGLE_GET_SIZE = self.single_get_size
         else:
+            self.session = None
             self.client = None
+        self.init_meta_cache(config)
+
+    @staticmethod
+    def make_row(blob):
+        if isinstance(blob, BlobPrefix):
+            return {'key': blob.name}
+        props = blob.properties
+        return {
+            'key': blob.name, 'last_modified': props.last_modified, 'etag': props.etag,
+            'size': props.content_length, 'type': props.blob_type, 'storage_class': props.blob_tier,
+        }
+
+    def list_page(self, prefix='', delimiter='', marker=None, max_keys=1000):
+        """
+        只请求一页, 返回 (行, 下一页的 marker)
+        """
+        blobs = self.client.list_blobs(
+            self.container_name, prefix=prefix or None, delimiter=delimiter or None,
+            num_results=max_keys, marker=marker or None
+        )
+        # 直接使用第一页, ListGenerator 迭代时会自动请求后续页
+        return [self.make_row(blob) for blob in blobs.items], blobs.next_marker
 
     def list_objects(self, **kwargs):
-        return self.client.get_block_list(self.container_name, **kwargs)
+        resp = {'status': 'success', 'errmsg': '', 'data': []}
+        try:
+            resp['data'], _ = self.list_page(
+                prefix=kwargs.get('prefix', ''), delimiter=kwargs.get('delimiter', ''),
+                marker=kwargs.get('marker'), max_keys=kwargs.get('max_keys', 1000)
+            )
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def iter_pages(self, prefix='', delimiter='', page_size=1000):
+        # Azure 单页最多 5000 个
+        marker = None
+        while True:
+            data, marker = self.list_page(prefix, delimiter, marker, min(page_size, 5000))
+            yield data
+            if not marker:
+                break
 
     def exists_object(self, key):
-        return self.client.exists(self.container_name, key)
+        resp = self.head_object(key)
+        return {'status': resp['status'], 'errmsg': resp['errmsg']}
+
+    def head_object(self, key):
+        resp = self.get_cached_meta(key)
+        if resp is not None:
+            return resp
+        generation = self.meta_generation()
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            props = self.client.get_blob_properties(self.container_name, key).properties
+            resp['data'] = {
+                'size': props.content_length, 'etag': props.etag,
+                'last_modified': props.last_modified,
+                'content_type': props.content_settings.content_type,
+            }
+            self.set_cached_meta(key, resp, generation=generation)
+        except AzureMissingResourceHttpError as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+            self.set_cached_meta(key, resp, missing=True, generation=generation)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
 
     def delete_object(self, key):
+        resp = {'status': 'success', 'errmsg': ''}
         try:
-            self.client.delete_blob(self.container_name, key)
-            return True, False
+            with self.invalidating_meta(key):
+                self.client.delete_blob(self.container_name, key)
+        except AzureMissingResourceHttpError:
+            # 与 S3/OSS 一致, 删除不存在的 key 视为成功
+            pass
         except Exception as e:
-            return False, e
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def delete_batch(self, keys):
+        # 当前 SDK 没有批量删除接口, 在连接池上并发删除
+        errors = []
+        results = bounded_map(self.delete_object, keys, workers=self.pool_size)
+        for key, resp in zip(keys, results):
+            if resp['status'] != 'success':
+                errors.append({'key': key, 'errmsg': resp['errmsg']})
+        return len(keys) - len(errors), errors
+
+    def delete_objects(self, key_list, workers=1):
+        # 每批已经在连接池上并发, 默认不再并发多个批次
+        return self.delete_keys(key_list, batch_size=self.pool_size * 10, workers=workers)
 
     def put_object(self, key, data):
-        pass
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            with self.invalidating_meta(key):
+                if isinstance(data, str):
+                    data = data.encode('utf-8')
+                if hasattr(data, 'read'):
+                    self.client.create_blob_from_stream(
+                        self.container_name, key, data, max_connections=self.max_connections
+                    )
+                else:
+                    self.client.create_blob_from_bytes(
+                        self.container_name, key, bytes(data), max_connections=self.max_connections
+                    )
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
 
     def get_object(self, key, **kwargs):
-        pass
+        """
+        大于 single_get_size 的 blob 用 max_connections 个连接分段并发下载
+        """
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            kwargs.setdefault('max_connections', self.max_connections)
+            blob = self.client.get_blob_to_bytes(self.container_name, key, **kwargs)
+            props = blob.properties
+            resp['data'] = {
+                'body': blob.content, 'size': props.content_length, 'etag': props.etag,
+                'last_modified': props.last_modified,
+                'content_type': props.content_settings.content_type,
+            }
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def open_read(self, key, start=None, end=None, size=None):
+        """
+        size 为 blob 大小, 未传入时从 head_object 获取, 启用元数据缓存时不会每次请求
+        """
+        if size is None:
+            head = self.head_object(key)
+            if head['status'] != 'success':
+                raise IOError(head['errmsg'])
+            size = head['data']['size']
+        start = start or 0
+        end = size - 1 if end is None else min(end, size - 1)
+        if end < start:
+            return ObjectReader(io.BytesIO(b''), size=0)
+        stream = BlobRangeStream(self, key, start, end, self.block_size)
+        return ObjectReader(stream, size=end - start + 1, chunk_size=self.block_size)
+
+    def open_range(self, key, start, end, size):
+        # 已经知道大小, 分段读取时不再逐段 HEAD
+        return self.open_read(key, start, end, size=size)
 
     def create_folder(self, key):
         if not key.endswith('/'): key += '/'
-        pass
+        return self.put_object(key, b'')
 
-    def delete_folder(self, key):
+    def delete_folder(self, key, workers=1):
         if not key.endswith('/'): key += '/'
-        pass
+        return self.delete_prefix(key, batch_size=self.pool_size * 10, workers=workers)
 
-    def upload_file(self, src, target):
+    def upload_file(self, src, target, callback=None, max_connections=None):
+        """
+        callback(transferred, total, bytes_per_second) 报告进度
+        """
+        resp = {'status': 'success', 'errmsg': ''}
         try:
-            self.client.create_blob_from_path(self.container_name, target, src)
-            return True, None
+            with self.invalidating_meta(target):
+                meter = ProgressMeter(callback) if callback else None
+                self.client.create_blob_from_path(
+                    self.container_name, target, src,
+                    max_connections=max_connections or self.max_connections,
+                    progress_callback=meter.update_to if meter else None
+                )
         except Exception as e:
-            return False, e
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
 
-    def download_file(self, src, target):
+    def download_file(self, src, target, callback=None, max_connections=None):
+        resp = {'status': 'success', 'errmsg': ''}
         try:
             os.makedirs(os.path.dirname(target), 0o755, exist_ok=True)
-            self.client.get_blob_to_path(self.container_name, src, target)
-            return True, None
+            meter = ProgressMeter(callback) if callback else None
+            self.client.get_blob_to_path(
+                self.container_name, src, target,
+                max_connections=max_connections or self.max_connections,
+                progress_callback=meter.update_to if meter else None
+            )
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def can_copy_from(self, storage):
+        return storage is self or (storage.type == self.type and storage.account_name == self.account_name)
+
+    def copy_object(self, src_key, dst_key, src_storage=None):
+        resp = {'status': 'success', 'errmsg': ''}
+        src = src_storage or self
+        try:
+            with self.invalidating_meta(dst_key):
+                source = self.client.make_blob_url(src.container_name, src_key)
+                copy = self.client.copy_blob(self.container_name, dst_key, source)
+                # 服务端异步复制, 等待完成
+                while copy.status == 'pending':
+                    time.sleep(0.5)
+                    copy = self.client.get_blob_properties(self.container_name, dst_key).properties.copy
+                if copy.status != 'success':
+                    raise Exception('Copy %s: %s' % (copy.status, copy.status_description))
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def upload_fileobj(self, fileobj, target, size=None, callback=None):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            with self.invalidating_meta(target):
+                meter = ProgressMeter(callback, total=size) if callback else None
+                self.client.create_blob_from_stream(
+                    self.container_name, target, fileobj, count=size, max_connections=self.max_connections,
+                    progress_callback=meter.update_to if meter else None
+                )
         except Exception as e:
-            return False, e
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
 
     def list_buckets(self, **kwargs):
-        response = self.client.list_containers()
-        return ([c.name for c in response.items])
+        resp = {'status': 'success', 'errmsg': '', 'data': []}
+        try:
+            resp['data'] = [{'name': c.name, 'create_time': c.properties.last_modified}
+                            for c in self.client.list_containers(**kwargs)]
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
 
     def create_bucket(self, bucket=None, **kwargs):
-        if not bucket: bucket = self.bucket
-        pass
+        resp = {'status': 'success', 'errmsg': ''}
+        if not bucket: bucket = self.container_name
+        try:
+            self.client.create_container(bucket, fail_on_exist=True, **kwargs)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
 
     def delete_bucket(self, bucket=None):
-        if not bucket: bucket = self.bucket
-        pass
+        resp = {'status': 'success', 'errmsg': ''}
+        if not bucket: bucket = self.container_name
+        try:
+            self.client.delete_container(bucket, fail_not_exist=True)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
 
     def get_bucket(self, bucket=None):
-        if not bucket: bucket = self.bucket
-        pass
+        resp = {'status': 'success', 'errmsg': ''}
+        if not bucket: bucket = self.container_name
+        try:
+            container = self.client.get_container_properties(bucket)
+            resp['data'] = {
+                'name': container.name, 'etag': container.properties.etag,
+                'last_modified': container.properties.last_modified,
+                'metadata': container.metadata,
+            }
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
 
     @property
     def type(self):
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+
+import collections
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import storagekit
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from azure.storage.blob.models import Blob, BlobPrefix, BlobProperties
+from fakes import ObjectStore
+
+
+class BlobPage(object):
+    def __init__(self, items, next_marker):
+        self.items = items
+        self.next_marker = next_marker
+
+
+class FakeBlockBlobService(object):
+    """
+    只实现 AzureStorage 用到的 BlockBlobService 方法, 数据保存在 ObjectStore 中, 记录调用次数;
+    copy_blob 返回 pending, 之后 copy_polls 次 get_blob_properties 后变为 success
+    """
+
+    def __init__(self, copy_polls=2):
+        self.store = ObjectStore()
+        self.calls = collections.Counter()
+        self.copy_polls = copy_polls
+        self.copies = {}
+
+    def meta(self, container, key):
+        meta = self.store.get(container, key)
+        if meta is None:
+            raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+        return meta
+
+    @staticmethod
+    def make_props(meta):
+        props = BlobProperties()
+        props.blob_type = 'BlockBlob'
+        props.content_length = len(meta['body'])
+        props.etag = '"%s"' % meta['etag']
+        props.last_modified = datetime.datetime.fromtimestamp(meta['mtime'], datetime.timezone.utc)
+        props.content_settings.content_type = 'application/octet-stream'
+        return props
+
+    def list_blobs(self, container, prefix=None, delimiter=None, num_results=None, marker=None):
+        self.calls['list_blobs'] += 1
+        contents, prefixes, truncated, last = self.store.list(
+            container, prefix or '', delimiter or '', start_after=marker or '', max_keys=num_results or 5000
+        )
+        items = [Blob(name=key, props=self.make_props(meta)) for key, meta in contents]
+        for name in prefixes:
+            item = BlobPrefix()
+            item.name = name
+            items.append(item)
+        return BlobPage(items, last if truncated else None)
+
+    def get_blob_properties(self, container, key):
+        self.calls['get_blob_properties'] += 1
+        props = self.make_props(self.meta(container, key))
+        remaining = self.copies.get((container, key))
+        if remaining is not None:
+            self.copies[(container, key)] = remaining - 1
+            props.copy.status = 'pending' if remaining > 1 else 'success'
+        return Blob(name=key, props=props)
+
+    def get_blob_to_bytes(self, container, key, start_range=None, end_range=None, **kwargs):
+        self.calls['get_blob_to_bytes'] += 1
+        body = self.meta(container, key)['body']
+        if start_range is not None and start_range >= len(body):
+            raise AzureHttpError('The range specified is invalid for the current size of the resource.', 416)
+        content = body[start_range or 0:None if end_range is None else end_range + 1]
+        return Blob(name=key, content=content, props=self.make_props(self.meta(container, key)))
+
+    def get_blob_to_path(self, container, key, path, progress_callback=None, **kwargs):
+        body = self.meta(container, key)['body']
+        with open(path, 'wb') as f:
+            f.write(body)
+        if progress_callback:
+            progress_callback(len(body), len(body))
+
+    def create_blob_from_bytes(self, container, key, data, **kwargs):
+        self.store.put(container, key, bytes(data))
+
+    def create_blob_from_stream(self, container, key, stream, count=None, progress_callback=None, **kwargs):
+        data = stream.read() if count is None else stream.read(count)
+        self.store.put(container, key, data)
+        if progress_callback:
+            progress_callback(len(data), count)
+
+    def create_blob_from_path(self, container, key, path, progress_callback=None, **kwargs):
+        with open(path, 'rb') as f:
+            self.create_blob_from_stream(container, key, f, progress_callback=progress_callback)
+
+    def delete_blob(self, container, key):
+        self.calls['delete_blob'] += 1
+        self.meta(container, key)
+        self.store.delete(container, key)
+
+    def make_blob_url(self, container, key):
+        return 'https://fake.blob.core.windows.net/%s/%s' % (container, key)
+
+    def copy_blob(self, container, key, url):
+        self.calls['copy_blob'] += 1
+        src_container, src_key = url.split('/', 4)[3:]
+        self.store.put(container, key, self.meta(src_container, src_key)['body'])
+        self.copies[(container, key)] = self.copy_polls
+        props = self.make_props(self.meta(container, key))
+        props.copy.status = 'pending'
+        return props.copy
+
+
+class TestAzureStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.storage = storagekit.get_object_storage(
+            {'TYPE': 'azure', 'CONTAINER_NAME': 'c', 'BLOCK_SIZE': 4}, shared=False
+        )
+        self.client = self.storage.client = FakeBlockBlobService()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def put(self, key, data):
+        self.assertEqual(self.storage.put_object(key, data)['status'], 'success')
+
+    def test_pagination(self):
+        keys = ['a/%d' % i for i in range(7)] + ['a/sub/x', 'b']
+        for key in keys:
+            self.put(key, b'x')
+        rows = list(self.storage.iter_objects(prefix='a/', page_size=3))
+        self.assertEqual([row['key'] for row in rows], keys[:-1])
+        self.assertEqual(rows[0]['size'], 1)
+        # 8 个 key, 每页 3 个, 需要 3 页
+        self.assertEqual(self.client.calls['list_blobs'], 3)
+        rows = self.storage.list_objects(prefix='a/', delimiter='/')['data']
+        self.assertEqual(sorted(row['key'] for row in rows), sorted(keys[:7] + ['a/sub/']))
+
+    def test_range_read(self):
+        self.put('k', b'0123456789')
+        with self.storage.open_read('k', 2, 5) as reader:
+            self.assertEqual(reader.size, 4)
+            self.assertEqual(reader.read(), b'2345')
+        with self.storage.open_read('k') as reader:
+            # BLOCK_SIZE 为 4, 分段请求
+            self.assertEqual([bytes(chunk) for chunk in reader], [b'0123', b'4567', b'89'])
+        with self.storage.open_read('k', 8, 100) as reader:
+            self.assertEqual(reader.read(), b'89')
+        with self.storage.open_read('k', 20) as reader:
+            self.assertEqual(reader.read(), b'')
+        with self.assertRaises(IOError):
+            self.storage.open_read('missing')
+
+    def test_parallel_read_single_head(self):
+        data = os.urandom(1000)
+        self.put('big', data)
+        self.client.calls.clear()
+        resp = self.storage.get_object_parallel('big', part_size=100)
+        self.assertEqual(bytes(resp['data']['body']), data)
+        self.assertEqual(self.client.calls['get_blob_properties'], 1)
+        target = os.path.join(self.tmp, 'big')
+        self.assertEqual(self.storage.get_object_parallel('big', target=target, part_size=300)['status'], 'success')
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.client.calls['get_blob_properties'], 2)
+
+    def test_delete(self):
+        self.put('k', b'x')
+        self.assertEqual(self.storage.delete_object('k')['status'], 'success')
+        # 与 S3/OSS 一致, 删除不存在的 key 视为成功
+        self.assertEqual(self.storage.delete_object('k')['status'], 'success')
+        for key in ('p/1', 'p/2', 'p/3'):
+            self.put(key, b'x')
+        self.assertEqual(self.storage.delete_folder('p')['data']['deleted'], 3)
+        self.assertEqual(list(self.storage.iter_objects()), [])
+
+    def test_copy_pending(self):
+        self.put('src', b'data')
+        with mock.patch('storagekit.azure.time.sleep') as sleep:
+            self.assertEqual(self.storage.copy_object('src', 'dst')['status'], 'success')
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(bytes(self.storage.get_object('dst')['data']['body']), b'data')
+
+    def test_files(self):
+        src = os.path.join(self.tmp, 'src')
+        target = os.path.join(self.tmp, 'out', 'dst')
+        with open(src, 'wb') as f:
+            f.write(b'file')
+        progress = []
+        self.assertEqual(self.storage.upload_file(src, 'f', callback=lambda *a: progress.append(a))['status'],
+                         'success')
+        self.assertEqual(progress[-1][:2], (4, None))
+        self.assertEqual(self.storage.download_file('f', target)['status'], 'success')
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), b'file')
+        self.assertEqual(self.storage.head_object('f')['data']['size'], 4)
+        self.assertEqual(self.storage.exists_object('missing')['status'], 'failure')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,9 +2,114 @@
 #
 
 import abc
+import collections.abc
+import contextlib
+import os
+
+from .utils import MetadataCache, bounded_map, chunked, prefetch
+
+
+class ObjectReader(object):
+    """
+    流式读取对象内容, 可以 read(size), 也可以按 chunk 迭代
+    """
+
+    def __init__(self, stream, size=None, close=None, chunk_size=1024 * 1024):
+        self.stream = stream
+        self.size = size
+        self.chunk_size = chunk_size
+        self._close = close or getattr(stream, 'close', None)
+
+    def read(self, size=-1):
+        return self.stream.read(None if size is None or size < 0 else size)
+
+    def readinto(self, buffer):
+        """
+        读满 buffer 或读到结尾, 返回读取的字节数
+        """
+        view = memoryview(buffer).cast('B')
+        total = 0
+        while total < len(view):
+            data = self.stream.read(min(self.chunk_size, len(view) - total))
+            if not data:
+                break
+            view[total:total + len(data)] = data
+            total += len(data)
+        return total
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.chunk_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        if self._close:
+            self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class ObjectStorage(metaclass=abc.ABCMeta):
+    meta_cache = None
+    meta_cache_backend = None
+    # 为 True 时实例本身保存着数据, 共享注册表不会因为空闲而淘汰它
+    stateful = False
+
+    def init_meta_cache(self, config):
+        """
+        配置了 METADATA_CACHE_TTL 时, head_object/exists_object 的结果缓存在进程内,
+        通过本实例的写入和删除会让缓存失效
+        """
+        ttl = config.get("METADATA_CACHE_TTL")
+        if ttl:
+            self.meta_cache = MetadataCache(
+                ttl=ttl, negative_ttl=config.get("METADATA_NEGATIVE_TTL", 5),
+                capacity=config.get("METADATA_CACHE_SIZE", 100000)
+            )
+            self.meta_cache_backend = '%s:%s' % (self.type, getattr(self, 'bucket', None)
+                                                 or getattr(self, 'container_name', None))
+
+    def get_cached_meta(self, key):
+        if self.meta_cache is None:
+            return None
+        return self.meta_cache.get(self.meta_cache_backend, key)
+
+    def meta_generation(self):
+        """
+        在请求 head 之前获取, 传给 set_cached_meta; 期间有写入或删除时不缓存这次的结果
+        """
+        if self.meta_cache is None:
+            return None
+        return self.meta_cache.generation
+
+    def set_cached_meta(self, key, resp, missing=False, generation=None):
+        if self.meta_cache is not None:
+            self.meta_cache.set(self.meta_cache_backend, key, resp, missing=missing, generation=generation)
+
+    def invalidate_meta(self, key=None, prefix=None):
+        if self.meta_cache is None:
+            return
+        if prefix is not None:
+            self.meta_cache.invalidate_prefix(self.meta_cache_backend, prefix)
+        else:
+            self.meta_cache.invalidate(self.meta_cache_backend, key)
+
+    @contextlib.contextmanager
+    def invalidating_meta(self, key=None, prefix=None):
+        """
+        写入前后都使缓存失效, 写入过程中并发的 head 结果不会留在缓存中
+        """
+        self.invalidate_meta(key, prefix)
+        try:
+            yield
+        finally:
+            self.invalidate_meta(key, prefix)
 
     @abc.abstractmethod
     def list_objects(self, **kwargs):
@@ -62,15 +167,221 @@ class ObjectStorage(metaclass=abc.ABCMeta):
     def get_bucket(self, bucket):
         pass
 
+    def iter_pages(self, prefix='', delimiter='', page_size=1000):
+        """
+        按页返回列举结果, 每页是与 list_objects 的 data 相同格式的列表,
+        默认只有 list_objects 返回的一页, 支持分页的后端需要重写
+        """
+        resp = self.list_objects(prefix=prefix, delimiter=delimiter)
+        if resp['status'] != 'success':
+            raise Exception(resp['errmsg'])
+        yield resp['data']
+
+    def iter_objects(self, prefix='', delimiter='', page_size=1000, prefetch_pages=False):
+        """
+        逐个返回 prefix 下的对象, 内存中最多只有一到两页,
+        prefetch_pages 为 True 时在处理当前页的同时获取下一页
+        """
+        pages = self.iter_pages(prefix=prefix, delimiter=delimiter, page_size=page_size)
+        if prefetch_pages:
+            pages = prefetch(pages)
+        for page in pages:
+            for row in page:
+                yield row
+
+    def delete_batch(self, keys):
+        """
+        删除一批 key, 返回 (删除数, [{'key': key, 'errmsg': errmsg}]),
+        支持批量删除的后端需要重写
+        """
+        errors = []
+        for key in keys:
+            resp = self.delete_object(key)
+            if resp['status'] != 'success':
+                errors.append({'key': key, 'errmsg': resp['errmsg']})
+        return len(keys) - len(errors), errors
+
+    def delete_keys(self, keys, batch_size=1000, workers=4):
+        """
+        keys 可以是生成器, 按 batch_size 分批后在线程池上并发删除
+        """
+        resp = {'status': 'success', 'errmsg': '', 'data': {'deleted': 0, 'errors': []}}
+        data = resp['data']
+
+        def delete(batch):
+            try:
+                return self.delete_batch(batch)
+            finally:
+                for key in batch:
+                    self.invalidate_meta(key)
+
+        try:
+            batches = chunked(keys, batch_size)
+            for deleted, errors in bounded_map(delete, batches, workers=workers, ordered=False):
+                data['deleted'] += deleted
+                data['errors'].extend(errors)
+        except Exception as e:
+            resp['status'] = 'failure'
+            resp['errmsg'] = str(e)
+            resp['error'] = e.__class__.__name__
+            return resp
+        if data['errors']:
+            resp['status'] = 'failure'
+            resp['errmsg'] = '%d key(s) failed to delete' % len(data['errors'])
+        return resp
+
+    def delete_prefix(self, prefix, batch_size=1000, workers=4):
+        """
+        边列举边删除 prefix 下的所有对象
+        """
+        keys = (row['key'] for row in self.iter_objects(prefix=prefix, prefetch_pages=True))
+        try:
+            return self.delete_keys(keys, batch_size=batch_size, workers=workers)
+        finally:
+            self.invalidate_meta(prefix=prefix)
+
+    def head_object(self, key):
+        """
+        返回 data: {'size', 'etag', 'last_modified', 'content_type'}
+        """
+        raise NotImplementedError
+
+    def open_read(self, key, start=None, end=None):
+        """
+        返回 ObjectReader, start/end 为闭区间的字节范围, 与 HTTP Range 相同
+        """
+        raise NotImplementedError
+
+    def open_range(self, key, start, end, size):
+        """
+        get_object_parallel 读取一段, size 为对象大小, 需要先知道大小才能读取的后端可以重写以省去请求
+        """
+        return self.open_read(key, start, end)
+
+    def can_copy_from(self, storage):
+        """
+        能否在服务端把 storage 中的对象复制到本存储, 不经过本地
+        """
+        return False
+
+    def copy_object(self, src_key, dst_key, src_storage=None):
+        """
+        服务端复制, src_storage 默认为本存储, 需要 can_copy_from(src_storage) 为 True
+        """
+        raise NotImplementedError
+
+    def upload_fileobj(self, fileobj, target, size=None, callback=None):
+        """
+        从可读对象(如 open_read 返回的 ObjectReader)流式上传, 默认读入内存后 put_object,
+        支持分片的后端需要重写
+        """
+        return self.put_object(target, fileobj.read())
+
+    def get_object_parallel(self, key, target=None, part_size=8 * 1024 * 1024, workers=8):
+        """
+        按 part_size 并发分段读取对象, target 为空时读到预分配的 bytearray (data['body']),
+        否则直接按偏移写入 target 文件
+        """
+        resp = {'status': 'success', 'errmsg': ''}
+        fd = None
+        try:
+            head = self.head_object(key)
+            if head['status'] != 'success':
+                return head
+            size = head['data']['size']
+            if target is None:
+                body = bytearray(size)
+                view = memoryview(body)
+            else:
+                os.makedirs(os.path.dirname(target) or '.', 0o755, exist_ok=True)
+                fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                os.ftruncate(fd, size)
+
+            def fetch(start):
+                end = min(start + part_size, size) - 1
+                with self.open_range(key, start, end, size) as reader:
+                    if fd is None:
+                        got = reader.readinto(view[start:end + 1])
+                    else:
+                        got = 0
+                        for data in reader:
+                            os.pwrite(fd, data, start + got)
+                            got += len(data)
+                if got != end - start + 1:
+                    raise IOError('Range %d-%d incomplete: got %d bytes' % (start, end, got))
+                return got
+
+            for _ in bounded_map(fetch, range(0, size, part_size), workers=workers, ordered=False):
+                pass
+            resp['data'] = {'size': size, 'body': body if target is None else None}
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        finally:
+            if fd is not None:
+                os.close(fd)
+        return resp
+
+    def iter_batch(self, method, items, workers=10, ordered=True):
+        """
+        在线程池上对每个 item 调用 method, item 为 key 或参数序列(tuple, list),
+        返回生成器, 每个结果是带 key 的 {'status', 'errmsg'} 字典, 只有迭代时才会执行;
+        ordered 为 False 时按完成顺序返回
+        """
+        def call(item):
+            if isinstance(item, (str, bytes)) or not isinstance(item, collections.abc.Sequence):
+                args = (item,)
+            else:
+                args = tuple(item)
+            try:
+                resp = getattr(self, method)(*args)
+            except Exception as e:
+                resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+            resp['key'] = args[0]
+            return resp
+        return bounded_map(call, items, workers=workers, ordered=ordered)
+
+    def batch_call(self, method, items, workers=10, ordered=True):
+        """
+        与 iter_batch 相同, 但立即执行完所有调用并返回结果列表
+        """
+        return list(self.iter_batch(method, items, workers=workers, ordered=ordered))
+
+    def put_objects(self, items, workers=10, ordered=True):
+        """
+        items 为 (key, data) 的可迭代对象, 返回时已全部写完
+        """
+        return self.batch_call('put_object', items, workers=workers, ordered=ordered)
+
+    def get_objects(self, keys, workers=10, ordered=True):
+        return self.batch_call('get_object', keys, workers=workers, ordered=ordered)
+
+    def exists_objects(self, keys, workers=10, ordered=True):
+        return self.batch_call('exists_object', keys, workers=workers, ordered=ordered)
+
+    def sync(self, local_dir, prefix='', direction='upload', **kwargs):
+        """
+        增量同步本地目录和 prefix, 参数见 storagekit.sync.sync
+        """
+        from .sync import sync
+        return sync(self, local_dir, prefix=prefix, direction=direction, **kwargs)
+
+    def close(self):
+        """
+        释放客户端的连接池, 注册表 clear() 时调用
+        """
+        pass
+
     def is_valid(self, src, target):
-        ok, msg = self.upload(src=src, target=target)
-        if not ok:
+        resp = self.upload_file(src, target)
+        if resp['status'] != 'success':
             return False
-        self.delete(path=target)
+        self.delete_object(target)
         return True
 
 
 class LogStorage(metaclass=abc.ABCMeta):
+    stateful = False
+
     @abc.abstractmethod
     def save(self, command):
         pass
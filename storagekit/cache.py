@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+#
+import datetime
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from .base import ObjectStorage
+
+
+class CachedObjectStorage(ObjectStorage):
+    """
+    在本地磁盘上缓存最近读取的对象, 超过 max_bytes 时按 LRU 淘汰,
+    validate 为 True 时每次命中都用 head_object 的 etag 校验是否过期
+    """
+
+    def __init__(self, storage, cache_dir, max_bytes=1024 * 1024 * 1024, validate=True):
+        self.storage = storage
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.RLock()
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'evictions': 0}
+        os.makedirs(cache_dir, 0o755, exist_ok=True)
+        self.load()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def load(self):
+        """
+        从 .meta 文件恢复缓存索引, 按访问时间排成 LRU 顺序
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.tmp'):
+                # 上次中断时没有完成的写入
+                os.remove(os.path.join(self.cache_dir, name))
+                continue
+            if not name.endswith('.meta'):
+                continue
+            meta_path = os.path.join(self.cache_dir, name)
+            data_path = meta_path[:-len('.meta')]
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                entries.append((os.stat(data_path).st_atime, meta))
+            except (OSError, ValueError):
+                self._remove_files(data_path)
+        for _, meta in sorted(entries, key=lambda x: x[0]):
+            self.entries[meta['key']] = meta
+            self.size += meta['size']
+        self.evict()
+
+    def lookup(self, key):
+        with self.lock:
+            meta = self.entries.get(key)
+            if meta is None:
+                return None
+        if self.validate:
+            head = self.storage.head_object(key)
+            if head['status'] != 'success' or head['data']['etag'] != meta['etag']:
+                self.invalidate(key)
+                return None
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        return meta
+
+    def store(self, key, tmp, etag=None, content_type=None, last_modified=None):
+        """
+        把已经写完的临时文件 tmp 原子地改名为 key 的缓存文件;
+        超过 max_bytes 时不缓存, 返回 None, tmp 由调用方处理
+        """
+        size = os.path.getsize(tmp)
+        if size > self.max_bytes:
+            return None
+        path = self.path(key)
+        if hasattr(last_modified, 'timestamp'):
+            last_modified = last_modified.timestamp()
+        meta = {'key': key, 'size': size, 'etag': etag, 'content_type': content_type,
+                'last_modified': last_modified}
+        with self.lock:
+            self._discard(key)
+            os.replace(tmp, path)
+            with open(path + '.meta.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(path + '.meta.tmp', path + '.meta')
+            self.entries[key] = meta
+            self.size += size
+            self.evict()
+        return meta
+
+    def mkstemp(self):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        return tmp
+
+    def evict(self):
+        with self.lock:
+            while self.size > self.max_bytes and self.entries:
+                key = next(iter(self.entries))
+                self._discard(key)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def invalidate_prefix(self, prefix):
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                self._discard(key)
+
+    def _discard(self, key):
+        meta = self.entries.pop(key, None)
+        if meta is not None:
+            self.size -= meta['size']
+            self._remove_files(self.path(key))
+
+    @staticmethod
+    def _remove_files(path):
+        for name in (path, path + '.meta'):
+            if os.path.exists(name):
+                os.remove(name)
+
+    def _hit(self, meta):
+        with self.lock:
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += meta['size']
+
+    def _miss(self):
+        with self.lock:
+            self.stats['misses'] += 1
+
+    def _head(self, key):
+        if not self.validate:
+            return {}
+        head = self.storage.head_object(key)
+        return head['data'] if head['status'] == 'success' else {}
+
+    @staticmethod
+    def make_data(meta, body):
+        """
+        命中和未命中时 data 中都有的字段
+        """
+        last_modified = meta.get('last_modified')
+        if last_modified is not None:
+            last_modified = datetime.datetime.fromtimestamp(last_modified, datetime.timezone.utc)
+        return {
+            'body': body, 'etag': meta.get('etag'), 'size': meta['size'],
+            'content_type': meta.get('content_type'), 'last_modified': last_modified,
+        }
+
+    def get_object(self, key, **kwargs):
+        """
+        命中时 body 是缓存文件 mmap 的 memoryview, 不经过内存拷贝
+        """
+        if kwargs:
+            return self.storage.get_object(key, **kwargs)
+        meta = self.lookup(key)
+        if meta is not None:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    body = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) \
+                        if meta['size'] else b''
+                self._hit(meta)
+                return {'status': 'success', 'errmsg': '', 'data': self.make_data(meta, body)}
+            except OSError:
+                self.invalidate(key)
+
+        self._miss()
+        resp = self.storage.get_object(key)
+        if resp['status'] == 'success':
+            data = resp['data']
+            data.setdefault('etag', data.get('ETag'))
+            data.setdefault('size', len(data['body']))
+            data.setdefault('content_type', data.get('ContentType'))
+            data.setdefault('last_modified', data.get('LastModified'))
+            tmp = self.mkstemp()
+            with open(tmp, 'wb') as f:
+                f.write(data['body'])
+            meta = self.store(key, tmp, etag=data['etag'], content_type=data['content_type'],
+                              last_modified=data['last_modified'])
+            if meta is None:
+                os.remove(tmp)
+        return resp
+
+    def download_file(self, src, target, **kwargs):
+        resp = {'status': 'success', 'errmsg': ''}
+        meta = self.lookup(src)
+        if meta is None:
+            self._miss()
+            head = self._head(src)
+            tmp = self.mkstemp()
+            resp = self.storage.download_file(src, tmp, **kwargs)
+            if resp['status'] != 'success':
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                return resp
+            meta = self.store(src, tmp, etag=head.get('etag'), content_type=head.get('content_type'),
+                              last_modified=head.get('last_modified'))
+            if meta is None:
+                # 超过缓存容量, 直接把已经下载的文件移到 target
+                os.makedirs(os.path.dirname(target) or '.', 0o755, exist_ok=True)
+                shutil.move(tmp, target)
+                return resp
+        else:
+            self._hit(meta)
+
+        try:
+            os.makedirs(os.path.dirname(target) or '.', 0o755, exist_ok=True)
+            with open(target, 'wb') as f:
+                self._copy_file(self.path(src), f)
+        except OSError:
+            # 缓存文件在复制前被淘汰
+            return self.storage.download_file(src, target, **kwargs)
+        return resp
+
+    def send_object(self, key, out):
+        """
+        把对象写到 socket 或文件描述符 out, 命中时使用 os.sendfile 零拷贝
+        """
+        meta = self.lookup(key)
+        if meta is None:
+            resp = self.get_object(key)
+            if resp['status'] != 'success':
+                return resp
+            with self.lock:
+                meta = self.entries.get(key)
+            if meta is None:
+                return self._write_body(resp['data']['body'], out)
+        else:
+            self._hit(meta)
+        try:
+            f = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            # 打开前缓存文件被其他线程淘汰, 按未命中处理, 直接从后端读取
+            resp = self.storage.get_object(key)
+            if resp['status'] != 'success':
+                return resp
+            return self._write_body(resp['data']['body'], out)
+        with f:
+            self._sendfile(f, out, meta['size'])
+        return {'status': 'success', 'errmsg': ''}
+
+    @staticmethod
+    def _write_body(body, out):
+        view = memoryview(body)
+        out_fd = out if isinstance(out, int) else out.fileno()
+        while view:
+            view = view[os.write(out_fd, view):]
+        return {'status': 'success', 'errmsg': ''}
+
+    @staticmethod
+    def _sendfile(src, out, size, fallback=False):
+        """
+        返回已发送的字节数; fallback 为 True 时 sendfile 失败不抛出异常, 由调用方从返回的位置继续
+        """
+        out_fd = out if isinstance(out, int) else out.fileno()
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(out_fd, src.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            if not fallback:
+                raise
+        return offset
+
+    def _copy_file(self, src_path, dst):
+        with open(src_path, 'rb') as src:
+            dst.flush()
+            size = os.fstat(src.fileno()).st_size
+            offset = self._sendfile(src, dst, size, fallback=True)
+            if offset < size:
+                # 不支持 sendfile 的文件系统, 从已经写入的位置继续普通复制
+                src.seek(offset)
+                dst.seek(offset)
+                shutil.copyfileobj(src, dst)
+
+    def put_object(self, key, data):
+        self.invalidate(key)
+        return self.storage.put_object(key, data)
+
+    def upload_file(self, src, target, **kwargs):
+        self.invalidate(target)
+        return self.storage.upload_file(src, target, **kwargs)
+
+    def copy_object(self, src_key, dst_key, src_storage=None):
+        self.invalidate(dst_key)
+        if isinstance(src_storage, CachedObjectStorage):
+            src_storage = src_storage.storage
+        return self.storage.copy_object(src_key, dst_key, src_storage=src_storage)
+
+    def upload_fileobj(self, fileobj, target, size=None, callback=None):
+        self.invalidate(target)
+        return self.storage.upload_fileobj(fileobj, target, size=size, callback=callback)
+
+    def can_copy_from(self, storage):
+        if isinstance(storage, CachedObjectStorage):
+            storage = storage.storage
+        return self.storage.can_copy_from(storage)
+
+    def delete_object(self, key):
+        self.invalidate(key)
+        return self.storage.delete_object(key)
+
+    def delete_objects(self, key_list):
+        key_list = list(key_list)
+        for key in key_list:
+            self.invalidate(key)
+        return self.storage.delete_objects(key_list)
+
+    def delete_folder(self, key):
+        self.invalidate_prefix(key if key.endswith('/') else key + '/')
+        return self.storage.delete_folder(key)
+
+    def list_objects(self, **kwargs):
+        return self.storage.list_objects(**kwargs)
+
+    def iter_pages(self, prefix='', delimiter='', page_size=1000):
+        return self.storage.iter_pages(prefix=prefix, delimiter=delimiter, page_size=page_size)
+
+    def exists_object(self, key):
+        return self.storage.exists_object(key)
+
+    def head_object(self, key):
+        return self.storage.head_object(key)
+
+    def open_read(self, key, start=None, end=None):
+        return self.storage.open_read(key, start, end)
+
+    def create_folder(self, key):
+        return self.storage.create_folder(key)
+
+    def list_buckets(self, **kwargs):
+        return self.storage.list_buckets(**kwargs)
+
+    def create_bucket(self, bucket=None, **kwargs):
+        return self.storage.create_bucket(bucket, **kwargs)
+
+    def delete_bucket(self, bucket=None):
+        return self.storage.delete_bucket(bucket)
+
+    def get_bucket(self, bucket=None):
+        return self.storage.get_bucket(bucket)
+
+    def __getattr__(self, item):
+        return getattr(self.storage, item)
+
+    @property
+    def type(self):
+        return self.storage.type
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from storagekit.cache import CachedObjectStorage
+from storagekit.memory import MemoryStorage
+
+
+class TestCachedObjectStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.backend = MemoryStorage({})
+        self.cache = CachedObjectStorage(self.backend, os.path.join(self.tmp, 'cache'), max_bytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_hit_and_miss_fields(self):
+        self.backend.put_object('k', b'hello')
+        miss = self.cache.get_object('k')['data']
+        hit = self.cache.get_object('k')['data']
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(bytes(hit['body']), b'hello')
+        for field in ('etag', 'size', 'content_type', 'last_modified'):
+            self.assertEqual(hit[field], miss[field], field)
+
+    def test_validate(self):
+        self.backend.put_object('k', b'old')
+        self.cache.get_object('k')
+        self.backend.put_object('k', b'new')
+        self.assertEqual(bytes(self.cache.get_object('k')['data']['body']), b'new')
+        self.cache.put_object('k', b'newer')
+        self.assertEqual(bytes(self.cache.get_object('k')['data']['body']), b'newer')
+
+    def test_evict_and_reload(self):
+        for key in ('a', 'b', 'c'):
+            self.backend.put_object(key, b'x' * 40)
+            self.cache.get_object(key)
+        self.assertEqual(list(self.cache.entries), ['b', 'c'])
+        self.assertEqual(self.cache.stats['evictions'], 1)
+        reloaded = CachedObjectStorage(self.backend, self.cache.cache_dir, max_bytes=100)
+        self.assertEqual(sorted(reloaded.entries), ['b', 'c'])
+
+    def test_download_over_budget(self):
+        self.backend.put_object('big', b'x' * 200)
+        target = os.path.join(self.tmp, 'out', 'big')
+        with mock.patch.object(self.backend, 'download_file', wraps=self.backend.download_file) as download:
+            self.assertEqual(self.cache.download_file('big', target)['status'], 'success')
+        self.assertEqual(download.call_count, 1)
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 200)
+        self.assertEqual(os.listdir(self.cache.cache_dir), [])
+
+    def test_partial_sendfile(self):
+        self.backend.put_object('k', bytes(range(50)))
+        self.cache.get_object('k')
+        calls = []
+
+        def sendfile(out_fd, in_fd, offset, count):
+            # 第一次只发送 10 字节, 之后报告不支持
+            if calls:
+                raise OSError('sendfile not supported')
+            calls.append(offset)
+            os.write(out_fd, os.pread(in_fd, 10, offset))
+            return 10
+
+        target = os.path.join(self.tmp, 'k')
+        with mock.patch('os.sendfile', sendfile):
+            self.assertEqual(self.cache.download_file('k', target)['status'], 'success')
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), bytes(range(50)))
+
+    def send(self, key):
+        target = os.path.join(self.tmp, 'sent')
+        with open(target, 'wb') as out:
+            resp = self.cache.send_object(key, out)
+        with open(target, 'rb') as f:
+            return resp, f.read()
+
+    def test_send_object(self):
+        self.backend.put_object('k', b'hello')
+        self.assertEqual(self.send('k'), ({'status': 'success', 'errmsg': ''}, b'hello'))
+        self.assertEqual(self.send('k')[1], b'hello')
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(self.send('missing')[0]['status'], 'failure')
+
+    def test_send_evicted_file(self):
+        self.backend.put_object('k', b'hello')
+        self.cache.get_object('k')
+        lookup = self.cache.lookup
+
+        def evict_after_lookup(key):
+            # 查到缓存项后, 打开文件前被其他线程淘汰
+            meta = lookup(key)
+            self.cache.invalidate(key)
+            return meta
+
+        with mock.patch.object(self.cache, 'lookup', evict_after_lookup), \
+                mock.patch.object(self.backend, 'get_object', wraps=self.backend.get_object) as get_object:
+            self.assertEqual(self.send('k')[1], b'hello')
+        self.assertEqual(get_object.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
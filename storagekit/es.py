@@ -1,22 +1,53 @@
 # -*- coding: utf-8 -*-
 #
+import atexit
+import logging
+import queue
+import threading
+import time
 from datetime import datetime, timedelta
 
 import pytz
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch import Elasticsearch, TransportError
+from elasticsearch.helpers import BulkIndexError
 
 from .base import LogStorage
+from .utils import bounded_map
+
+logger = logging.getLogger(__name__)
 
 
 class ESStorage(LogStorage):
 
     def __init__(self, config):
         hosts = config.get("HOSTS")
-        kwargs = config.get("OTHER", {})
+        kwargs = dict(config.get("OTHER", {}))
+        if config.get("POOL_SIZE"):
+            kwargs.setdefault("maxsize", config["POOL_SIZE"])
         self.index = config.get("INDEX") or 'jumpserver'
         self.doc_type = config.get("DOC_TYPE") or 'command_store'
-        self.es = Elasticsearch(hosts=hosts, **kwargs)
+        # 按天(day)或按月(month)分索引, 如 jumpserver-2020.01.01
+        self.partition = config.get("INDEX_PARTITION")
+        if self.partition not in (None, 'day', 'month'):
+            raise ValueError("INDEX_PARTITION must be 'day' or 'month'")
+        self.alias = config.get("INDEX_ALIAS")
+        self.retention_days = config.get("INDEX_RETENTION_DAYS")
+        self.max_search_indices = config.get("MAX_SEARCH_INDICES", 100)
+        self._created_indices = set()
+        # AsyncLogStorage 用相同的参数创建 AsyncElasticsearch
+        self.client_kwargs = dict(kwargs, hosts=hosts)
+        self.es = Elasticsearch(**self.client_kwargs)
+        self.writer = None
+        if config.get("BULK_WRITE"):
+            self.writer = ESBulkWriter(
+                self,
+                max_docs=config.get("BULK_MAX_DOCS", 500),
+                max_bytes=config.get("BULK_MAX_BYTES", 5 * 1024 * 1024),
+                max_delay=config.get("BULK_MAX_DELAY", 1.0),
+                queue_size=config.get("BULK_QUEUE_SIZE", 10000),
+                put_timeout=config.get("BULK_PUT_TIMEOUT"),
+                on_error=config.get("BULK_ON_ERROR"),
+            )
 
     @staticmethod
     def make_data(command):
@@ -29,30 +60,227 @@ class ESStorage(LogStorage):
         data["date"] = datetime.fromtimestamp(command['timestamp'], tz=pytz.UTC)
         return data
 
-    def bulk_save(self, command_set, raise_on_error=True):
-        actions = []
+    @property
+    def partition_format(self):
+        return '%Y.%m.%d' if self.partition == 'day' else '%Y.%m'
+
+    def get_index(self, timestamp=None):
+        """
+        写入时根据命令的 timestamp 得到所在的索引
+        """
+        if not self.partition:
+            return self.index
+        if timestamp is None:
+            timestamp = time.time()
+        date = datetime.fromtimestamp(timestamp, tz=pytz.UTC)
+        index = '%s-%s' % (self.index, date.strftime(self.partition_format))
+        if index not in self._created_indices:
+            self.create_index(index)
+        return index
+
+    def create_index(self, index):
+        self.es.indices.create(index=index, ignore=400)
+        if self.alias:
+            self.es.indices.put_alias(index=index, name=self.alias)
+        self._created_indices.add(index)
+
+    def iter_partitions(self, date_from, date_to):
+        """
+        返回与 [date_from, date_to] 有交集的分区起始时间 (UTC)
+        """
+        start = datetime.fromtimestamp(date_from.timestamp(), tz=pytz.UTC)
+        end = datetime.fromtimestamp(date_to.timestamp(), tz=pytz.UTC)
+        current = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.partition == 'month':
+            current = current.replace(day=1)
+        while current <= end:
+            yield current
+            current = self.next_partition(current)
+
+    def next_partition(self, date):
+        if self.partition == 'day':
+            return date + timedelta(days=1)
+        if date.month == 12:
+            return date.replace(year=date.year + 1, month=1)
+        return date.replace(month=date.month + 1)
+
+    def get_search_kwargs(self, date_from=None, date_to=None):
+        """
+        查询时只搜索与时间范围有交集的索引
+        """
+        if not self.partition:
+            return dict(index=self.index, doc_type=self.doc_type)
+        date_from, date_to = self.get_date_range(date_from, date_to)
+        indices = []
+        for date in self.iter_partitions(date_from, date_to):
+            indices.append('%s-%s' % (self.index, date.strftime(self.partition_format)))
+            if len(indices) > self.max_search_indices:
+                indices = [self.alias or '%s-*' % self.index]
+                break
+        return dict(index=','.join(indices), doc_type=self.doc_type, ignore_unavailable=True)
+
+    def drop_expired_indices(self, retention_days=None):
+        """
+        删除已经完全超出保留天数的分区索引, 返回删除的索引名
+        """
+        retention_days = retention_days or self.retention_days
+        if not self.partition or not retention_days:
+            return []
+        expire = datetime.now(tz=pytz.UTC) - timedelta(days=retention_days)
+        prefix = '%s-' % self.index
+        dropped = []
+        for index in sorted(self.es.indices.get(index=prefix + '*')):
+            try:
+                date = datetime.strptime(index[len(prefix):], self.partition_format)
+            except ValueError:
+                continue
+            if self.next_partition(date.replace(tzinfo=pytz.UTC)) <= expire:
+                self.es.indices.delete(index=index)
+                self._created_indices.discard(index)
+                dropped.append(index)
+        return dropped
+
+    def make_action(self, command):
+        return dict(
+            _index=self.get_index(command["timestamp"]),
+            _type=self.doc_type,
+            _source=self.make_data(command),
+        )
+
+    def iter_bulk_chunks(self, command_set, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024):
+        """
+        按文档数和字节数切分, 每次只序列化一个 chunk
+        """
+        serializer = self.es.transport.serializer
+        commands, lines, size = [], [], 0
         for command in command_set:
-            data = dict(
-                _index=self.index,
-                _type=self.doc_type,
-                _source=self.make_data(command),
+            action = self.make_action(command)
+            source = serializer.dumps(action.pop("_source"))
+            meta = serializer.dumps({"index": action})
+            cur_size = len(meta) + len(source) + 2
+            if commands and (len(commands) >= chunk_size or size + cur_size > max_chunk_bytes):
+                yield commands, lines
+                commands, lines, size = [], [], 0
+            commands.append(command)
+            lines.append(meta)
+            lines.append(source)
+            size += cur_size
+        if commands:
+            yield commands, lines
+
+    def send_bulk_chunk(self, commands, lines, raise_on_error=True,
+                        max_retries=0, initial_backoff=2, max_backoff=600):
+        """
+        发送一个 chunk, 429 的文档按指数退避重试, 返回 (success, errors, retried)
+        """
+        success, retried = 0, 0
+        errors = []
+        for attempt in range(max_retries + 1):
+            if attempt:
+                time.sleep(min(max_backoff, initial_backoff * 2 ** (attempt - 1)))
+            try:
+                resp = self.es.bulk("\n".join(lines) + "\n")
+            except TransportError as e:
+                if e.status_code == 429 and attempt < max_retries:
+                    retried += len(commands)
+                    continue
+                if raise_on_error:
+                    raise
+                for command in commands:
+                    errors.append({"index": {"error": str(e), "status": e.status_code, "data": command}})
+                break
+
+            to_retry, to_retry_lines = [], []
+            for i, (command, item) in enumerate(zip(commands, resp["items"])):
+                op_type, info = item.popitem()
+                status = info.get("status", 500)
+                if 200 <= status < 300:
+                    success += 1
+                elif status == 429 and attempt < max_retries:
+                    to_retry.append(command)
+                    to_retry_lines.extend(lines[i * 2:i * 2 + 2])
+                else:
+                    info["data"] = command
+                    errors.append({op_type: info})
+            if not to_retry:
+                break
+            retried += len(to_retry)
+            commands, lines = to_retry, to_retry_lines
+        return success, errors, retried
+
+    def bulk_save(self, command_set, raise_on_error=True, chunk_size=500,
+                  max_chunk_bytes=10 * 1024 * 1024, thread_count=1, max_retries=0):
+        """
+        command_set 可以是任意可迭代对象或生成器, 按 chunk 流式写入,
+        thread_count > 1 时并发发送 chunk, 返回汇总的写入报告
+        """
+        report = {
+            "success": 0, "failed": 0, "retried": 0, "chunks": 0,
+            "took": 0, "docs_per_sec": 0, "errors": [],
+        }
+        start = time.monotonic()
+
+        def send(chunk):
+            return self.send_bulk_chunk(
+                chunk[0], chunk[1], raise_on_error=raise_on_error, max_retries=max_retries
             )
-            actions.append(data)
-        return bulk(self.es, actions, index=self.index, raise_on_error=raise_on_error)
+
+        chunks = self.iter_bulk_chunks(command_set, chunk_size, max_chunk_bytes)
+        results = bounded_map(send, chunks, workers=thread_count, ordered=False)
+        try:
+            for success, errors, retried in results:
+                report["chunks"] += 1
+                report["success"] += success
+                report["failed"] += len(errors)
+                report["retried"] += retried
+                report["errors"].extend(errors)
+                if errors and raise_on_error:
+                    raise BulkIndexError(
+                        "%i document(s) failed to index." % len(errors), errors
+                    )
+        finally:
+            results.close()
+
+        report["took"] = time.monotonic() - start
+        if report["took"]:
+            report["docs_per_sec"] = report["success"] / report["took"]
+        return report
 
     def save(self, command):
         """
-        保存命令到数据库
+        保存命令到数据库, 开启 BULK_WRITE 后只放入队列, 由后台线程批量写入
         """
+        if self.writer:
+            return self.writer.put(command)
         data = self.make_data(command)
-        return self.es.index(index=self.index, doc_type=self.doc_type, body=data)
+        index = self.get_index(command["timestamp"])
+        return self.es.index(index=index, doc_type=self.doc_type, body=data)
+
+    def flush(self, timeout=None):
+        if self.writer:
+            return self.writer.flush(timeout=timeout)
+        return True
+
+    def close(self, timeout=None):
+        if self.writer:
+            self.writer.close(timeout=timeout)
+
+    @property
+    def stateful(self):
+        # 后台写入的实例可能被其他调用方持有并继续 save, 不随空闲淘汰关闭
+        return self.writer is not None
 
     @staticmethod
-    def get_query_body(match=None, exact=None, date_from=None, date_to=None):
+    def get_date_range(date_from=None, date_to=None):
         if date_to is None:
             date_to = datetime.now()
         if date_from is None:
             date_from = date_to - timedelta(days=7)
+        return date_from, date_to
+
+    @classmethod
+    def get_query_body(cls, match=None, exact=None, date_from=None, date_to=None):
+        date_from, date_to = cls.get_date_range(date_from, date_to)
 
         time_from = date_from.timestamp()
         time_to = date_to.timestamp()
@@ -90,10 +318,9 @@ class ESStorage(LogStorage):
                 body["query"]["bool"]["filter"].append({"term": {k: v}})
         return body
 
-    def filter(self, date_from=None, date_to=None,
-               user=None, asset=None, system_user=None,
-               input=None, session=None, risk_level=None, org_id=None):
-
+    @staticmethod
+    def make_filter(user=None, asset=None, system_user=None,
+                    input=None, session=None, risk_level=None, org_id=None):
         match = {}
         exact = {}
 
@@ -112,38 +339,111 @@ class ESStorage(LogStorage):
             match["org_id"] = org_id
         if risk_level is not None:
             match['risk_level'] = risk_level
+        return match, exact
 
+    def filter(self, date_from=None, date_to=None,
+               user=None, asset=None, system_user=None,
+               input=None, session=None, risk_level=None, org_id=None):
+        match, exact = self.make_filter(
+            user=user, asset=asset, system_user=system_user, input=input,
+            session=session, risk_level=risk_level, org_id=org_id
+        )
         body = self.get_query_body(match, exact, date_from, date_to)
+        kwargs = self.get_search_kwargs(date_from, date_to)
 
         # Get total count (Because default size=10)
-        data = self.es.search(index=self.index, doc_type=self.doc_type, body=body, size=0)
+        data = self.es.search(body=body, size=0, **kwargs)
         total = data["hits"]["total"]
 
-        data = self.es.search(index=self.index, doc_type=self.doc_type, body=body, size=total)
+        data = self.es.search(body=body, size=total, **kwargs)
         return data["hits"]
 
+    def iter_filter(self, date_from=None, date_to=None,
+                    user=None, asset=None, system_user=None,
+                    input=None, session=None, risk_level=None, org_id=None,
+                    page_size=1000, fields=None, ordered=True, scroll='2m'):
+        """
+        逐条返回命令, 使用 scroll 分页, 不受 max_result_window 限制, 内存占用只与 page_size 有关;
+        ordered 为 False 时按 _doc 顺序返回, 不需要排序, 适合导出全部结果
+        """
+        match, exact = self.make_filter(
+            user=user, asset=asset, system_user=system_user, input=input,
+            session=session, risk_level=risk_level, org_id=org_id
+        )
+        body = self.get_query_body(match, exact, date_from, date_to)
+        # scroll 不需要唯一的排序字段, 避免按 _id 排序时加载 _id 的 fielddata
+        body["sort"] = [{"timestamp": {"order": "desc"}}] if ordered else ["_doc"]
+        body["size"] = page_size
+        if fields is not None:
+            body["_source"] = list(fields)
+
+        data = self.es.search(body=body, scroll=scroll, **self.get_search_kwargs(date_from, date_to))
+        scroll_id = data.get("_scroll_id")
+        try:
+            while True:
+                hits = data["hits"]["hits"]
+                for hit in hits:
+                    yield hit
+                if len(hits) < page_size or not scroll_id:
+                    break
+                data = self.es.scroll(scroll_id=scroll_id, scroll=scroll)
+                scroll_id = data.get("_scroll_id", scroll_id)
+        finally:
+            # 提前结束迭代时也释放服务端的 scroll 上下文
+            if scroll_id:
+                try:
+                    self.es.clear_scroll(scroll_id=scroll_id)
+                except Exception:
+                    logger.warning("Clear scroll failed", exc_info=True)
+
     def count(self, date_from=None, date_to=None,
               user=None, asset=None, system_user=None,
               input=None, session=None):
-        match = {}
-        exact = {}
-
-        if user:
-            exact["user"] = user
-        if asset:
-            exact["asset"] = asset
-        if system_user:
-            exact["system_user"] = system_user
-
-        if session:
-            match["session"] = session
-        if input:
-            match["input"] = input
+        match, exact = self.make_filter(
+            user=user, asset=asset, system_user=system_user,
+            input=input, session=session
+        )
         body = self.get_query_body(match, exact, date_from, date_to)
         del body["sort"]
-        data = self.es.count(body=body)
+        data = self.es.count(body=body, **self.get_search_kwargs(date_from, date_to))
         return data["count"]
 
+    def aggregate(self, date_from=None, date_to=None,
+                  user=None, asset=None, system_user=None,
+                  input=None, session=None, risk_level=None, org_id=None,
+                  fields=('user', 'asset', 'system_user', 'risk_level'),
+                  size=10, interval='day'):
+        """
+        由 ES 计算各字段的 terms 统计和按时间的直方图, 一次请求, 不返回文档
+        """
+        match, exact = self.make_filter(
+            user=user, asset=asset, system_user=system_user, input=input,
+            session=session, risk_level=risk_level, org_id=org_id
+        )
+        body = self.get_query_body(match, exact, date_from, date_to)
+        del body["sort"]
+        aggs = {}
+        for field in fields:
+            aggs[field] = {"terms": {"field": field, "size": size}}
+        if interval:
+            # date 字段与 timestamp 的值相同, 类型是 date, 可以直接做 date_histogram
+            aggs["histogram"] = {
+                "date_histogram": {"field": "date", "interval": interval, "min_doc_count": 0}
+            }
+        body["aggs"] = aggs
+        body["size"] = 0
+
+        data = self.es.search(body=body, **self.get_search_kwargs(date_from, date_to))
+        aggregations = data.get("aggregations", {})
+        result = {"total": data["hits"]["total"]}
+        for field in fields:
+            buckets = aggregations.get(field, {}).get("buckets", [])
+            result[field] = [{"key": b["key"], "count": b["doc_count"]} for b in buckets]
+        if interval:
+            buckets = aggregations.get("histogram", {}).get("buckets", [])
+            result["histogram"] = [{"timestamp": b["key"] / 1000, "count": b["doc_count"]} for b in buckets]
+        return result
+
     def __getattr__(self, item):
         return getattr(self.es, item)
 
@@ -156,3 +456,123 @@ class ESStorage(LogStorage):
             return self.es.ping()
         except Exception:
             return False
+
+
+class ESBulkWriter(object):
+    """
+    后台批量写入, 按文档数、字节数或最大延迟触发 flush
+    """
+    _stop = object()
+
+    def __init__(self, storage, max_docs=500, max_bytes=5 * 1024 * 1024,
+                 max_delay=1.0, queue_size=10000, put_timeout=None, on_error=None):
+        self.storage = storage
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.put_timeout = put_timeout
+        self.on_error = on_error
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.closed = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='es-bulk-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, command):
+        """
+        队列满时阻塞, 设置了 put_timeout 则超时抛出 queue.Full
+        """
+        if self.closed:
+            raise RuntimeError("Bulk writer is closed")
+        self.queue.put(command, timeout=self.put_timeout)
+
+    def flush(self, timeout=None):
+        """
+        等待 flush 之前放入的命令全部写入, 超时返回 False
+        """
+        if self.closed:
+            return not self.thread.is_alive()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        event = threading.Event()
+        try:
+            self.queue.put(event, timeout=timeout)
+        except queue.Full:
+            return False
+        return event.wait(None if deadline is None else max(0, deadline - time.monotonic()))
+
+    def close(self, timeout=None):
+        """
+        写完队列中剩余的命令后停止, 队列满时不阻塞, 最多等待 timeout 秒
+        """
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.stopping.set()
+        try:
+            # 队列满时后台线程不会阻塞在 get 上, 取空队列后根据 stopping 退出
+            self.queue.put_nowait(self._stop)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+
+    @staticmethod
+    def estimate_size(command):
+        return len(command.get("input") or "") + len(command.get("output") or "") + 256
+
+    def _run(self):
+        batch = []
+        size = 0
+        deadline = None
+        while True:
+            timeout = max(0, deadline - time.monotonic()) if batch else None
+            if self.stopping.is_set():
+                timeout = 0
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is None or item is self._stop or isinstance(item, threading.Event):
+                self._send(batch)
+                batch, size = [], 0
+                if isinstance(item, threading.Event):
+                    item.set()
+                elif item is self._stop or self.stopping.is_set():
+                    break
+                continue
+
+            if not batch:
+                deadline = time.monotonic() + self.max_delay
+            batch.append(item)
+            size += self.estimate_size(item)
+            if len(batch) >= self.max_docs or size >= self.max_bytes \
+                    or time.monotonic() >= deadline:
+                self._send(batch)
+                batch, size = [], 0
+
+    def _send(self, batch):
+        if not batch:
+            return
+        try:
+            chunks = self.storage.iter_bulk_chunks(
+                batch, chunk_size=len(batch), max_chunk_bytes=max(self.max_bytes * 2, 10 * 1024 * 1024)
+            )
+            for commands, lines in chunks:
+                _, errors, _ = self.storage.send_bulk_chunk(commands, lines, raise_on_error=False)
+                for error in errors:
+                    op_type, info = next(iter(error.items()))
+                    self._error(info.pop("data"), error)
+        except Exception as e:
+            for command in batch:
+                self._error(command, {"index": {"error": str(e), "exception": e}})
+
+    def _error(self, command, info):
+        if not self.on_error:
+            logger.error("Save command to es failed: %s", info)
+            return
+        try:
+            self.on_error(command, info)
+        except Exception:
+            logger.exception("Bulk writer error callback failed")
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import storagekit
+from elasticsearch import TransportError
+from elasticsearch.helpers import BulkIndexError
+from fakes import FakeESServer
+
+
+def make_command(i, **kwargs):
+    command = {
+        'user': 'admin', 'asset': 'web-01', 'system_user': 'root', 'input': 'ls %d' % i,
+        'output': 'ok', 'risk_level': 0, 'session': 's', 'timestamp': time.time() - i,
+    }
+    command.update(kwargs)
+    return command
+
+
+class ESTestCase(unittest.TestCase):
+    config = {}
+
+    def setUp(self):
+        self.server = FakeESServer().start()
+        self.storage = storagekit.get_log_storage(
+            dict({'TYPE': 'es', 'HOSTS': [self.server.endpoint]}, **self.config), shared=False
+        )
+
+    def tearDown(self):
+        self.storage.close()
+        self.server.stop()
+
+    @property
+    def indices(self):
+        return self.server.server.RequestHandlerClass.indices
+
+    @property
+    def scrolls(self):
+        return self.server.server.RequestHandlerClass.scrolls
+
+
+class TestIterFilter(ESTestCase):
+
+    def test_scroll(self):
+        self.storage.bulk_save([make_command(i) for i in range(25)])
+        hits = list(self.storage.iter_filter(page_size=10))
+        self.assertEqual([hit['_source']['input'] for hit in hits], ['ls %d' % i for i in range(25)])
+        self.assertEqual(self.scrolls, {})
+
+    def test_unordered_early_exit(self):
+        self.storage.bulk_save([make_command(i) for i in range(25)])
+        hits = self.storage.iter_filter(page_size=10, ordered=False)
+        self.assertEqual(len([next(hits) for _ in range(5)]), 5)
+        hits.close()
+        self.assertEqual(self.scrolls, {})
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class TestPartitions(unittest.TestCase):
+
+    def make_storage(self, **config):
+        storage = storagekit.get_log_storage(
+            dict({'TYPE': 'es', 'HOSTS': ['http://127.0.0.1:9'], 'INDEX': 'cmd'}, **config), shared=False
+        )
+        storage.es = mock.Mock()
+        return storage
+
+    def test_get_index(self):
+        day = self.make_storage(INDEX_PARTITION='day', INDEX_ALIAS='commands')
+        month = self.make_storage(INDEX_PARTITION='month')
+        for date, day_index, month_index in (
+            (utc(2019, 12, 31, 23, 59, 59), 'cmd-2019.12.31', 'cmd-2019.12'),
+            (utc(2020, 1, 1), 'cmd-2020.01.01', 'cmd-2020.01'),
+            (utc(2020, 2, 29, 12), 'cmd-2020.02.29', 'cmd-2020.02'),
+            (utc(2020, 3, 1), 'cmd-2020.03.01', 'cmd-2020.03'),
+        ):
+            self.assertEqual(day.get_index(date.timestamp()), day_index)
+            self.assertEqual(month.get_index(date.timestamp()), month_index)
+        # 每个索引只创建一次, 并加入别名
+        day.get_index(utc(2020, 1, 1, 8).timestamp())
+        self.assertEqual(day.es.indices.create.call_count, 4)
+        day.es.indices.put_alias.assert_any_call(index='cmd-2020.01.01', name='commands')
+        self.assertFalse(month.es.indices.put_alias.called)
+        self.assertEqual(self.make_storage().get_index(time.time()), 'cmd')
+
+    def test_search_kwargs(self):
+        day = self.make_storage(INDEX_PARTITION='day', MAX_SEARCH_INDICES=5)
+        kwargs = day.get_search_kwargs(utc(2020, 2, 27, 12), utc(2020, 3, 1, 1))
+        self.assertEqual(kwargs['index'], 'cmd-2020.02.27,cmd-2020.02.28,cmd-2020.02.29,cmd-2020.03.01')
+        self.assertTrue(kwargs['ignore_unavailable'])
+        kwargs = day.get_search_kwargs(utc(2020, 1, 1), utc(2020, 1, 31))
+        self.assertEqual(kwargs['index'], 'cmd-*')
+
+        month = self.make_storage(INDEX_PARTITION='month', INDEX_ALIAS='commands', MAX_SEARCH_INDICES=2)
+        kwargs = month.get_search_kwargs(utc(2019, 12, 15), utc(2020, 1, 31, 23))
+        self.assertEqual(kwargs['index'], 'cmd-2019.12,cmd-2020.01')
+        self.assertEqual(month.get_search_kwargs(utc(2019, 11, 30), utc(2020, 1, 1))['index'], 'commands')
+        self.assertEqual(self.make_storage().get_search_kwargs(), {'index': 'cmd', 'doc_type': 'command_store'})
+
+    def test_drop_expired_indices(self):
+        storage = self.make_storage(INDEX_PARTITION='day', INDEX_RETENTION_DAYS=30)
+        today = datetime.now(timezone.utc)
+        names = ['cmd-%s' % (today - timedelta(days=days)).strftime('%Y.%m.%d') for days in (40, 31, 30, 0)]
+        storage.es.indices.get.return_value = dict.fromkeys(names + ['cmd-other'], {})
+        # 整个分区都早于保留期限才删除
+        self.assertEqual(storage.drop_expired_indices(), names[:2])
+        storage.es.indices.get.assert_called_once_with(index='cmd-*')
+        self.assertEqual([c[1]['index'] for c in storage.es.indices.delete.call_args_list], names[:2])
+
+        month = self.make_storage(INDEX_PARTITION='month')
+        month.es.indices.get.return_value = {'cmd-2000.01': {}, 'cmd-%s' % today.strftime('%Y.%m'): {}}
+        self.assertEqual(month.drop_expired_indices(retention_days=365), ['cmd-2000.01'])
+        self.assertEqual(self.make_storage().drop_expired_indices(retention_days=1), [])
+
+
+class TestAggregate(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = storagekit.get_log_storage({'TYPE': 'es', 'HOSTS': ['http://127.0.0.1:9']}, shared=False)
+        self.storage.es = mock.Mock()
+        self.storage.es.search.return_value = {
+            'hits': {'total': 12, 'hits': []},
+            'aggregations': {
+                'user': {'buckets': [{'key': 'admin', 'doc_count': 9}, {'key': 'guest', 'doc_count': 3}]},
+                'risk_level': {'buckets': [{'key': 0, 'doc_count': 12}]},
+                'histogram': {'buckets': [
+                    {'key': 1577836800000, 'key_as_string': '2020-01-01', 'doc_count': 5},
+                    {'key': 1577923200000, 'key_as_string': '2020-01-02', 'doc_count': 0},
+                ]},
+            },
+        }
+
+    def test_aggregate(self):
+        result = self.storage.aggregate(
+            date_from=utc(2020, 1, 1), date_to=utc(2020, 1, 3), user='admin',
+            fields=('user', 'risk_level', 'asset'), size=5, interval='day'
+        )
+        self.assertEqual(result, {
+            'total': 12,
+            'user': [{'key': 'admin', 'count': 9}, {'key': 'guest', 'count': 3}],
+            'risk_level': [{'key': 0, 'count': 12}],
+            'asset': [],
+            'histogram': [{'timestamp': 1577836800, 'count': 5}, {'timestamp': 1577923200, 'count': 0}],
+        })
+        body = self.storage.es.search.call_args[1]['body']
+        self.assertEqual(body['size'], 0)
+        self.assertNotIn('sort', body)
+        self.assertEqual(body['aggs']['user'], {'terms': {'field': 'user', 'size': 5}})
+        self.assertEqual(body['aggs']['histogram'],
+                         {'date_histogram': {'field': 'date', 'interval': 'day', 'min_doc_count': 0}})
+        self.assertIn({'term': {'user': 'admin'}}, body['query']['bool']['filter'])
+        time_range = {'gte': utc(2020, 1, 1).timestamp(), 'lte': utc(2020, 1, 3).timestamp()}
+        self.assertIn({'range': {'timestamp': time_range}}, body['query']['bool']['filter'])
+
+    def test_without_histogram(self):
+        result = self.storage.aggregate(fields=('user',), interval=None)
+        self.assertEqual(sorted(result), ['total', 'user'])
+        self.assertNotIn('histogram', self.storage.es.search.call_args[1]['body']['aggs'])
+
+
+class TestBulkSave(ESTestCase):
+
+    def fake_bulk(self, status):
+        """
+        替换 es.bulk, status(input, attempt) 返回每个文档的状态码
+        """
+        attempts = {}
+
+        def bulk(body):
+            items = []
+            for source in body.splitlines()[1::2]:
+                text = json.loads(source)['input']
+                attempts[text] = attempts.get(text, 0) + 1
+                items.append({'index': {'status': status(text, attempts[text])}})
+            return {'took': 1, 'errors': True, 'items': items}
+        return mock.patch.object(self.storage.es, 'bulk', bulk)
+
+    def test_report(self):
+        for thread_count in (1, 3):
+            report = self.storage.bulk_save((make_command(i) for i in range(25)),
+                                            chunk_size=10, thread_count=thread_count)
+            self.assertEqual((report['chunks'], report['success'], report['failed'], report['retried']),
+                             (3, 25, 0, 0))
+            self.assertEqual(report['errors'], [])
+            self.assertGreater(report['took'], 0)
+            self.assertGreater(report['docs_per_sec'], 0)
+        self.assertEqual(sum(len(docs) for docs in self.indices.values()), 50)
+
+    def test_errors(self):
+        commands = [make_command(i) for i in range(5)]
+        with self.fake_bulk(lambda text, attempt: 400 if text == 'ls 3' else 201):
+            report = self.storage.bulk_save(commands, raise_on_error=False, chunk_size=2)
+            with self.assertRaises(BulkIndexError):
+                self.storage.bulk_save(commands, chunk_size=2)
+        self.assertEqual((report['success'], report['failed']), (4, 1))
+        self.assertEqual(report['errors'][0]['index']['status'], 400)
+        self.assertEqual(report['errors'][0]['index']['data']['input'], 'ls 3')
+
+    def test_retry(self):
+        commands = [make_command(i) for i in range(4)]
+        busy = lambda text, attempt: 429 if text == 'ls 1' and attempt == 1 else 201
+        with mock.patch('time.sleep') as sleep:
+            with self.fake_bulk(busy):
+                report = self.storage.bulk_save(commands, max_retries=2)
+            self.assertEqual((report['success'], report['failed'], report['retried']), (4, 0, 1))
+            self.assertEqual(sleep.call_count, 1)
+
+            with self.fake_bulk(busy):
+                report = self.storage.bulk_save(commands, raise_on_error=False)
+            self.assertEqual((report['success'], report['failed'], report['retried']), (3, 1, 0))
+
+            responses = [TransportError(429, 'es_rejected_execution_exception', {})]
+            bulk = self.storage.es.bulk
+
+            def rejecting(body):
+                if responses:
+                    raise responses.pop()
+                return bulk(body)
+
+            with mock.patch.object(self.storage.es, 'bulk', rejecting):
+                report = self.storage.bulk_save(commands, max_retries=1)
+            self.assertEqual((report['success'], report['retried']), (4, 4))
+
+
+class TestBulkWriter(ESTestCase):
+    config = {'BULK_WRITE': True, 'BULK_MAX_DOCS': 10, 'BULK_MAX_DELAY': 60}
+
+    @property
+    def saved(self):
+        return sum(len(docs) for docs in self.indices.values())
+
+    def wait_saved(self, count, timeout=2):
+        deadline = time.monotonic() + timeout
+        while self.saved < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.saved
+
+    def test_flush(self):
+        for i in range(5):
+            self.storage.save(make_command(i))
+        self.assertEqual(self.saved, 0)
+        self.assertTrue(self.storage.flush(timeout=2))
+        self.assertEqual(self.saved, 5)
+
+    def test_max_docs(self):
+        for i in range(10):
+            self.storage.save(make_command(i))
+        self.assertEqual(self.wait_saved(10), 10)
+
+    def test_max_delay(self):
+        self.storage.writer.max_delay = 0.05
+        self.storage.save(make_command(0))
+        self.assertEqual(self.wait_saved(1), 1)
+
+    def test_close(self):
+        for i in range(5):
+            self.storage.save(make_command(i))
+        self.storage.close(timeout=2)
+        self.assertEqual(self.saved, 5)
+        self.assertFalse(self.storage.writer.thread.is_alive())
+        with self.assertRaises(RuntimeError):
+            self.storage.save(make_command(5))
+
+    def test_close_stalled(self):
+        self.storage.writer.close()
+        writer = self.storage.writer = storagekit.es.ESBulkWriter(
+            self.storage, max_docs=1, max_delay=60, queue_size=2
+        )
+        sending, release = threading.Event(), threading.Event()
+
+        def send_bulk_chunk(commands, lines, raise_on_error=True):
+            sending.set()
+            release.wait()
+            return len(commands), [], 0
+
+        with mock.patch.object(self.storage, 'send_bulk_chunk', send_bulk_chunk):
+            writer.put(make_command(0))
+            sending.wait()
+            writer.put(make_command(1))
+            writer.put(make_command(2))
+            self.assertTrue(writer.queue.full())
+            self.assertFalse(writer.flush(timeout=0.05))
+            start = time.monotonic()
+            writer.close(timeout=0.1)
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertTrue(writer.thread.is_alive())
+            release.set()
+            writer.thread.join(2)
+        self.assertFalse(writer.thread.is_alive())
+
+    def test_on_error(self):
+        errors = []
+        self.storage.writer.on_error = lambda command, info: errors.append((command['input'], info))
+
+        def send_bulk_chunk(commands, lines, raise_on_error=True):
+            return 0, [{'index': {'status': 400, 'error': 'mapper_parsing_exception', 'data': c}}
+                       for c in commands], 0
+
+        with mock.patch.object(self.storage, 'send_bulk_chunk', send_bulk_chunk):
+            self.storage.save(make_command(0))
+            self.storage.flush(timeout=2)
+        self.assertEqual([command for command, _ in errors], ['ls 0'])
+        self.assertEqual(errors[0][1]['index']['status'], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+HEAVY_MODULES = ('boto3', 'botocore', 'oss2', 'azure', 'elasticsearch', 'pytz')
+
+
+def run(code):
+    # 每次在新的解释器里执行, 不受当前进程已导入模块的影响
+    return subprocess.check_output([sys.executable, '-c', code], cwd=ROOT).decode().strip()
+
+
+class TestImport(unittest.TestCase):
+
+    def test_no_sdk_on_import(self):
+        code = (
+            'import sys, storagekit\n'
+            'print(",".join(m for m in %r if m in sys.modules))' % (HEAVY_MODULES,)
+        )
+        self.assertEqual(run(code), '')
+
+    def test_import_time(self):
+        code = (
+            'import time\n'
+            'start = time.perf_counter()\n'
+            'import storagekit\n'
+            'print(time.perf_counter() - start)'
+        )
+        self.assertLess(float(run(code)), 0.5)
+
+    def test_lazy_export(self):
+        code = (
+            'import sys, storagekit\n'
+            'storagekit.CachedObjectStorage\n'
+            'print("boto3" in sys.modules, "storagekit.cache" in sys.modules)'
+        )
+        self.assertEqual(run(code), 'False True')
+
+    def test_register_backend(self):
+        code = (
+            'import storagekit\n'
+            'storagekit.register_object_storage("dummy", "collections:OrderedDict")\n'
+            'print(type(storagekit.create_object_storage({"TYPE": "dummy"})).__name__)'
+        )
+        self.assertEqual(run(code), 'OrderedDict')
+
+
+if __name__ == '__main__':
+    unittest.main()
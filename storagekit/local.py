@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+#
+import datetime
+import errno
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+
+from .base import ObjectStorage, ObjectReader
+from .utils import SortedKeys
+
+TMP_PREFIX = '.storagekit-'
+TMP_SUFFIX = '.tmp'
+
+
+class FileRange(object):
+    """
+    只读取文件中 length 字节的流
+    """
+
+    def __init__(self, f, start, length):
+        f.seek(start)
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=None):
+        if size is None or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class LocalStorage(ObjectStorage):
+    """
+    以本地目录作为对象存储, ROOT 下每个 bucket 是一个子目录, key 中的 / 对应子目录;
+    写入先写临时文件再 rename, 不会读到写了一半的对象;
+    key 的有序索引在第一次列举时扫描目录建立, 之后随本实例的写入和删除更新,
+    其他进程写入的文件需要调用 refresh() 后才能列举到
+    """
+
+    def __init__(self, config):
+        self.root = os.path.abspath(config.get("ROOT", None) or os.path.join(tempfile.gettempdir(), 'storagekit'))
+        self.bucket = config.get("BUCKET", None) or 'default'
+        # 为 True 时 rename 前 fsync, 断电也不会丢失已返回成功的写入
+        self.fsync = config.get("FSYNC", False)
+        self.indexes = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.bucket_path(), 0o755, exist_ok=True)
+
+    def bucket_path(self, bucket=None):
+        return os.path.join(self.root, bucket or self.bucket)
+
+    def path(self, key):
+        parts = key.split('/')
+        if key.startswith('/') or any(part in ('.', '..') for part in parts):
+            raise ValueError('Invalid key: %s' % key)
+        return os.path.join(self.bucket_path(), *parts)
+
+    def get_index(self):
+        with self.lock:
+            index = self.indexes.get(self.bucket)
+            if index is None:
+                index = self.indexes[self.bucket] = SortedKeys(self.scan())
+            return index
+
+    def built_index(self):
+        # 写入和删除只更新已经建立的索引, 未建立时第一次列举会扫描到
+        with self.lock:
+            return self.indexes.get(self.bucket)
+
+    def refresh(self):
+        with self.lock:
+            self.indexes.pop(self.bucket, None)
+
+    def scan(self):
+        base = self.bucket_path()
+        for dirpath, dirnames, filenames in os.walk(base):
+            rel = os.path.relpath(dirpath, base)
+            prefix = '' if rel == '.' else rel.replace(os.sep, '/') + '/'
+            for name in filenames:
+                if not (name.startswith(TMP_PREFIX) and name.endswith(TMP_SUFFIX)):
+                    yield prefix + name
+
+    @staticmethod
+    def make_meta(st):
+        return {
+            'size': st.st_size, 'etag': '"%x-%x"' % (st.st_mtime_ns, st.st_size),
+            'last_modified': datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc),
+        }
+
+    def make_row(self, key):
+        try:
+            st = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        row = self.make_meta(st)
+        row.update(key=key, type='', storage_class='local')
+        return row
+
+    def list_objects(self, **kwargs):
+        resp = {'status': 'success', 'errmsg': '', 'data': []}
+        try:
+            keys, prefixes, _ = self.get_index().page(
+                prefix=kwargs.get('prefix', ''), delimiter=kwargs.get('delimiter', ''),
+                marker=kwargs.get('marker', ''), max_keys=kwargs.get('max_keys', 1000)
+            )
+            data = [{'key': prefix} for prefix in prefixes]
+            data.extend(row for row in map(self.make_row, keys) if row is not None)
+            resp['data'] = data
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def iter_pages(self, prefix='', delimiter='', page_size=1000):
+        index = self.get_index()
+        marker = ''
+        while marker is not None:
+            keys, prefixes, marker = index.page(
+                prefix=prefix, delimiter=delimiter, marker=marker, max_keys=page_size
+            )
+            data = [{'key': p} for p in prefixes]
+            data.extend(row for row in map(self.make_row, keys) if row is not None)
+            yield data
+
+    def exists_object(self, key):
+        resp = self.head_object(key)
+        return {'status': resp['status'], 'errmsg': resp['errmsg']}
+
+    def head_object(self, key):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            resp['data'] = self.make_meta(os.stat(self.path(key)))
+            resp['data']['content_type'] = 'application/octet-stream'
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def write(self, key, write):
+        """
+        write(f) 写入临时文件后原子地替换 key 对应的文件
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), 0o755, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TMP_PREFIX, suffix=TMP_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        index = self.built_index()
+        if index is not None:
+            index.add(key)
+
+    def put_object(self, key, data):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            if hasattr(data, 'read'):
+                self.write(key, lambda f: shutil.copyfileobj(data, f))
+            else:
+                self.write(key, lambda f: f.write(data))
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def get_object(self, key, **kwargs):
+        """
+        body 是文件 mmap 的 memoryview, 不复制文件内容; 需要 bytes 时调用 bytes(body)
+        """
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            with open(self.path(key), 'rb') as f:
+                st = os.fstat(f.fileno())
+                body = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) if st.st_size else b''
+            resp['data'] = self.make_meta(st)
+            resp['data']['body'] = body
+            resp['data']['content_type'] = 'application/octet-stream'
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def open_read(self, key, start=None, end=None):
+        f = open(self.path(key), 'rb')
+        size = os.fstat(f.fileno()).st_size
+        start = start or 0
+        end = size - 1 if end is None else min(end, size - 1)
+        length = max(end - start + 1, 0)
+        return ObjectReader(FileRange(f, start, length), size=length)
+
+    def delete_object(self, key):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            index = self.built_index()
+            if index is not None:
+                index.discard(key)
+            self.prune(os.path.dirname(self.path(key)))
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def prune(self, path):
+        # 删除对象后留下的空目录, 直到 bucket 目录为止
+        base = self.bucket_path()
+        while path != base and path.startswith(base):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+            path = os.path.dirname(path)
+
+    def delete_objects(self, key_list, workers=4):
+        return self.delete_keys(key_list, workers=workers)
+
+    def create_folder(self, key):
+        resp = {'status': 'success', 'errmsg': ''}
+        if not key.endswith('/'): key += '/'
+        try:
+            os.makedirs(self.path(key.rstrip('/')), 0o755, exist_ok=True)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def delete_folder(self, key, workers=4):
+        if not key.endswith('/'): key += '/'
+        resp = self.delete_prefix(key, workers=workers)
+        try:
+            path = self.path(key.rstrip('/'))
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            self.prune(os.path.dirname(path))
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def upload_file(self, src, target):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            with open(src, 'rb') as f:
+                self.write(target, lambda out: shutil.copyfileobj(f, out, 1024 * 1024))
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def download_file(self, src, target):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            os.makedirs(os.path.dirname(target) or '.', 0o755, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target) or '.', prefix=TMP_PREFIX, suffix=TMP_SUFFIX)
+            try:
+                os.close(fd)
+                shutil.copyfile(self.path(src), tmp)
+                os.replace(tmp, target)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def can_copy_from(self, storage):
+        return storage is self or (storage.type == self.type and storage.root == self.root)
+
+    def copy_object(self, src_key, dst_key, src_storage=None):
+        resp = {'status': 'success', 'errmsg': ''}
+        src = src_storage or self
+        try:
+            with open(src.path(src_key), 'rb') as f:
+                self.write(dst_key, lambda out: shutil.copyfileobj(f, out, 1024 * 1024))
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def upload_fileobj(self, fileobj, target, size=None, callback=None):
+        return self.put_object(target, fileobj)
+
+    def list_buckets(self, **kwargs):
+        resp = {'status': 'success', 'errmsg': '', 'data': []}
+        try:
+            resp['data'] = [
+                {'name': entry.name,
+                 'create_time': datetime.datetime.fromtimestamp(entry.stat().st_ctime, datetime.timezone.utc)}
+                for entry in sorted(os.scandir(self.root), key=lambda e: e.name) if entry.is_dir()
+            ]
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def create_bucket(self, bucket=None, **kwargs):
+        resp = {'status': 'success', 'errmsg': ''}
+        if not bucket: bucket = self.bucket
+        try:
+            os.makedirs(self.bucket_path(bucket), 0o755, exist_ok=True)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def delete_bucket(self, bucket=None):
+        resp = {'status': 'success', 'errmsg': ''}
+        if not bucket: bucket = self.bucket
+        try:
+            os.rmdir(self.bucket_path(bucket))
+            with self.lock:
+                self.indexes.pop(bucket, None)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def get_bucket(self, bucket=None):
+        resp = {'status': 'success', 'errmsg': ''}
+        if not bucket: bucket = self.bucket
+        try:
+            st = os.stat(self.bucket_path(bucket))
+            if not os.path.isdir(self.bucket_path(bucket)):
+                raise NotADirectoryError(errno.ENOTDIR, 'Not a bucket', bucket)
+            resp['data'] = {
+                'name': bucket, 'path': self.bucket_path(bucket),
+                'create_time': datetime.datetime.fromtimestamp(st.st_ctime, datetime.timezone.utc),
+            }
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    @property
+    def type(self):
+        return 'local'
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import storagekit
+
+
+class ObjectStorageCases(object):
+    config = None
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.client = storagekit.get_object_storage(dict(self.config, ROOT=self.tmp), shared=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_put_get(self):
+        self.assertEqual(self.client.put_object('a/b.txt', b'hello')['status'], 'success')
+        resp = self.client.get_object('a/b.txt')
+        self.assertEqual(bytes(resp['data']['body']), b'hello')
+        self.assertEqual(self.client.head_object('a/b.txt')['data']['size'], 5)
+        self.assertEqual(self.client.exists_object('a/b.txt')['status'], 'success')
+        self.assertEqual(self.client.exists_object('a/c.txt')['status'], 'failure')
+
+    def test_list(self):
+        for key in ('a/1', 'a/2', 'a/sub/3', 'b/4'):
+            self.client.put_object(key, key)
+        keys = [row['key'] for row in self.client.list_objects(prefix='a/', delimiter='/')['data']]
+        self.assertEqual(keys, ['a/sub/', 'a/1', 'a/2'])
+        keys = [row['key'] for row in self.client.iter_objects(prefix='a/', page_size=1)]
+        self.assertEqual(keys, ['a/1', 'a/2', 'a/sub/3'])
+
+    def test_open_read(self):
+        self.client.put_object('range', b'0123456789')
+        with self.client.open_read('range', 2, 5) as reader:
+            self.assertEqual(reader.read(), b'2345')
+
+    def test_delete(self):
+        for key in ('d/1', 'd/2', 'd/e/3', 'f'):
+            self.client.put_object(key, b'x')
+        self.client.delete_object('f')
+        self.assertEqual(self.client.exists_object('f')['status'], 'failure')
+        self.assertEqual(self.client.delete_folder('d')['status'], 'success')
+        self.assertEqual(list(self.client.iter_objects()), [])
+
+    def test_delete_keys(self):
+        for i in range(5):
+            self.client.put_object('k%d' % i, b'x')
+        resp = self.client.delete_keys(('k%d' % i for i in range(3)), batch_size=2, workers=2)
+        self.assertEqual((resp['status'], resp['data']), ('success', {'deleted': 3, 'errors': []}))
+        self.assertEqual([row['key'] for row in self.client.iter_objects()], ['k3', 'k4'])
+
+        delete_object = self.client.delete_object
+
+        def failing(key):
+            if key == 'k4':
+                return {'status': 'failure', 'errmsg': 'denied', 'data': ''}
+            return delete_object(key)
+
+        with mock.patch.object(self.client, 'delete_object', failing):
+            resp = self.client.delete_keys(['k3', 'k4'])
+        self.assertEqual(resp['status'], 'failure')
+        self.assertEqual(resp['data'], {'deleted': 1, 'errors': [{'key': 'k4', 'errmsg': 'denied'}]})
+
+    def test_delete_prefix(self):
+        for key in ('p/1', 'p/2', 'p/q/3', 'pp', 'r'):
+            self.client.put_object(key, b'x')
+        resp = self.client.delete_prefix('p/', batch_size=2)
+        self.assertEqual(resp['data']['deleted'], 3)
+        self.assertEqual([row['key'] for row in self.client.iter_objects()], ['pp', 'r'])
+        self.assertEqual(self.client.delete_prefix('missing/')['data']['deleted'], 0)
+
+    def test_batch(self):
+        results = self.client.put_objects([('k1', b'a'), ['k2', b'b']])
+        self.assertEqual([(r['key'], r['status']) for r in results], [('k1', 'success'), ('k2', 'success')])
+        self.assertEqual([r['status'] for r in self.client.exists_objects(['k1', 'k2', 'k3'])],
+                         ['success', 'success', 'failure'])
+        bodies = [bytes(r['data']['body']) for r in self.client.iter_batch('get_object', ['k1', 'k2'])]
+        self.assertEqual(bodies, [b'a', b'b'])
+
+    def test_file_transfer(self):
+        src = os.path.join(self.tmp, 'src.bin')
+        target = os.path.join(self.tmp, 'out', 'dst.bin')
+        with open(src, 'wb') as f:
+            f.write(os.urandom(4096))
+        self.assertEqual(self.client.upload_file(src, 'file.bin')['status'], 'success')
+        self.assertEqual(self.client.download_file('file.bin', target)['status'], 'success')
+        with open(src, 'rb') as a, open(target, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+
+class TestMemoryStorage(ObjectStorageCases, unittest.TestCase):
+    config = {'TYPE': 'memory'}
+
+
+class TestLocalStorage(ObjectStorageCases, unittest.TestCase):
+    config = {'TYPE': 'local', 'BUCKET': 'bucket'}
+
+    def test_atomic_write(self):
+        self.client.put_object('k', b'old')
+        body = self.client.get_object('k')['data']['body']
+        self.client.put_object('k', b'new')
+        # 替换的是新文件, 已经映射的旧内容不受影响
+        self.assertEqual(bytes(body), b'old')
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'bucket')), ['k'])
+
+    def test_lazy_index(self):
+        with mock.patch.object(self.client, 'scan', wraps=self.client.scan) as scan:
+            self.client.put_object('a', b'x')
+            self.client.delete_object('a')
+            self.client.put_object('b', b'x')
+            self.assertEqual(scan.call_count, 0)
+            self.assertEqual([row['key'] for row in self.client.iter_objects()], ['b'])
+            self.client.put_object('c', b'x')
+            self.client.delete_object('b')
+            self.assertEqual([row['key'] for row in self.client.iter_objects()], ['c'])
+            self.assertEqual(scan.call_count, 1)
+
+    def test_invalid_key(self):
+        self.assertEqual(self.client.put_object('../escape', b'x')['status'], 'failure')
+
+    def test_refresh(self):
+        os.makedirs(os.path.join(self.tmp, 'bucket', 'x'))
+        self.client.list_objects()
+        with open(os.path.join(self.tmp, 'bucket', 'x', 'y'), 'w') as f:
+            f.write('z')
+        self.client.refresh()
+        self.assertEqual([row['key'] for row in self.client.iter_objects()], ['x/y'])
+
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.client = storagekit.get_object_storage({'TYPE': 'memory'}, shared=False)
+        for name in ('a', 'b/c', 'b/d'):
+            path = os.path.join(self.src, *name.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(name.encode())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def sync(self, local_dir, **kwargs):
+        return self.client.sync(local_dir, 'p', manifest=os.path.join(self.tmp, 'manifest.json'), **kwargs)['data']
+
+    def test_incremental(self):
+        self.assertEqual(sorted(self.sync(self.src)['transferred']), ['a', 'b/c', 'b/d'])
+        self.assertEqual(self.sync(self.src)['skipped'], 3)
+        with open(os.path.join(self.src, 'a'), 'wb') as f:
+            f.write(b'changed')
+        os.remove(os.path.join(self.src, 'b', 'c'))
+        plan = self.sync(self.src, delete=True, dry_run=True)
+        self.assertEqual((plan['transferred'], plan['deleted']), (['a'], ['b/c']))
+        self.assertEqual(self.client.exists_object('p/b/c')['status'], 'success')
+        data = self.sync(self.src, delete=True)
+        self.assertEqual((data['transferred'], data['deleted']), (['a'], ['b/c']))
+        self.assertEqual(self.client.exists_object('p/b/c')['status'], 'failure')
+
+    def test_download(self):
+        self.sync(self.src)
+        dst = os.path.join(self.tmp, 'dst')
+        data = self.client.sync(dst, 'p', direction='download', manifest=False)['data']
+        self.assertEqual(sorted(data['transferred']), ['a', 'b/c', 'b/d'])
+        with open(os.path.join(dst, 'b', 'd'), 'rb') as f:
+            self.assertEqual(f.read(), b'b/d')
+
+    def test_bwlimit_concurrent_callbacks(self):
+        src = os.path.join(self.tmp, 'big')
+        os.makedirs(src)
+        with open(os.path.join(src, 'f'), 'wb') as f:
+            f.write(b'x' * 1000)
+        upload_file = self.client.upload_file
+
+        def parallel(src, target, callback=None):
+            # 分片上传时多个线程乱序回调累计字节数
+            threads = [threading.Thread(target=lambda i=i: [callback(n, 1000, 0) for n in range(i, 1001, 8)])
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return upload_file(src, target)
+
+        consumed = []
+        with mock.patch.object(self.client, 'upload_file', parallel), \
+                mock.patch('storagekit.sync.RateLimiter.consume', lambda self, amount: consumed.append(amount)):
+            self.assertEqual(self.sync(src, bwlimit=10 ** 9)['transferred'], ['f'])
+        self.assertEqual(sum(consumed), 1000)
+        self.assertTrue(all(amount > 0 for amount in consumed))
+
+
+class TestMultiObjectStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.multi = storagekit.get_multi_object_storage([
+            {'TYPE': 'memory', 'BUCKET': 'repair'},
+            {'TYPE': 'local', 'ROOT': os.path.join(self.tmp, 'a')},
+            {'TYPE': 'local', 'ROOT': os.path.join(self.tmp, 'b')},
+        ])
+        self.memory, self.a, self.b = self.multi.storage_list
+
+    def tearDown(self):
+        for storage in self.multi.storage_list:
+            storage.delete_folder('r/')
+        shutil.rmtree(self.tmp)
+
+    def test_read_methods(self):
+        self.multi.put_object('r/k', b'hello world')
+        self.assertEqual(self.multi.head_object('r/k')['data']['size'], 11)
+        with self.multi.open_read('r/k', 0, 4) as reader:
+            self.assertEqual(reader.read(), b'hello')
+        resp = self.multi.get_object_parallel('r/k', part_size=4)
+        self.assertEqual(bytes(resp['data']['body']), b'hello world')
+        cached = storagekit.CachedObjectStorage(self.multi, os.path.join(self.tmp, 'cache'))
+        for _ in range(2):
+            self.assertEqual(bytes(cached.get_object('r/k')['data']['body']), b'hello world')
+
+    def test_is_valid(self):
+        src = os.path.join(self.tmp, 'probe')
+        with open(src, 'wb') as f:
+            f.write(b'x')
+        self.assertTrue(self.multi.is_valid(src, 'r/probe'))
+        self.assertEqual(self.multi.exists_object('r/probe')['status'], 'failure')
+        self.assertFalse(self.multi.is_valid(os.path.join(self.tmp, 'missing'), 'r/probe'))
+
+    def test_write_policy(self):
+        for policy in (0, -1, '0'):
+            self.assertRaises(ValueError, storagekit.MultiObjectStorage, [], write_policy=policy)
+
+    def test_close(self):
+        with mock.patch.object(self.a, 'close') as close:
+            self.multi.close()
+        # 共享的后端由注册表管理, 不关闭
+        self.assertFalse(close.called)
+        self.assertRaises(RuntimeError, self.multi.executor.submit, time.time)
+
+        multi = storagekit.MultiObjectStorage(
+            [{'TYPE': 'local', 'ROOT': os.path.join(self.tmp, name)} for name in ('c', 'd')],
+            write_policy=1, shared=False
+        )
+        self.assertIsNot(multi.storage_list[0], storagekit.get_object_storage(multi.configs[0]))
+        closes = [mock.patch.object(storage, 'close').start() for storage in multi.storage_list]
+        self.addCleanup(mock.patch.stopall)
+        self.assertEqual(multi.put_object('r/k', b'v')['status'], 'success')
+        multi.close()
+        self.assertTrue(all(close.called for close in closes))
+        # close 等待后台的副本写完
+        self.assertEqual([s.exists_object('r/k')['status'] for s in multi.storage_list], ['success'] * 2)
+
+    def test_copy(self):
+        self.memory.put_object('r/x', b'payload')
+        resp = self.multi.copy('r/x', 0, self.multi.backend_id(self.a))
+        self.assertEqual((resp['status'], resp['data']['server_side']), ('success', False))
+        # head 和 open_read 记在源端, 上传记在目标端
+        self.assertEqual([len(stats.samples) for stats in self.multi.stats], [2, 1, 0])
+        self.assertEqual(bytes(self.a.get_object('r/x')['data']['body']), b'payload')
+        self.assertFalse(self.b.can_copy_from(self.a))
+        self.assertTrue(self.a.can_copy_from(self.a))
+
+    def test_repair(self):
+        self.multi.put_object('r/same', b'same')
+        self.memory.put_object('r/missing', b'only here')
+        self.a.put_object('r/stale', b'old')
+        self.b.put_object('r/stale', b'newer')
+        os.utime(self.a.path('r/stale'), (0, 0))
+        plan = self.multi.repair('r/', dry_run=True)['data']
+        self.assertEqual(plan['checked'], 3)
+        self.assertEqual(sorted((c['key'], c['dst']) for c in plan['copied']), sorted([
+            ('r/missing', self.multi.backend_id(self.a)), ('r/missing', self.multi.backend_id(self.b)),
+            ('r/stale', self.multi.backend_id(self.memory)), ('r/stale', self.multi.backend_id(self.a)),
+        ]))
+        progress = []
+        resp = self.multi.repair('r/', callback=lambda done, total, rate: progress.append((done, total)))
+        self.assertEqual((resp['status'], len(resp['data']['copied'])), ('success', 4))
+        self.assertEqual(progress[-1], (4, 4))
+        self.assertEqual(bytes(self.a.get_object('r/stale')['data']['body']), b'newer')
+        self.assertEqual(self.multi.repair('r/', dry_run=True)['data']['copied'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class KeyLocationIndex(object):
+    """
+    记录每个 key 存在于哪些后端, 内存中按 LRU 淘汰, 指定 path 时持久化到 SQLite
+    """
+
+    def __init__(self, capacity=100000, path=None):
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.lock = threading.RLock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS locations ('
+                'key TEXT NOT NULL, backend TEXT NOT NULL, PRIMARY KEY (key, backend))'
+            )
+            self.db.commit()
+
+    def get(self, key):
+        """
+        返回 key 所在后端的集合, 未知返回 None
+        """
+        with self.lock:
+            backends = self.cache.get(key)
+            if backends is not None:
+                self.cache.move_to_end(key)
+                return set(backends)
+            if self.db is None:
+                return None
+            rows = self.db.execute('SELECT backend FROM locations WHERE key = ?', (key,)).fetchall()
+            if not rows:
+                return None
+            backends = frozenset(row[0] for row in rows)
+            self._cache_set(key, backends)
+            return set(backends)
+
+    def add(self, key, backend):
+        with self.lock:
+            backends = self.get(key) or set()
+            backends.add(backend)
+            self._cache_set(key, frozenset(backends))
+            if self.db is not None:
+                self.db.execute('INSERT OR IGNORE INTO locations VALUES (?, ?)', (key, backend))
+                self.db.commit()
+
+    def discard(self, key, backend=None):
+        with self.lock:
+            if backend is None:
+                self.cache.pop(key, None)
+                if self.db is not None:
+                    self.db.execute('DELETE FROM locations WHERE key = ?', (key,))
+                    self.db.commit()
+                return
+            backends = self.get(key)
+            if backends is not None:
+                backends.discard(backend)
+                if backends:
+                    self._cache_set(key, frozenset(backends))
+                else:
+                    self.cache.pop(key, None)
+            if self.db is not None:
+                self.db.execute('DELETE FROM locations WHERE key = ? AND backend = ?', (key, backend))
+                self.db.commit()
+
+    def discard_prefix(self, prefix):
+        with self.lock:
+            for key in [k for k in self.cache if k.startswith(prefix)]:
+                del self.cache[key]
+            if self.db is not None:
+                self.db.execute(
+                    'DELETE FROM locations WHERE substr(key, 1, ?) = ?', (len(prefix), prefix)
+                )
+                self.db.commit()
+
+    def seed(self, backend, keys, batch_size=1000):
+        """
+        批量写入一个后端已有的 key, 通常来自列举结果
+        """
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) >= batch_size:
+                self._seed_batch(backend, batch)
+                batch = []
+        if batch:
+            self._seed_batch(backend, batch)
+
+    def _seed_batch(self, backend, keys):
+        with self.lock:
+            if self.db is not None:
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO locations VALUES (?, ?)', [(key, backend) for key in keys]
+                )
+                self.db.commit()
+            for key in keys:
+                backends = self.cache.get(key)
+                if backends is not None:
+                    self._cache_set(key, backends | {backend})
+                elif self.db is None:
+                    self._cache_set(key, frozenset([backend]))
+
+    def _cache_set(self, key, backends):
+        self.cache[key] = backends
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            if self.db is not None:
+                self.db.execute('DELETE FROM locations')
+                self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
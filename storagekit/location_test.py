@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import storagekit
+from storagekit.location import KeyLocationIndex
+
+
+class TestKeyLocationIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'locations.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_add_and_discard(self):
+        index = KeyLocationIndex()
+        self.assertIsNone(index.get('k'))
+        index.add('k', 'a')
+        index.add('k', 'b')
+        self.assertEqual(index.get('k'), {'a', 'b'})
+        index.get('k').add('c')
+        self.assertEqual(index.get('k'), {'a', 'b'})
+        index.discard('k', 'a')
+        self.assertEqual(index.get('k'), {'b'})
+        index.discard('k', 'b')
+        self.assertIsNone(index.get('k'))
+        index.add('k', 'a')
+        index.discard('k')
+        self.assertIsNone(index.get('k'))
+
+    def test_capacity(self):
+        index = KeyLocationIndex(capacity=2)
+        for key in ('x', 'y'):
+            index.add(key, 'a')
+        index.get('x')
+        index.add('z', 'a')
+        self.assertEqual(list(index.cache), ['x', 'z'])
+        self.assertIsNone(index.get('y'))
+
+    def test_persist(self):
+        index = KeyLocationIndex(capacity=1, path=self.path)
+        index.add('p/1', 'a')
+        index.add('p/2', 'b')
+        index.add('q/1', 'a')
+        # 超出容量被淘汰的 key 从 SQLite 读回
+        self.assertEqual(index.get('p/1'), {'a'})
+        index.close()
+
+        index = KeyLocationIndex(path=self.path)
+        self.assertEqual(index.get('p/2'), {'b'})
+        index.discard_prefix('p/')
+        self.assertIsNone(index.get('p/1'))
+        self.assertIsNone(index.get('p/2'))
+        self.assertEqual(index.get('q/1'), {'a'})
+        index.clear()
+        self.assertIsNone(index.get('q/1'))
+        index.close()
+
+    def test_seed(self):
+        for path in (None, self.path):
+            index = KeyLocationIndex(path=path)
+            index.add('k0', 'b')
+            index.seed('a', ('k%d' % i for i in range(5)), batch_size=2)
+            self.assertEqual(index.get('k0'), {'a', 'b'})
+            self.assertEqual(index.get('k4'), {'a'})
+            index.clear()
+            index.close()
+
+
+class TestMultiLocationIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.index = KeyLocationIndex()
+        self.multi = storagekit.MultiObjectStorage(
+            [{'TYPE': 'local', 'ROOT': os.path.join(self.tmp, name)} for name in ('a', 'b')],
+            location_index=self.index,
+        )
+        self.a, self.b = self.multi.storage_list
+        self.ids = [self.multi.backend_id(s) for s in self.multi.storage_list]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_track(self):
+        self.b.put_object('r/only-b', b'b')
+        self.multi.put_object('r/both', b'x')
+        self.assertEqual(self.index.get('r/both'), set(self.ids))
+        self.assertIsNone(self.multi.locate('r/only-b'))
+
+        self.multi.seed_location_index('r/')
+        self.assertEqual(self.multi.locate('r/only-b'), [1])
+        self.assertEqual(self.multi.read_indexes('r/only-b')[0], 1)
+        self.assertEqual(self.multi.get_object('r/only-b')['data']['body'], b'b')
+
+        self.multi.delete_object('r/both')
+        self.assertIsNone(self.index.get('r/both'))
+        self.multi.delete_folder('r')
+        self.assertIsNone(self.index.get('r/only-b'))
+
+
+    def test_same_backend_id(self):
+        # 两个 MemoryStorage 没有可以区分的 bucket/endpoint
+        multi = storagekit.MultiObjectStorage(
+            [{'TYPE': 'memory'}, {'TYPE': 'memory', 'BUCKET': 'default'}], location_index=KeyLocationIndex()
+        )
+        first, second = multi.storage_list
+        self.assertEqual(len(set(multi.backend_ids)), 2)
+        self.assertEqual([multi.backend_id(s) for s in multi.storage_list], multi.backend_ids)
+        second.put_object('only-second', b'2')
+        multi.seed_location_index()
+        self.assertEqual(multi.locate('only-second'), [1])
+        self.assertEqual(multi.backend_index(multi.backend_ids[1]), 1)
+        self.assertEqual(multi.get_object('only-second')['data']['body'], b'2')
+        multi.delete_object('only-second')
+        self.assertEqual(second.exists_object('only-second')['status'], 'failure')
+        self.assertIsNone(multi.location_index.get('only-second'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+import datetime
+import errno
+import hashlib
+import io
+import os
+import threading
+
+from .base import ObjectStorage, ObjectReader
+from .utils import SortedKeys
+
+
+def no_such_key(key):
+    return FileNotFoundError(errno.ENOENT, 'The specified key does not exist', key)
+
+
+def to_bytes(data):
+    if hasattr(data, 'read'):
+        data = data.read()
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return bytes(data)
+
+
+class MemoryStorage(ObjectStorage):
+    """
+    进程内的对象存储, 用于测试和开发, 相同配置通过 get_object_storage 获取的是同一个实例
+    """
+    stateful = True
+
+    def __init__(self, config):
+        self.bucket = config.get("BUCKET", None) or 'default'
+        self.buckets = {}
+        self.lock = threading.RLock()
+        self.create_bucket(self.bucket)
+
+    def get_store(self, bucket=None):
+        """
+        返回 bucket 的 (objects, SortedKeys)
+        """
+        store = self.buckets.get(bucket or self.bucket)
+        if store is None:
+            raise FileNotFoundError(errno.ENOENT, 'The specified bucket does not exist', bucket or self.bucket)
+        return store[1], store[2]
+
+    @staticmethod
+    def make_row(key, meta):
+        return {
+            'key': key, 'last_modified': meta['last_modified'], 'etag': meta['etag'],
+            'size': len(meta['body']), 'type': '', 'storage_class': 'memory',
+        }
+
+    def list_objects(self, **kwargs):
+        resp = {'status': 'success', 'errmsg': '', 'data': []}
+        try:
+            objects, index = self.get_store()
+            keys, prefixes, _ = index.page(
+                prefix=kwargs.get('prefix', ''), delimiter=kwargs.get('delimiter', ''),
+                marker=kwargs.get('marker', ''), max_keys=kwargs.get('max_keys', 1000)
+            )
+            data = [{'key': prefix} for prefix in prefixes]
+            with self.lock:
+                data.extend(self.make_row(key, objects[key]) for key in keys if key in objects)
+            resp['data'] = data
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def iter_pages(self, prefix='', delimiter='', page_size=1000):
+        objects, index = self.get_store()
+        marker = ''
+        while marker is not None:
+            keys, prefixes, marker = index.page(
+                prefix=prefix, delimiter=delimiter, marker=marker, max_keys=page_size
+            )
+            data = [{'key': p} for p in prefixes]
+            with self.lock:
+                data.extend(self.make_row(key, objects[key]) for key in keys if key in objects)
+            yield data
+
+    def get_meta(self, key):
+        objects, _ = self.get_store()
+        meta = objects.get(key)
+        if meta is None:
+            raise no_such_key(key)
+        return meta
+
+    def exists_object(self, key):
+        resp = self.head_object(key)
+        return {'status': resp['status'], 'errmsg': resp['errmsg']}
+
+    def head_object(self, key):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            meta = self.get_meta(key)
+            resp['data'] = {
+                'size': len(meta['body']), 'etag': meta['etag'],
+                'last_modified': meta['last_modified'], 'content_type': meta['content_type'],
+            }
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def put_object(self, key, data, content_type='application/octet-stream'):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            body = to_bytes(data)
+            objects, index = self.get_store()
+            meta = {
+                'body': body, 'etag': '"%s"' % hashlib.md5(body).hexdigest(),
+                'last_modified': datetime.datetime.now(datetime.timezone.utc),
+                'content_type': content_type,
+            }
+            with self.lock:
+                objects[key] = meta
+                index.add(key)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def get_object(self, key, **kwargs):
+        """
+        body 是保存的 bytes 本身, 不会复制
+        """
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            meta = self.get_meta(key)
+            resp['data'] = {
+                'body': meta['body'], 'etag': meta['etag'], 'size': len(meta['body']),
+                'last_modified': meta['last_modified'], 'content_type': meta['content_type'],
+            }
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def open_read(self, key, start=None, end=None):
+        body = self.get_meta(key)['body']
+        if start is not None or end is not None:
+            body = body[start or 0:None if end is None else end + 1]
+        return ObjectReader(io.BytesIO(body), size=len(body))
+
+    def delete_object(self, key):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            objects, index = self.get_store()
+            with self.lock:
+                objects.pop(key, None)
+                index.discard(key)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def delete_objects(self, key_list, workers=1):
+        return self.delete_keys(key_list, workers=workers)
+
+    def create_folder(self, key):
+        if not key.endswith('/'): key += '/'
+        return self.put_object(key, b'')
+
+    def delete_folder(self, key, workers=1):
+        if not key.endswith('/'): key += '/'
+        return self.delete_prefix(key, workers=workers)
+
+    def upload_file(self, src, target):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            with open(src, 'rb') as f:
+                resp = self.put_object(target, f)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def download_file(self, src, target):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            body = self.get_meta(src)['body']
+            os.makedirs(os.path.dirname(target) or '.', 0o755, exist_ok=True)
+            tmp = '%s.%d.tmp' % (target, threading.get_ident())
+            with open(tmp, 'wb') as f:
+                f.write(body)
+            os.replace(tmp, target)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def can_copy_from(self, storage):
+        return storage is self
+
+    def copy_object(self, src_key, dst_key, src_storage=None):
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            meta = self.get_meta(src_key)
+            objects, index = self.get_store()
+            with self.lock:
+                objects[dst_key] = dict(meta, last_modified=datetime.datetime.now(datetime.timezone.utc))
+                index.add(dst_key)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def upload_fileobj(self, fileobj, target, size=None, callback=None):
+        return self.put_object(target, fileobj)
+
+    def list_buckets(self, **kwargs):
+        with self.lock:
+            data = [{'name': name, 'create_time': store[0]} for name, store in sorted(self.buckets.items())]
+        return {'status': 'success', 'errmsg': '', 'data': data}
+
+    def create_bucket(self, bucket=None, **kwargs):
+        if not bucket: bucket = self.bucket
+        with self.lock:
+            self.buckets.setdefault(bucket, (datetime.datetime.now(datetime.timezone.utc), {}, SortedKeys()))
+        return {'status': 'success', 'errmsg': ''}
+
+    def delete_bucket(self, bucket=None):
+        resp = {'status': 'success', 'errmsg': ''}
+        if not bucket: bucket = self.bucket
+        with self.lock:
+            store = self.buckets.get(bucket)
+            if store is None:
+                resp = {'status': 'failure', 'errmsg': 'The specified bucket does not exist'}
+            elif store[1]:
+                resp = {'status': 'failure', 'errmsg': 'The bucket you tried to delete is not empty'}
+            else:
+                del self.buckets[bucket]
+        return resp
+
+    def get_bucket(self, bucket=None):
+        resp = {'status': 'success', 'errmsg': ''}
+        if not bucket: bucket = self.bucket
+        with self.lock:
+            store = self.buckets.get(bucket)
+            if store is None:
+                resp = {'status': 'failure', 'errmsg': 'The specified bucket does not exist'}
+            else:
+                resp['data'] = {'name': bucket, 'create_time': store[0], 'count': len(store[1])}
+        return resp
+
+    @property
+    def type(self):
+        return 'memory'
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+#
+import bisect
+import functools
+import os
+import re
+import socket
+import threading
+import time
+
+OBJECT_OPERATIONS = (
+    'list_objects', 'exists_object', 'head_object', 'put_object', 'get_object',
+    'delete_object', 'delete_objects', 'create_folder', 'delete_folder',
+    'upload_file', 'download_file', 'get_object_parallel', 'open_read',
+    'copy_object', 'upload_fileobj',
+    'list_buckets', 'create_bucket', 'delete_bucket', 'get_bucket',
+)
+
+LOG_OPERATIONS = ('save', 'bulk_save', 'filter', 'count', 'aggregate')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class MetricsSink(object):
+    """
+    指标输出的接口, start 的返回值会作为 context 传给 finish, 可以用来挂接 tracing 的 span
+    """
+
+    def start(self, backend, operation):
+        return None
+
+    def finish(self, backend, operation, elapsed, error=None,
+               bytes_in=0, bytes_out=0, retries=0, context=None):
+        pass
+
+
+class RegistrySink(MetricsSink):
+    """
+    进程内的 Prometheus 风格指标, render() 返回文本格式, 可以直接作为 /metrics 的响应
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, namespace='storagekit'):
+        self.buckets = tuple(sorted(buckets))
+        self.namespace = namespace
+        self.histograms = {}
+        self.errors = {}
+        self.bytes = {}
+        self.retries = {}
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def start(self, backend, operation):
+        with self.lock:
+            key = (backend, operation)
+            self.inflight[key] = self.inflight.get(key, 0) + 1
+
+    def finish(self, backend, operation, elapsed, error=None,
+               bytes_in=0, bytes_out=0, retries=0, context=None):
+        key = (backend, operation)
+        with self.lock:
+            self.inflight[key] -= 1
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # 每个桶的计数, 最后一个是 +Inf, 以及 sum
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, elapsed)] += 1
+            histogram[1] += elapsed
+            if error is not None:
+                self.errors[key + (error,)] = self.errors.get(key + (error,), 0) + 1
+            if bytes_in:
+                self.bytes[key + ('in',)] = self.bytes.get(key + ('in',), 0) + bytes_in
+            if bytes_out:
+                self.bytes[key + ('out',)] = self.bytes.get(key + ('out',), 0) + bytes_out
+            if retries:
+                self.retries[key] = self.retries.get(key, 0) + retries
+
+    def snapshot(self):
+        """
+        返回 {(backend, operation): {'count', 'sum', 'errors', 'bytes_in', 'bytes_out', 'retries', 'inflight'}}
+        """
+        with self.lock:
+            data = {}
+            for key in set(self.histograms) | set(self.inflight):
+                counts, total = self.histograms.get(key, [[], 0.0])
+                data[key] = {
+                    'count': sum(counts), 'sum': total,
+                    'errors': {k[2]: v for k, v in self.errors.items() if k[:2] == key},
+                    'bytes_in': self.bytes.get(key + ('in',), 0),
+                    'bytes_out': self.bytes.get(key + ('out',), 0),
+                    'retries': self.retries.get(key, 0),
+                    'inflight': self.inflight.get(key, 0),
+                }
+            return data
+
+    def render(self):
+        ns = self.namespace
+        lines = []
+        with self.lock:
+            lines.append('# TYPE %s_operation_seconds histogram' % ns)
+            for (backend, operation), (counts, total) in sorted(self.histograms.items()):
+                labels = 'backend="%s",operation="%s"' % (backend, operation)
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('%s_operation_seconds_bucket{%s,le="%s"} %d' % (ns, labels, bound, cumulative))
+                lines.append('%s_operation_seconds_sum{%s} %s' % (ns, labels, total))
+                lines.append('%s_operation_seconds_count{%s} %d' % (ns, labels, cumulative))
+            lines.append('# TYPE %s_operation_errors_total counter' % ns)
+            for (backend, operation, error), count in sorted(self.errors.items()):
+                lines.append('%s_operation_errors_total{backend="%s",operation="%s",error="%s"} %d'
+                             % (ns, backend, operation, error, count))
+            lines.append('# TYPE %s_bytes_total counter' % ns)
+            for (backend, operation, direction), count in sorted(self.bytes.items()):
+                lines.append('%s_bytes_total{backend="%s",operation="%s",direction="%s"} %d'
+                             % (ns, backend, operation, direction, count))
+            lines.append('# TYPE %s_retries_total counter' % ns)
+            for (backend, operation), count in sorted(self.retries.items()):
+                lines.append('%s_retries_total{backend="%s",operation="%s"} %d' % (ns, backend, operation, count))
+            lines.append('# TYPE %s_inflight gauge' % ns)
+            for (backend, operation), count in sorted(self.inflight.items()):
+                lines.append('%s_inflight{backend="%s",operation="%s"} %d' % (ns, backend, operation, count))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdSink(MetricsSink):
+    """
+    通过 UDP 发送 StatsD 指标, 发送失败直接忽略, 不影响存储操作
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='storagekit'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def name(self, *parts):
+        return '.'.join([self.prefix] + [re.sub(r'[^\w\-]', '_', str(p)) for p in parts])
+
+    def send(self, lines):
+        try:
+            self.sock.sendto('\n'.join(lines).encode('utf-8'), self.address)
+        except OSError:
+            pass
+
+    def start(self, backend, operation):
+        self.send(['%s:+1|g' % self.name(backend, operation, 'inflight')])
+
+    def finish(self, backend, operation, elapsed, error=None,
+               bytes_in=0, bytes_out=0, retries=0, context=None):
+        lines = [
+            '%s:-1|g' % self.name(backend, operation, 'inflight'),
+            '%s:%.3f|ms' % (self.name(backend, operation, 'time'), elapsed * 1000),
+        ]
+        if error is not None:
+            lines.append('%s:1|c' % self.name(backend, operation, 'errors', error))
+        if bytes_in:
+            lines.append('%s:%d|c' % (self.name(backend, operation, 'bytes_in'), bytes_in))
+        if bytes_out:
+            lines.append('%s:%d|c' % (self.name(backend, operation, 'bytes_out'), bytes_out))
+        if retries:
+            lines.append('%s:%d|c' % (self.name(backend, operation, 'retries'), retries))
+        self.send(lines)
+
+    def close(self):
+        self.sock.close()
+
+
+class CallbackSink(MetricsSink):
+    """
+    每次操作结束时调用 callback(event), event 为 dict;
+    指定 on_start 时操作开始前调用 on_start(backend, operation), 返回值放在 event['context'],
+    可以用来创建和结束 tracing 的 span
+    """
+
+    def __init__(self, callback, on_start=None):
+        self.callback = callback
+        self.on_start = on_start
+
+    def start(self, backend, operation):
+        if self.on_start is not None:
+            return self.on_start(backend, operation)
+
+    def finish(self, backend, operation, elapsed, error=None,
+               bytes_in=0, bytes_out=0, retries=0, context=None):
+        self.callback({
+            'backend': backend, 'operation': operation, 'elapsed': elapsed, 'error': error,
+            'bytes_in': bytes_in, 'bytes_out': bytes_out, 'retries': retries, 'context': context,
+        })
+
+
+def backend_label(storage):
+    name = getattr(storage, 'bucket', None) or getattr(storage, 'container_name', None) \
+        or getattr(storage, 'index', None)
+    return '%s:%s' % (storage.type, name) if name else storage.type
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def transferred_bytes(operation, args, kwargs, resp):
+    """
+    返回 (bytes_in, bytes_out), 只统计能直接从参数或结果得到的字节数
+    """
+    ok = isinstance(resp, dict) and resp.get('status') == 'success'
+    data = resp.get('data') if isinstance(resp, dict) else None
+    if operation == 'put_object':
+        body = args[1] if len(args) > 1 else kwargs.get('data')
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        return 0, len(body) if isinstance(body, (bytes, bytearray, memoryview)) else 0
+    if operation == 'upload_file' and ok:
+        return 0, file_size(args[0] if args else kwargs.get('src'))
+    if operation == 'get_object' and ok and isinstance(data, dict):
+        body = data.get('body')
+        return len(body) if body is not None else 0, 0
+    if operation == 'download_file' and ok:
+        return file_size(args[1] if len(args) > 1 else kwargs.get('target')), 0
+    if operation == 'get_object_parallel' and ok and isinstance(data, dict):
+        return data.get('size', 0), 0
+    return 0, 0
+
+
+def wrap(func, sink, backend, operation):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        context = sink.start(backend, operation)
+        start = time.perf_counter()
+        resp = error = None
+        try:
+            resp = func(*args, **kwargs)
+            return resp
+        except Exception as e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            retries = 0
+            if isinstance(resp, dict):
+                if resp.get('status') == 'failure':
+                    error = resp.get('error') or 'failure'
+                # ESStorage.bulk_save 的报告中带有重试次数
+                retries = resp.get('retried', 0) if isinstance(resp.get('retried'), int) else 0
+            bytes_in, bytes_out = transferred_bytes(operation, args, kwargs, resp)
+            sink.finish(backend, operation, elapsed, error=error, bytes_in=bytes_in,
+                        bytes_out=bytes_out, retries=retries, context=context)
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument(storage, sink, backend=None, operations=None):
+    """
+    在实例上用计时的包装函数替换存储方法, 未调用时类上的方法不受影响, 没有任何开销
+    """
+    if operations is None:
+        operations = LOG_OPERATIONS if hasattr(storage, 'bulk_save') else OBJECT_OPERATIONS
+    backend = backend or backend_label(storage)
+    for operation in operations:
+        func = getattr(storage, operation, None)
+        if func is None or getattr(func, 'instrumented', False):
+            continue
+        setattr(storage, operation, wrap(func, sink, backend, operation))
+    return storage
+
+
+def uninstrument(storage):
+    for operation in OBJECT_OPERATIONS + LOG_OPERATIONS:
+        if getattr(storage.__dict__.get(operation), 'instrumented', False):
+            delattr(storage, operation)
+    return storage
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import storagekit
+from storagekit.metrics import CallbackSink, RegistrySink, StatsdSink, instrument, uninstrument, wrap
+
+
+class TestRegistrySink(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = RegistrySink(buckets=(1, 0.1))
+        self.storage = storagekit.get_object_storage(
+            {'TYPE': 'memory', 'BUCKET': 'm', 'METRICS': self.sink}, shared=False
+        )
+
+    def test_snapshot(self):
+        self.storage.put_object('k', b'hello')
+        self.storage.get_object('k')
+        self.storage.get_object('missing')
+        data = self.sink.snapshot()
+        put, get = data[('memory:m', 'put_object')], data[('memory:m', 'get_object')]
+        self.assertEqual((put['count'], put['bytes_out'], put['errors'], put['inflight']), (1, 5, {}, 0))
+        self.assertEqual((get['count'], get['bytes_in']), (2, 5))
+        self.assertEqual(sum(get['errors'].values()), 1)
+
+    def test_exception(self):
+        with self.assertRaises(TypeError):
+            self.storage.put_object()
+        self.assertEqual(self.sink.snapshot()[('memory:m', 'put_object')]['errors'], {'TypeError': 1})
+
+    def test_render(self):
+        for elapsed, kwargs in ((0.05, {'bytes_in': 3}), (5, {'error': 'Timeout', 'retries': 2})):
+            self.sink.start('b', 'op')
+            self.sink.finish('b', 'op', elapsed, **kwargs)
+        text = self.sink.render()
+        for line in (
+            'storagekit_operation_seconds_bucket{backend="b",operation="op",le="0.1"} 1',
+            'storagekit_operation_seconds_bucket{backend="b",operation="op",le="1"} 1',
+            'storagekit_operation_seconds_bucket{backend="b",operation="op",le="+Inf"} 2',
+            'storagekit_operation_seconds_count{backend="b",operation="op"} 2',
+            'storagekit_operation_errors_total{backend="b",operation="op",error="Timeout"} 1',
+            'storagekit_bytes_total{backend="b",operation="op",direction="in"} 3',
+            'storagekit_retries_total{backend="b",operation="op"} 2',
+        ):
+            self.assertIn(line, text.splitlines())
+
+
+class TestStatsdSink(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(2)
+        self.sink = StatsdSink(port=self.server.getsockname()[1], prefix='sk')
+
+    def tearDown(self):
+        self.sink.close()
+        self.server.close()
+
+    def recv(self):
+        return self.server.recv(65536).decode('utf-8').split('\n')
+
+    def test_send(self):
+        storage = storagekit.get_object_storage({'TYPE': 'memory', 'BUCKET': 'm'}, shared=False)
+        instrument(storage, self.sink)
+        storage.put_object('k', b'hello')
+        self.assertEqual(self.recv(), ['sk.memory_m.put_object.inflight:+1|g'])
+        lines = self.recv()
+        self.assertEqual(lines[0], 'sk.memory_m.put_object.inflight:-1|g')
+        self.assertTrue(lines[1].startswith('sk.memory_m.put_object.time:'))
+        self.assertEqual(lines[2], 'sk.memory_m.put_object.bytes_out:5|c')
+
+    def test_name(self):
+        self.assertEqual(self.sink.name('s3:bucket.x', 'get_object'), 'sk.s3_bucket_x.get_object')
+
+
+class TestInstrument(unittest.TestCase):
+
+    def test_callback(self):
+        events = []
+        sink = CallbackSink(events.append, on_start=lambda backend, operation: (backend, operation))
+        storage = storagekit.get_object_storage({'TYPE': 'memory'}, shared=False)
+        instrument(storage, sink, backend='mem', operations=['put_object'])
+        instrument(storage, sink, backend='mem', operations=['put_object'])
+        storage.put_object('k', b'x')
+        storage.get_object('k')
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['context'], ('mem', 'put_object'))
+        self.assertEqual((events[0]['bytes_out'], events[0]['error']), (1, None))
+
+        uninstrument(storage)
+        self.assertNotIn('put_object', storage.__dict__)
+        storage.put_object('k', b'x')
+        self.assertEqual(len(events), 1)
+
+    def test_retries(self):
+        sink = RegistrySink()
+        bulk_save = wrap(lambda commands: {'success': 2, 'retried': 3}, sink, 'es', 'bulk_save')
+        bulk_save([])
+        self.assertEqual(sink.snapshot()[('es', 'bulk_save')]['retries'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
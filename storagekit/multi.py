@@ -1,15 +1,86 @@
 # -*- coding: utf-8 -*-
 #
+import collections
+import heapq
+import itertools
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from .base import ObjectStorage, LogStorage
+from .sync import plain_etag
+from .utils import ProgressMeter, bounded_map
+
+MULTIPART_ETAG = re.compile(r'^[0-9a-f]{32}-\d+$')
+
+
+class BackendStats(object):
+    """
+    单个后端的 EWMA 延迟、错误率和最近成功请求的延迟样本
+    """
+
+    def __init__(self, alpha=0.2, window=200):
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.samples = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, elapsed, ok):
+        with self.lock:
+            self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+            if not ok:
+                return
+            self.samples.append(elapsed)
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += self.alpha * (elapsed - self.latency)
+
+    def percentile(self, p, min_samples=20):
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            samples = sorted(self.samples)
+        return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+    @property
+    def healthy(self):
+        return self.error_rate < 0.5
+
+    def sort_key(self):
+        # 没有样本的后端延迟按 0 处理, 让它有机会被探测
+        return not self.healthy, self.latency or 0.0
 
 
 class MultiObjectStorage(ObjectStorage):
 
-    def __init__(self, configs):
+    def __init__(self, configs, write_policy='all', max_workers=None,
+                 hedge_reads=False, hedge_delay=0.05, location_index=None, shared=True):
+        """
+        write_policy: 'all' 全部写成功, 'quorum' 多数写成功, 或整数 N 表示 N 个写成功即返回,
+        其余未完成的副本在后台继续写入
+        hedge_reads: 读请求超过最快后端的 p95 延迟(样本不足时用 hedge_delay)仍未返回,
+        则同时请求下一个后端, 取先成功的结果
+        location_index: KeyLocationIndex, 记录 key 所在的后端, 读和删除直接访问这些后端
+        shared: 后端从注册表获取共享实例; 为 False 时新建, 由本对象在 close() 时关闭
+        """
+        if write_policy not in ('all', 'quorum') and int(write_policy) < 1:
+            raise ValueError("write_policy must be 'all', 'quorum' or a positive integer")
         self.configs = configs
+        self.write_policy = write_policy
+        self.hedge_reads = hedge_reads
+        self.hedge_delay = hedge_delay
+        self.location_index = location_index
+        self.shared = shared
         self.storage_list = []
         self.init_storage_list()
+        self.init_backend_ids()
+        self.stats = [BackendStats() for _ in self.storage_list]
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or len(self.storage_list) * 4 or 1)
 
     def init_storage_list(self):
         from . import get_object_storage
@@ -19,45 +90,454 @@ class MultiObjectStorage(ObjectStorage):
             configs = self.configs
 
         for config in configs:
-            self.storage_list.append(get_object_storage(config))
+            self.storage_list.append(get_object_storage(config, shared=self.shared))
 
-    def upload(self, src, target):
-        success = []
-        msg = []
+    @property
+    def required_acks(self):
+        total = len(self.storage_list)
+        if self.write_policy == 'all':
+            return total
+        if self.write_policy == 'quorum':
+            return total // 2 + 1
+        return min(int(self.write_policy), total)
 
-        for storage in self.storage_list:
-            ok, err = storage.upload(src, target)
-            success.append(ok)
-            msg.append(err)
+    def call(self, index, method, *args, **kwargs):
+        """
+        method 为方法名, 或者以 storage 为第一个参数的函数
+        """
+        storage = self.storage_list[index]
+        start = time.monotonic()
+        try:
+            if callable(method):
+                resp = method(storage, *args, **kwargs)
+            else:
+                resp = getattr(storage, method)(*args, **kwargs)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        resp['elapsed'] = time.monotonic() - start
+        self.stats[index].record(resp['elapsed'], resp['status'] == 'success')
+        return resp
 
-        return success, msg
+    def ordered_indexes(self, indexes=None):
+        if indexes is None:
+            indexes = range(len(self.storage_list))
+        return sorted(indexes, key=lambda i: self.stats[i].sort_key())
 
-    def download(self, src, target):
-        success = False
-        msg = None
+    @staticmethod
+    def make_backend_id(storage):
+        name = getattr(storage, 'bucket', None) or getattr(storage, 'container_name', None)
+        location = getattr(storage, 'endpoint', None) or getattr(storage, 'region', None) \
+            or getattr(storage, 'account_name', None) or getattr(storage, 'root', None)
+        return '%s:%s/%s' % (storage.type, location or '', name or '')
 
-        for storage in self.storage_list:
-            if storage.exists(src):
-                ok, msg = storage.download(src, target)
-                if ok:
-                    success = True
-                    break
-        return success, msg
+    def init_backend_ids(self):
+        ids = [self.make_backend_id(storage) for storage in self.storage_list]
+        # 没有 bucket/endpoint 可以区分的后端(如多个 MemoryStorage) id 相同, 加上下标区分
+        self.backend_ids = [
+            backend_id if ids.count(backend_id) == 1 else '%s#%d' % (backend_id, i)
+            for i, backend_id in enumerate(ids)
+        ]
 
-    def delete(self, path):
-        success = True
-        msg = None
+    def backend_id(self, storage):
+        """
+        位置索引和复制结果中使用的后端标识
+        """
+        for i, item in enumerate(self.storage_list):
+            if item is storage:
+                return self.backend_ids[i]
+        return self.make_backend_id(storage)
+
+    def locate(self, key):
+        """
+        返回 key 所在的后端, 没有位置索引或者未知时返回 None
+        """
+        if self.location_index is None:
+            return None
+        backends = self.location_index.get(key)
+        if not backends:
+            return None
+        indexes = [i for i, backend_id in enumerate(self.backend_ids) if backend_id in backends]
+        return indexes or None
+
+    def read_indexes(self, key):
+        # 已知的后端优先, 其余的作为位置索引过期时的后备
+        located = self.locate(key)
+        if located is None:
+            return self.ordered_indexes()
+        others = [i for i in range(len(self.storage_list)) if i not in located]
+        return self.ordered_indexes(located) + self.ordered_indexes(others)
+
+    def track(self, method, key, exists=True):
+        """
+        包装 method, 成功后在位置索引中记录或删除 key
+        """
+        if self.location_index is None:
+            return method
+
+        def tracked(storage, *args, **kwargs):
+            if callable(method):
+                resp = method(storage, *args, **kwargs)
+            else:
+                resp = getattr(storage, method)(*args, **kwargs)
+            if resp['status'] == 'success':
+                if exists:
+                    self.location_index.add(key, self.backend_id(storage))
+                else:
+                    self.location_index.discard(key, self.backend_id(storage))
+            return resp
+        return tracked
+
+    def seed_location_index(self, prefix=''):
+        """
+        列举每个后端, 用已有的 key 初始化位置索引
+        """
+        for storage, backend_id in zip(self.storage_list, self.backend_ids):
+            keys = (row['key'] for row in storage.iter_objects(prefix=prefix, prefetch_pages=True)
+                    if 'size' in row)
+            self.location_index.seed(backend_id, keys)
+
+    def fan_out(self, method, *args, indexes=None, **kwargs):
+        """
+        并发调用所有后端(或 indexes 指定的后端), 达到 write_policy 要求的成功数后立即返回,
+        data 中是每个后端的结果, 仍在执行的为 pending, 完成后会原地更新
+        """
+        if indexes is None:
+            indexes = range(len(self.storage_list))
+        results = []
+        futures = {}
+        for i in indexes:
+            storage = self.storage_list[i]
+            result = {'index': i, 'type': storage.type, 'status': 'pending', 'errmsg': '', 'elapsed': None}
+            results.append(result)
+            future = self.executor.submit(self.call, i, method, *args, **kwargs)
+            future.add_done_callback(lambda f, result=result: result.update(f.result()))
+            futures[future] = result
+
+        required = self.required_acks if len(results) == len(self.storage_list) else len(results)
+        allowed_failures = len(results) - required
+        success, failure = 0, 0
+        not_done = set(futures)
+        while not_done and success < required and failure <= allowed_failures:
+            done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures[future].update(future.result())
+                if future.result()['status'] == 'success':
+                    success += 1
+                else:
+                    failure += 1
+
+        resp = {'status': 'success', 'errmsg': '', 'data': results}
+        if success < required:
+            resp['status'] = 'failure'
+            resp['errmsg'] = '; '.join(
+                '%s: %s' % (r['type'], r['errmsg']) for r in results if r['status'] == 'failure'
+            )
+        return resp
+
+    def first_success(self, method, *args, indexes=None, **kwargs):
+        """
+        按 indexes 的顺序(默认按延迟从低到高)依次尝试后端, 开启 hedge_reads 时并发对冲
+        """
+        if indexes is None:
+            indexes = self.ordered_indexes()
+        if self.hedge_reads:
+            return self.hedged(method, *args, indexes=indexes, **kwargs)
+        resp = {'status': 'failure', 'errmsg': 'No storage available'}
+        for i in indexes:
+            resp = self.call(i, method, *args, **kwargs)
+            if resp['status'] == 'success':
+                break
+        return resp
+
+    def hedged(self, method, *args, indexes=None, **kwargs):
+        resp = {'status': 'failure', 'errmsg': 'No storage available'}
+        order = iter(self.ordered_indexes() if indexes is None else indexes)
+        pending = {}
+
+        def launch():
+            i = next(order, None)
+            if i is None:
+                return None
+            pending[self.executor.submit(self.call, i, method, *args, **kwargs)] = i
+            return i
+
+        current = launch()
+        while pending:
+            delay = None
+            if current is not None:
+                delay = self.stats[current].percentile(0.95) or self.hedge_delay
+            done, _ = wait(pending, timeout=delay, return_when=FIRST_COMPLETED)
+            if not done:
+                current = launch()
+                continue
+            for future in done:
+                pending.pop(future)
+                resp = future.result()
+                if resp['status'] == 'success':
+                    return resp
+            # 失败的后端不再等待 hedge 延迟, 直接换下一个
+            current = launch()
+        return resp
+
+    def list_objects(self, **kwargs):
+        return self.first_success('list_objects', **kwargs)
+
+    def exists_object(self, key):
+        return self.first_success(
+            self.track('exists_object', key), key, indexes=self.read_indexes(key)
+        )
+
+    def get_object(self, key, **kwargs):
+        return self.first_success(
+            self.track('get_object', key), key, indexes=self.read_indexes(key), **kwargs
+        )
+
+    def head_object(self, key):
+        return self.first_success(
+            self.track('head_object', key), key, indexes=self.read_indexes(key)
+        )
+
+    def open_read(self, key, start=None, end=None):
+        """
+        按 read_indexes 的顺序打开第一个可读的后端, 全部失败时抛出最后一个异常
+        """
+        error = IOError('No storage available')
+        for i in self.read_indexes(key):
+            start_time = time.monotonic()
+            try:
+                reader = self.storage_list[i].open_read(key, start, end)
+            except Exception as e:
+                self.stats[i].record(time.monotonic() - start_time, False)
+                error = e
+                continue
+            self.stats[i].record(time.monotonic() - start_time, True)
+            return reader
+        raise error
+
+    def get_object_parallel(self, key, target=None, part_size=8 * 1024 * 1024, workers=8):
+        # 所有分段从同一个后端读取, 避免副本不一致时拼接出错误的内容
+        return self.first_success(
+            'get_object_parallel', key, target=target, part_size=part_size, workers=workers,
+            indexes=self.read_indexes(key)
+        )
+
+    def put_object(self, key, data):
+        return self.fan_out(self.track('put_object', key), key, data)
+
+    def delete_object(self, key):
+        # 已知 key 所在的后端时只删除这些后端
+        return self.fan_out(
+            self.track('delete_object', key, exists=False), key, indexes=self.locate(key)
+        )
 
-        for storage in self.storage_list:
-            if storage.exists(path):
-                ok, msg = storage.delete(path)
-                if not ok:
-                    success = False
-        return success, msg
+    def delete_objects(self, key_list):
+        key_list = list(key_list)
+        if self.location_index is not None:
+            for key in key_list:
+                self.location_index.discard(key)
+        return self.fan_out('delete_objects', key_list)
+
+    def create_folder(self, key):
+        return self.fan_out('create_folder', key)
+
+    def delete_folder(self, key):
+        if self.location_index is not None:
+            self.location_index.discard_prefix(key if key.endswith('/') else key + '/')
+        return self.fan_out('delete_folder', key)
+
+    def upload_file(self, src, target):
+        return self.fan_out(self.track('upload_file', target), src, target)
+
+    def download_file(self, src, target):
+        if not self.hedge_reads:
+            return self.first_success(
+                self.track('download_file', src), src, target, indexes=self.read_indexes(src)
+            )
+
+        # 对冲时各后端先写到各自的临时文件, 先成功的一个改名为 target
+        won = threading.Lock()
+
+        def download(storage, src, target):
+            tmp = '%s.%s.part' % (target, uuid.uuid4().hex)
+            resp = storage.download_file(src, tmp)
+            if resp['status'] == 'success' and won.acquire(blocking=False):
+                os.replace(tmp, target)
+            elif os.path.exists(tmp):
+                os.remove(tmp)
+            return resp
+        return self.first_success(
+            self.track(download, src), src, target, indexes=self.read_indexes(src)
+        )
+
+    def backend_index(self, backend):
+        """
+        backend 为 storage_list 中的下标或 backend_id
+        """
+        if isinstance(backend, int):
+            if not 0 <= backend < len(self.storage_list):
+                raise IndexError('Backend index out of range: %d' % backend)
+            return backend
+        if backend in self.backend_ids:
+            return self.backend_ids.index(backend)
+        raise ValueError('Unknown backend: %s' % backend)
+
+    def copy(self, key, src_backend, dst_backend, dst_key=None, callback=None):
+        """
+        把 src_backend 上的 key 复制到 dst_backend;
+        同一服务商同一账号内使用服务端复制, 否则 open_read 流式读取并 upload_fileobj 上传, 不落本地文件
+        """
+        src_index, dst_index = self.backend_index(src_backend), self.backend_index(dst_backend)
+        src, dst = self.storage_list[src_index], self.storage_list[dst_index]
+        dst_key = dst_key or key
+        server_side = dst.can_copy_from(src)
+        data = {'key': dst_key, 'src': self.backend_ids[src_index], 'dst': self.backend_ids[dst_index],
+                'server_side': server_side}
+
+        if server_side:
+            resp = self.call(dst_index, self.track(
+                lambda storage: storage.copy_object(key, dst_key, src_storage=src), dst_key
+            ))
+            resp['data'] = data
+            return resp
+
+        # 读源端的延迟记在源端, 上传记在目标端
+        head = self.call(src_index, 'head_object', key)
+        if head['status'] != 'success':
+            head['data'] = data
+            return head
+        opened = self.call(src_index, lambda storage: {
+            'status': 'success', 'errmsg': '', 'reader': storage.open_read(key)
+        })
+        if opened['status'] != 'success':
+            opened['data'] = data
+            return opened
+        with opened['reader'] as reader:
+            resp = self.call(dst_index, self.track(
+                lambda storage: storage.upload_fileobj(reader, dst_key, size=head['data']['size'], callback=callback),
+                dst_key
+            ))
+        resp['data'] = data
+        return resp
+
+    def same_object(self, a, b, types):
+        """
+        比较两个后端列举出的同一 key, 只有两边的 etag 都是内容的 md5 时才比较 etag, 否则只比较 size
+        """
+        if a.get('size') != b.get('size'):
+            return False
+        md5_a, md5_b = plain_etag(a.get('etag')), plain_etag(b.get('etag'))
+        if md5_a and md5_b:
+            return md5_a == md5_b
+        # 同类后端分片上传的 etag 由分片 md5 计算, 分片大小相同时可以比较
+        etag_a, etag_b = (a.get('etag') or '').strip('"').lower(), (b.get('etag') or '').strip('"').lower()
+        if types[0] == types[1] and MULTIPART_ETAG.match(etag_a) and MULTIPART_ETAG.match(etag_b):
+            return etag_a == etag_b
+        return True
+
+    def repair(self, prefix='', workers=8, dry_run=False, callback=None):
+        """
+        同时列举所有后端 prefix 下的对象, 按 key 顺序归并, 把缺失或者 etag 不一致的副本从最新修改的副本复制过去;
+        列举是流式的, 内存占用与 prefix 下的对象数无关;
+        workers 为并发复制数, callback(done, total, per_second) 按对象数报告进度, 列举完成前 total 为 None;
+        dry_run 为 True 时只返回将要执行的复制
+        """
+        data = {'checked': 0, 'copied': [], 'errors': [], 'bytes': 0, 'dry_run': dry_run}
+        order = self.ordered_indexes()
+
+        def listing(i):
+            # iter_objects 按 key 的字典序返回, prefetch_pages 在后台预取下一页, 各后端的列举并发进行
+            for row in self.storage_list[i].iter_objects(prefix=prefix, prefetch_pages=True):
+                if 'size' in row:
+                    yield row['key'], order.index(i), i, row
+
+        def modified(row):
+            value = row.get('last_modified')
+            return value.timestamp() if hasattr(value, 'timestamp') else 0
+
+        def plan():
+            merged = heapq.merge(*[listing(i) for i in range(len(self.storage_list))], key=lambda t: t[:2])
+            for key, group in itertools.groupby(merged, key=lambda t: t[0]):
+                # group 按延迟从低到高排列, max 在修改时间相同时选延迟低的后端
+                replicas = {i: row for _, _, i, row in group}
+                data['checked'] += 1
+                src = max(replicas, key=lambda i: modified(replicas[i]))
+                row = replicas[src]
+                for i in range(len(self.storage_list)):
+                    if i == src:
+                        continue
+                    types = (self.storage_list[i].type, self.storage_list[src].type)
+                    if i not in replicas or not self.same_object(replicas[i], row, types):
+                        yield key, src, i, row['size']
+
+        meter = ProgressMeter(callback) if callback else None
+
+        def repair_one(task):
+            key, src, dst, size = task
+            if dry_run:
+                ret = {'status': 'success', 'errmsg': '', 'data': {
+                    'src': self.backend_ids[src], 'dst': self.backend_ids[dst],
+                }}
+            else:
+                ret = self.copy(key, src, dst)
+            if meter:
+                meter(1)
+            return task, ret
+
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            for (key, src, dst, size), ret in bounded_map(repair_one, plan(), workers=workers, ordered=False):
+                item = {'key': key, 'src': ret['data']['src'], 'dst': ret['data']['dst']}
+                if ret['status'] == 'success':
+                    data['copied'].append(item)
+                    data['bytes'] += size
+                else:
+                    item['errmsg'] = ret['errmsg']
+                    data['errors'].append(item)
+        except Exception as e:
+            # 列举失败时无法判断之后的 key 是否缺失, 已经完成的复制保留
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        if meter:
+            meter.total = meter.transferred
+            meter(0)
+
+        if resp['status'] == 'success' and data['errors']:
+            resp = {'status': 'failure', 'errmsg': '%d replica(s) failed to repair' % len(data['errors'])}
+        resp['data'] = data
+        return resp
+
+    def list_buckets(self, **kwargs):
+        return self.first_success('list_buckets', **kwargs)
+
+    def create_bucket(self, bucket=None, **kwargs):
+        return self.fan_out('create_bucket', bucket, **kwargs)
+
+    def delete_bucket(self, bucket=None):
+        return self.fan_out('delete_bucket', bucket)
+
+    def get_bucket(self, bucket=None):
+        return self.first_success('get_bucket', bucket)
+
+    def upload(self, src, target):
+        return self.upload_file(src, target)
+
+    def download(self, src, target):
+        return self.download_file(src, target)
+
+    def delete(self, path):
+        return self.delete_object(path)
 
     def exists(self, path):
-        for storage in self.storage_list:
-            if storage.exists(path):
-                return True
-        return False
+        return self.exists_object(path)['status'] == 'success'
+
+    def close(self):
+        """
+        等待后台未完成的副本写入后关闭线程池; 共享的后端由注册表管理, 只关闭自己创建的后端
+        """
+        self.executor.shutdown(wait=True)
+        if not self.shared:
+            for storage in self.storage_list:
+                storage.close()
 
+    @property
+    def type(self):
+        return 'multi'
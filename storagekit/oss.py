@@ -2,9 +2,24 @@
 #
 import os
 import datetime
+import tempfile
 import oss2
 
-from .base import ObjectStorage
+from .base import ObjectStorage, ObjectReader
+from .utils import ProgressMeter, bounded_map, make_http_adapter
+
+
+def read_full(fileobj, size):
+    # 网络流的 read(size) 可能返回不足 size 的数据
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        data = fileobj.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    return b''.join(chunks)
 
 
 class OSSStorage(ObjectStorage):
@@ -13,14 +28,47 @@ class OSSStorage(ObjectStorage):
         self.bucket = config.get("BUCKET", None)
         self.access_key = config.get("ACCESS_KEY", None)
         self.secret_key = config.get("SECRET_KEY", None)
+        self.pool_size = config.get("POOL_SIZE", oss2.defaults.connection_pool_size)
+        self.keep_alive = config.get("KEEP_ALIVE", True)
+        # 大于 multipart_threshold 的文件分片并发传输, 断点记录在 checkpoint_dir,
+        # 中断后重试只传缺少的分片; 未配置时用 ~/.storagekit, 不可写时用临时目录
+        self.multipart_threshold = config.get("MULTIPART_THRESHOLD", oss2.defaults.multipart_threshold)
+        self.part_size = config.get("PART_SIZE", oss2.defaults.part_size)
+        self.num_threads = config.get("NUM_THREADS", 4)
+        self.checkpoint_dir = config.get("CHECKPOINT_DIR", None)
+        self.session = self.make_session(self.pool_size, self.keep_alive)
+        self.buckets = {}
         if self.access_key and self.secret_key:
             self.auth = oss2.Auth(self.access_key, self.secret_key)
         else:
             self.auth = None
         if self.auth and self.endpoint and self.bucket:
-            self.client = oss2.Bucket(self.auth, self.endpoint, self.bucket)
+            self.client = self.get_bucket_client(self.bucket)
         else:
             self.client = None
+        self.init_meta_cache(config)
+
+    @staticmethod
+    def make_session(pool_size, keep_alive=True):
+        session = oss2.Session()
+        adapter = make_http_adapter(pool_size, keep_alive)
+        session.session.mount('http://', adapter)
+        session.session.mount('https://', adapter)
+        return session
+
+    def get_bucket_client(self, bucket):
+        # 所有 bucket 共用一个 session, 也就共用连接池
+        client = self.buckets.get(bucket)
+        if client is None:
+            client = oss2.Bucket(self.auth, self.endpoint, bucket, session=self.session)
+            self.buckets[bucket] = client
+        return client
+
+    @staticmethod
+    def make_row(row):
+        d = row.__dict__
+        d['last_modified'] = datetime.datetime.fromtimestamp(d['last_modified'])
+        return d
 
     def list_objects(self, **kwargs):
         resp = {'status': 'success', 'errmsg': '', 'data': []}
@@ -30,21 +78,23 @@ class OSSStorage(ObjectStorage):
             if rets.prefix_list:
                 data = [{'key': row} for row in rets.prefix_list]
             for row in rets.object_list:
-                d = row.__dict__
-                d['last_modified'] = datetime.datetime.fromtimestamp(d['last_modified'])
-                data.append(d)
+                data.append(self.make_row(row))
             resp['data'] = data
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
+    def iter_pages(self, prefix='', delimiter='', page_size=1000):
+        # 直接按页使用 ObjectIterator, 保留它对 5xx 的重试
+        objects = oss2.ObjectIterator(self.client, prefix=prefix, delimiter=delimiter, max_keys=page_size)
+        while objects.is_truncated:
+            objects.fetch_with_retry()
+            yield [{'key': row.key} if row.is_prefix() else self.make_row(row) for row in objects.entries]
+            objects.entries = []
+
     def exists_object(self, key):
-        resp = {'status': 'success', 'errmsg': ''}
-        try:
-            self.client.object_exists(key)
-        except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
-        return resp
+        resp = self.head_object(key)
+        return {'status': resp['status'], 'errmsg': resp['errmsg']}
 
     def get_object(self, key, **kwargs):
         resp = {'status': 'success', 'errmsg': ''}
@@ -54,105 +104,247 @@ class OSSStorage(ObjectStorage):
             resp['data']['body'] = data.read()
             resp['data']['content_type'] = data.content_type
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
 
-    def put_object(self, key, data):
+    def head_object(self, key):
+        resp = self.get_cached_meta(key)
+        if resp is not None:
+            return resp
+        generation = self.meta_generation()
         resp = {'status': 'success', 'errmsg': ''}
         try:
-            self.client.put_object(key, data)
+            ret = self.client.head_object(key)
+            resp['data'] = {
+                'size': ret.content_length, 'etag': ret.etag,
+                'last_modified': datetime.datetime.fromtimestamp(ret.last_modified),
+                'content_type': ret.content_type,
+            }
+            self.set_cached_meta(key, resp, generation=generation)
+        except oss2.exceptions.NotFound as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+            self.set_cached_meta(key, resp, missing=True, generation=generation)
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
-    def delete_object(self, key):
+    def open_read(self, key, start=None, end=None):
+        kwargs = {}
+        if start is not None or end is not None:
+            kwargs['byte_range'] = (start or 0, end)
+        ret = self.client.get_object(key, **kwargs)
+        return ObjectReader(ret, size=ret.content_length, close=ret.resp.response.close)
+
+    def put_object(self, key, data):
         resp = {'status': 'success', 'errmsg': ''}
         try:
-            self.client.delete_object(key)
+            with self.invalidating_meta(key):
+                self.client.put_object(key, data)
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
-    def delete_objects(self, key_list):
+    def delete_object(self, key):
         resp = {'status': 'success', 'errmsg': ''}
         try:
-            self.client.batch_delete_objects(key_list)
+            with self.invalidating_meta(key):
+                self.client.delete_object(key)
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
+    def delete_batch(self, keys):
+        ret = self.client.batch_delete_objects(keys)
+        deleted = set(ret.deleted_keys)
+        errors = [{'key': key, 'errmsg': 'Not deleted'} for key in keys if key not in deleted]
+        return len(keys) - len(errors), errors
+
+    def delete_objects(self, key_list, workers=4):
+        return self.delete_keys(key_list, workers=workers)
+
     def create_folder(self, key):
         resp = {'status': 'success', 'errmsg': ''}
         if not key.endswith('/'): key += '/'
         try:
-            self.client.put_object(key, '')
+            with self.invalidating_meta(key):
+                self.client.put_object(key, '')
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
-    def delete_folder(self, key):
-        resp = {'status': 'success', 'errmsg': ''}
+    def delete_folder(self, key, workers=4):
         if not key.endswith('/'): key += '/'
+        return self.delete_prefix(key, workers=workers)
+
+    def get_checkpoint_dir(self):
+        if self.checkpoint_dir:
+            return self.checkpoint_dir
+        home = os.path.expanduser('~')
+        candidates = [os.path.join(home, '.storagekit')] if home != '~' else []
+        candidates.append(os.path.join(tempfile.gettempdir(), 'storagekit'))
+        for path in candidates:
+            try:
+                os.makedirs(path, 0o700, exist_ok=True)
+            except OSError:
+                continue
+            if os.access(path, os.W_OK):
+                return path
+        return candidates[-1]
+
+    def upload_file(self, src, target, callback=None, multipart_threshold=None, part_size=None, num_threads=None):
+        """
+        callback(transferred, total, bytes_per_second) 报告进度, 其余参数覆盖实例的配置;
+        小于 multipart_threshold 的文件直接 put, 不记录断点
+        """
+        resp = {'status': 'success', 'errmsg': ''}
+        multipart_threshold = multipart_threshold or self.multipart_threshold
         try:
-            objects = oss2.ObjectIterator(self.client, prefix=key)
-            key_list = [row.key for row in objects]
-            self.delete_objects(key_list)
+            with self.invalidating_meta(target):
+                meter = ProgressMeter(callback) if callback else None
+                if os.path.getsize(src) < multipart_threshold:
+                    self.client.put_object_from_file(
+                        target, src, progress_callback=meter.update_to if meter else None
+                    )
+                    return resp
+                oss2.resumable_upload(
+                    self.client, target, src,
+                    store=oss2.ResumableStore(root=self.get_checkpoint_dir(), dir='oss-upload'),
+                    multipart_threshold=multipart_threshold,
+                    part_size=part_size or self.part_size,
+                    num_threads=num_threads or self.num_threads,
+                    progress_callback=meter.update_to if meter else None,
+                )
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
-    def upload_file(self, src, target):
+    def download_file(self, src, target, callback=None, multipart_threshold=None, part_size=None, num_threads=None):
         resp = {'status': 'success', 'errmsg': ''}
+        multipart_threshold = multipart_threshold or self.multipart_threshold
         try:
-            self.client.put_object_from_file(target, src)
+            head = self.head_object(src)
+            if head['status'] != 'success':
+                return head
+            os.makedirs(os.path.dirname(target), 0o755, exist_ok=True)
+            meter = ProgressMeter(callback) if callback else None
+            if head['data']['size'] < multipart_threshold:
+                self.client.get_object_to_file(
+                    src, target, progress_callback=meter.update_to if meter else None
+                )
+                return resp
+            oss2.resumable_download(
+                self.client, src, target,
+                store=oss2.ResumableDownloadStore(root=self.get_checkpoint_dir(), dir='oss-download'),
+                multiget_threshold=multipart_threshold,
+                part_size=part_size or self.part_size,
+                num_threads=num_threads or self.num_threads,
+                progress_callback=meter.update_to if meter else None,
+            )
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
-    def download_file(self, src, target):
+    def can_copy_from(self, storage):
+        # OSS 只能在同一个 region 内复制
+        return storage is self or (
+            storage.type == self.type and
+            (storage.endpoint, storage.access_key) == (self.endpoint, self.access_key)
+        )
+
+    def copy_object(self, src_key, dst_key, src_storage=None):
         resp = {'status': 'success', 'errmsg': ''}
+        src = src_storage or self
         try:
-            os.makedirs(os.path.dirname(target), 0o755, exist_ok=True)
-            self.client.get_object_to_file(src, target)
+            with self.invalidating_meta(dst_key):
+                self.client.copy_object(src.bucket, src_key, dst_key)
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
+    def upload_fileobj(self, fileobj, target, size=None, callback=None):
+        """
+        从不可 seek 的流上传, 大小未知或超过 multipart_threshold 时按 part_size 读取分片并发上传,
+        内存中最多有 num_threads * 2 个分片
+        """
+        resp = {'status': 'success', 'errmsg': ''}
+        meter = ProgressMeter(callback, total=size) if callback else None
+        try:
+            with self.invalidating_meta(target):
+                if size is not None and size < self.multipart_threshold:
+                    self.client.put_object(target, fileobj.read())
+                    if meter:
+                        meter(size)
+                else:
+                    self.upload_parts(fileobj, target, meter)
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def upload_parts(self, fileobj, target, meter=None):
+        upload_id = self.client.init_multipart_upload(target).upload_id
+        try:
+            def parts():
+                number = 1
+                while True:
+                    data = read_full(fileobj, self.part_size)
+                    if not data and number > 1:
+                        return
+                    yield number, data
+                    if len(data) < self.part_size:
+                        return
+                    number += 1
+
+            def upload_part(part):
+                number, data = part
+                ret = self.client.upload_part(target, upload_id, number, data)
+                if meter:
+                    meter(len(data))
+                return oss2.models.PartInfo(number, ret.etag)
+
+            infos = list(bounded_map(upload_part, parts(), workers=self.num_threads))
+            self.client.complete_multipart_upload(target, upload_id, infos)
+        except Exception:
+            self.client.abort_multipart_upload(target, upload_id)
+            raise
+
+    def close(self):
+        self.session.session.close()
+
     def list_buckets(self, **kwargs):
         resp = {'status': 'success', 'errmsg': '', 'data': []}
         try:
-            service = oss2.Service(self.auth,self.endpoint)
+            service = oss2.Service(self.auth, self.endpoint, session=self.session)
             resp['data'] = ([{'name': b.name, 'create_time': datetime.datetime.fromtimestamp(b.creation_date), 'location': b.location} for b in oss2.BucketIterator(service)])
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
     def create_bucket(self, bucket=None, **kwargs):
         resp = {'status': 'success', 'errmsg': ''}
         if not bucket: bucket = self.bucket
         try:
-            oss2.Bucket(self.auth, self.endpoint, bucket).create_bucket(**kwargs)
+            self.get_bucket_client(bucket).create_bucket(**kwargs)
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
     def delete_bucket(self, bucket=None):
         resp = {'status': 'success', 'errmsg': ''}
         if not bucket: bucket = self.bucket
         try:
-            oss2.Bucket(self.auth, self.endpoint, bucket).delete_bucket()
+            self.get_bucket_client(bucket).delete_bucket()
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
     def get_bucket(self, bucket=None):
         resp = {'status': 'success', 'errmsg': ''}
         if not bucket: bucket = self.bucket
         try:
-            resp['data'] = oss2.Bucket(self.auth, self.endpoint, bucket).get_bucket_info()
+            resp['data'] = self.get_bucket_client(bucket).get_bucket_info()
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
     @property
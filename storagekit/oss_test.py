@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import storagekit
+from fakes import FakeOSSServer
+
+
+class TestOSSTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = FakeOSSServer().start()
+        self.storage = storagekit.get_object_storage({
+            'TYPE': 'oss', 'BUCKET': 'b', 'ACCESS_KEY': 'a', 'SECRET_KEY': 's',
+            'ENDPOINT': self.server.endpoint, 'MULTIPART_THRESHOLD': 100 * 1024, 'PART_SIZE': 100 * 1024,
+        }, shared=False)
+
+    def tearDown(self):
+        self.storage.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_small_file(self):
+        src = self.write('small', b'x' * 1000)
+        target = os.path.join(self.tmp, 'out', 'small')
+        progress = []
+        # 小文件不经过断点续传, 也不需要可写的 HOME
+        with mock.patch('oss2.resumable_upload') as upload, mock.patch('oss2.resumable_download') as download, \
+                mock.patch.object(self.storage, 'get_checkpoint_dir', side_effect=AssertionError):
+            self.assertEqual(self.storage.upload_file(src, 'small', callback=lambda *a: progress.append(a))['status'],
+                             'success')
+            self.assertEqual(self.storage.download_file('small', target)['status'], 'success')
+        self.assertFalse(upload.called or download.called)
+        self.assertEqual(progress[-1][:2], (1000, 1000))
+        self.assertEqual(self.read(target), b'x' * 1000)
+        self.assertEqual(self.storage.download_file('missing', target)['status'], 'failure')
+
+    def test_multipart(self):
+        self.storage.checkpoint_dir = os.path.join(self.tmp, 'checkpoints')
+        data = os.urandom(300 * 1024)
+        src = self.write('big', data)
+        target = os.path.join(self.tmp, 'out', 'big')
+        self.assertEqual(self.storage.upload_file(src, 'big')['status'], 'success')
+        self.assertEqual(self.storage.download_file('big', target)['status'], 'success')
+        self.assertEqual(self.read(target), data)
+
+    def test_checkpoint_dir_fallback(self):
+        with mock.patch('os.path.expanduser', lambda path: '~'):
+            self.assertEqual(self.storage.get_checkpoint_dir(), os.path.join(tempfile.gettempdir(), 'storagekit'))
+        with mock.patch('os.access', lambda path, mode: not path.startswith(os.path.expanduser('~'))):
+            self.assertEqual(self.storage.get_checkpoint_dir(), os.path.join(tempfile.gettempdir(), 'storagekit'))
+
+
+if __name__ == '__main__':
+    unittest.main()
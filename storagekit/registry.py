@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IDLE_TIMEOUT = 3600
+
+
+class StorageRegistry(object):
+    """
+    按规范化后的配置缓存存储实例, 相同配置共享同一个客户端和连接池;
+    超过 idle_timeout 秒(配置中的 IDLE_TIMEOUT 优先, 0 或 None 表示不淘汰)未被获取的实例
+    会从注册表移除, 之后的 get 创建新实例; 调用方可能还持有旧实例, 所以不调用 close(),
+    由垃圾回收释放连接; stateful 为 True 的实例(如 MemoryStorage)保存着数据, 不会被淘汰
+    """
+
+    def __init__(self, idle_timeout=None):
+        self.idle_timeout = idle_timeout
+        self.instances = {}
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def make_key(kind, config):
+        normalized = {str(k).upper(): v for k, v in config.items()}
+        if isinstance(normalized.get('TYPE'), str):
+            normalized['TYPE'] = normalized['TYPE'].lower()
+        return kind, json.dumps(normalized, sort_keys=True, default=repr)
+
+    def get(self, kind, config, factory):
+        key = self.make_key(kind, config)
+        now = time.monotonic()
+        self.evict_idle(now)
+        with self.lock:
+            entry = self.instances.get(key)
+            if entry is not None:
+                entry[1] = now
+                return entry[0]
+
+        # 在锁外创建, 避免慢的客户端初始化阻塞其他配置; 并发创建时保留先放入的一个
+        instance = factory(config)
+        idle_timeout = config.get("IDLE_TIMEOUT", self.idle_timeout)
+        with self.lock:
+            entry = self.instances.setdefault(key, [instance, now, idle_timeout])
+            entry[1] = now
+        if entry[0] is not instance:
+            self.close(instance)
+        return entry[0]
+
+    def evict_idle(self, now=None):
+        now = now or time.monotonic()
+        with self.lock:
+            for key, (instance, last_used, idle_timeout) in list(self.instances.items()):
+                if not idle_timeout or getattr(instance, 'stateful', False):
+                    continue
+                if now - last_used > idle_timeout:
+                    del self.instances[key]
+
+    @staticmethod
+    def close(instance):
+        close = getattr(instance, 'close', None)
+        if close is None:
+            return
+        try:
+            close()
+        except Exception:
+            logger.exception("Close storage %r failed", instance)
+
+    def clear(self):
+        with self.lock:
+            instances = [entry[0] for entry in self.instances.values()]
+            self.instances.clear()
+        for instance in instances:
+            self.close(instance)
+
+
+registry = StorageRegistry(idle_timeout=DEFAULT_IDLE_TIMEOUT)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from storagekit.local import LocalStorage
+from storagekit.memory import MemoryStorage
+from storagekit.registry import StorageRegistry
+
+
+class Closable(object):
+
+    def __init__(self, config, stateful=False):
+        self.config = config
+        self.stateful = stateful
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestStorageRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_shared(self):
+        registry = StorageRegistry()
+        a = registry.get('object', {'type': 'S3', 'bucket': 'b'}, Closable)
+        b = registry.get('object', {'TYPE': 's3', 'BUCKET': 'b'}, Closable)
+        self.assertIs(a, b)
+        self.assertIsNot(a, registry.get('object', {'TYPE': 's3', 'BUCKET': 'c'}, Closable))
+
+    def test_evict_idle(self):
+        registry = StorageRegistry(idle_timeout=10)
+        idle = registry.get('object', {'TYPE': 'a'}, Closable)
+        never = registry.get('object', {'TYPE': 'b', 'IDLE_TIMEOUT': 0}, Closable)
+        memory = registry.get('object', {'TYPE': 'memory'}, MemoryStorage)
+        memory.put_object('k', b'v')
+        registry.evict_idle(registry.instances[registry.make_key('object', {'TYPE': 'a'})][1] + 11)
+        self.assertNotIn(registry.make_key('object', {'TYPE': 'a'}), registry.instances)
+        self.assertIs(registry.get('object', {'TYPE': 'b', 'IDLE_TIMEOUT': 0}, Closable), never)
+        self.assertIsNot(registry.get('object', {'TYPE': 'a'}, Closable), idle)
+        self.assertIs(registry.get('object', {'TYPE': 'memory'}, MemoryStorage), memory)
+        self.assertEqual(memory.exists_object('k')['status'], 'success')
+
+    def test_held_instance_survives_eviction(self):
+        registry = StorageRegistry(idle_timeout=10)
+        config = {'TYPE': 'local', 'ROOT': self.tmp}
+        held = registry.get('object', config, LocalStorage)
+        held.put_object('k', b'v')
+        registry.evict_idle(time.monotonic() + 11)
+        # 持有者仍然可以继续使用被淘汰的实例
+        self.assertEqual(bytes(held.get_object('k')['data']['body']), b'v')
+        self.assertEqual(held.put_object('k2', b'v')['status'], 'success')
+        fresh = registry.get('object', config, LocalStorage)
+        self.assertIsNot(fresh, held)
+        self.assertEqual(fresh.exists_object('k2')['status'], 'success')
+
+    def test_clear(self):
+        registry = StorageRegistry()
+        instance = registry.get('log', {'TYPE': 'x'}, Closable)
+        registry.clear()
+        self.assertTrue(instance.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 #
-import boto3
+import hashlib
+import json
+import math
 import os
 
-from .base import ObjectStorage
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from .base import ObjectStorage, ObjectReader
+from .utils import ProgressMeter, bounded_map
 
 
 class S3Storage(ObjectStorage):
@@ -13,16 +21,49 @@ class S3Storage(ObjectStorage):
         self.access_key = config.get("ACCESS_KEY", None)
         self.secret_key = config.get("SECRET_KEY", None)
         self.endpoint = config.get("ENDPOINT", None)
+        self.multipart_threshold = config.get("MULTIPART_THRESHOLD", 8 * 1024 * 1024)
+        self.multipart_chunksize = config.get("MULTIPART_CHUNKSIZE", 8 * 1024 * 1024)
+        self.max_concurrency = config.get("MAX_CONCURRENCY", 10)
+        self.max_pool_connections = config.get("MAX_POOL_CONNECTIONS", max(10, self.max_concurrency))
+        self.keep_alive = config.get("KEEP_ALIVE", True)
+        # 断点续传的记录目录, 设置后大于 multipart_threshold 的文件使用可续传的分片上传
+        self.checkpoint_dir = config.get("CHECKPOINT_DIR", None)
 
         try:
             self.client = boto3.client(
                 's3', region_name=self.region,
                 aws_access_key_id=self.access_key,
                 aws_secret_access_key=self.secret_key,
-                endpoint_url=self.endpoint
+                endpoint_url=self.endpoint,
+                config=self.make_client_config()
             )
         except ValueError:
             pass
+        self.init_meta_cache(config)
+
+    def make_client_config(self):
+        try:
+            return Config(max_pool_connections=self.max_pool_connections, tcp_keepalive=self.keep_alive)
+        except TypeError:
+            # botocore 1.21 之前不支持 tcp_keepalive
+            return Config(max_pool_connections=self.max_pool_connections)
+
+    def close(self):
+        # botocore 1.26 之前的客户端没有 close, 连接池随客户端回收
+        close = getattr(getattr(self, 'client', None), 'close', None)
+        if close is not None:
+            close()
+
+    @staticmethod
+    def make_row(row):
+        d = {}
+        d['key'] = row['Key']
+        d['last_modified'] = row['LastModified']
+        d['etag'] = row['ETag']
+        d['size'] = row['Size']
+        d['tyep'] = ''
+        d['storage_class'] = row['StorageClass']
+        return d
 
     def list_objects(self, **kwargs):
         resp = {'status': 'success', 'errmsg': '', 'data': []}
@@ -37,33 +78,34 @@ class S3Storage(ObjectStorage):
                 data = [{'key': row['Prefix']} for row in rets['CommonPrefixes']]
             if 'Contents' in rets:
                 for row in rets['Contents']:
-                    d = {}
-                    d['key'] = row['Key']
-                    d['last_modified'] = row['LastModified']
-                    d['etag'] = row['ETag']
-                    d['size'] = row['Size']
-                    d['tyep'] = ''
-                    d['storage_class'] = row['StorageClass']
-                    data.append(d)
+                    data.append(self.make_row(row))
             resp['data'] = data
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
+    def iter_pages(self, prefix='', delimiter='', page_size=1000):
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=self.bucket, Prefix=prefix, Delimiter=delimiter,
+            PaginationConfig={'PageSize': page_size}
+        )
+        for page in pages:
+            data = [{'key': row['Prefix']} for row in page.get('CommonPrefixes', [])]
+            data.extend(self.make_row(row) for row in page.get('Contents', []))
+            yield data
+
     def exists_object(self, key):
-        resp = {'status': 'success', 'errmsg': ''}
-        try:
-            self.client.head_object(Bucket=self.bucket, Key=key)
-        except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
-        return resp
+        resp = self.head_object(key)
+        return {'status': resp['status'], 'errmsg': resp['errmsg']}
 
     def put_object(self, key, data):
         resp = {'status': 'success', 'errmsg': ''}
         try:
-            self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+            with self.invalidating_meta(key):
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
     def get_object(self, key, **kwargs):
@@ -74,64 +116,215 @@ class S3Storage(ObjectStorage):
             resp['data']['body'] = data['Body'].read()
             resp['data']['content_type'] = data['ResponseMetadata']['HTTPHeaders']['content-type']
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
-    def delete_object(self, key):
+    def head_object(self, key):
+        resp = self.get_cached_meta(key)
+        if resp is not None:
+            return resp
+        generation = self.meta_generation()
         resp = {'status': 'success', 'errmsg': ''}
         try:
-            self.client.delete_object(Bucket=self.bucket, Key=key)
+            ret = self.client.head_object(Bucket=self.bucket, Key=key)
+            resp['data'] = {
+                'size': ret['ContentLength'], 'etag': ret['ETag'],
+                'last_modified': ret['LastModified'], 'content_type': ret.get('ContentType'),
+            }
+            self.set_cached_meta(key, resp, generation=generation)
+        except ClientError as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                self.set_cached_meta(key, resp, missing=True, generation=generation)
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
-    def delete_objects(self, key_list):
+    def open_read(self, key, start=None, end=None):
+        kwargs = {}
+        if start is not None or end is not None:
+            kwargs['Range'] = 'bytes=%s-%s' % (start or 0, '' if end is None else end)
+        ret = self.client.get_object(Bucket=self.bucket, Key=key, **kwargs)
+        return ObjectReader(ret['Body'], size=ret['ContentLength'])
+
+    def delete_object(self, key):
         resp = {'status': 'success', 'errmsg': ''}
-        objects = [{'Key': row} for row in key_list]
         try:
-            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects':objects})
+            with self.invalidating_meta(key):
+                self.client.delete_object(Bucket=self.bucket, Key=key)
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
+    def delete_batch(self, keys):
+        objects = [{'Key': key} for key in keys]
+        ret = self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects, 'Quiet': True})
+        errors = [{'key': row['Key'], 'errmsg': row.get('Message', row.get('Code', ''))}
+                  for row in ret.get('Errors', [])]
+        return len(keys) - len(errors), errors
+
+    def delete_objects(self, key_list, workers=4):
+        return self.delete_keys(key_list, workers=workers)
+
     def create_folder(self, key):
         resp = {'status': 'success', 'errmsg': ''}
         if not key.endswith('/'): key += '/'
         try:
-            self.client.put_object(Bucket=self.bucket, Key=key, Body='')
+            with self.invalidating_meta(key):
+                self.client.put_object(Bucket=self.bucket, Key=key, Body='')
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
-    def delete_folder(self, key):
-        resp = {'status': 'success', 'errmsg': ''}
+    def delete_folder(self, key, workers=4):
         if not key.endswith('/'): key += '/'
+        return self.delete_prefix(key, workers=workers)
+
+    def transfer_config(self, multipart_threshold=None, multipart_chunksize=None, max_concurrency=None):
+        return TransferConfig(
+            multipart_threshold=multipart_threshold or self.multipart_threshold,
+            multipart_chunksize=multipart_chunksize or self.multipart_chunksize,
+            max_concurrency=max_concurrency or self.max_concurrency,
+        )
+
+    def upload_file(self, src, target, callback=None, resumable=None, **kwargs):
+        """
+        kwargs 可以是 multipart_threshold, multipart_chunksize, max_concurrency, 覆盖实例的配置,
+        callback(transferred, total, bytes_per_second) 报告进度
+        """
+        resp = {'status': 'success', 'errmsg': ''}
+        try:
+            with self.invalidating_meta(target):
+                config = self.transfer_config(**kwargs)
+                size = os.path.getsize(src)
+                meter = ProgressMeter(callback, total=size) if callback else None
+                if resumable is None:
+                    resumable = bool(self.checkpoint_dir)
+                if resumable and size >= config.multipart_threshold:
+                    self.resumable_upload(src, target, config, meter)
+                else:
+                    self.client.upload_file(
+                        Filename=src, Bucket=self.bucket, Key=target, Config=config, Callback=meter
+                    )
+        except Exception as e:
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+        return resp
+
+    def checkpoint_path(self, src, target):
+        name = '%s:%s:%s' % (self.bucket, target, os.path.abspath(src))
+        checkpoint_dir = self.checkpoint_dir or os.path.join(os.path.expanduser('~'), '.storagekit')
+        os.makedirs(checkpoint_dir, 0o755, exist_ok=True)
+        return os.path.join(checkpoint_dir, hashlib.md5(name.encode()).hexdigest() + '.json')
+
+    def resumable_upload(self, src, target, config, meter=None):
+        """
+        分片上传, upload_id 记录在 checkpoint 文件中, 中断后重新调用只上传缺少的分片
+        """
+        stat = os.stat(src)
+        # S3 最多 10000 个分片
+        part_size = max(config.multipart_chunksize, int(math.ceil(stat.st_size / 10000.0)))
+        checkpoint = self.checkpoint_path(src, target)
+        record = {}
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                record = json.load(f)
+        if (record.get('size'), record.get('mtime'), record.get('part_size')) != \
+                (stat.st_size, stat.st_mtime, part_size):
+            if record.get('upload_id'):
+                # 文件已经改变, 取消旧的上传, 否则已上传的分片会一直保留并计费
+                try:
+                    self.client.abort_multipart_upload(Bucket=self.bucket, Key=target, UploadId=record['upload_id'])
+                except self.client.exceptions.NoSuchUpload:
+                    pass
+            ret = self.client.create_multipart_upload(Bucket=self.bucket, Key=target)
+            record = {
+                'upload_id': ret['UploadId'], 'size': stat.st_size,
+                'mtime': stat.st_mtime, 'part_size': part_size,
+            }
+            with open(checkpoint, 'w') as f:
+                json.dump(record, f)
+
+        upload_id = record['upload_id']
+        uploaded = {}
+        paginator = self.client.get_paginator('list_parts')
         try:
-            s3 = boto3.resource('s3',
-                            aws_access_key_id=self.access_key,
-                            aws_secret_access_key=self.secret_key,
-                            endpoint_url=self.endpoint)
-            bucket = s3.Bucket(self.bucket)
-            bucket.objects.filter(Prefix=key).delete()
+            for page in paginator.paginate(Bucket=self.bucket, Key=target, UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    uploaded[part['PartNumber']] = part['ETag']
+        except self.client.exceptions.NoSuchUpload:
+            # upload_id 已过期或被取消, 重新开始
+            os.remove(checkpoint)
+            return self.resumable_upload(src, target, config, meter)
+        if meter and uploaded:
+            meter(sum(min(part_size, stat.st_size - (n - 1) * part_size) for n in uploaded))
+
+        def upload_part(number):
+            with open(src, 'rb') as f:
+                f.seek((number - 1) * part_size)
+                data = f.read(part_size)
+            ret = self.client.upload_part(
+                Bucket=self.bucket, Key=target, UploadId=upload_id,
+                PartNumber=number, Body=data
+            )
+            if meter:
+                meter(len(data))
+            return number, ret['ETag']
+
+        total_parts = max(1, int(math.ceil(stat.st_size / float(part_size))))
+        missing = [n for n in range(1, total_parts + 1) if n not in uploaded]
+        for number, etag in bounded_map(upload_part, missing, workers=config.max_concurrency):
+            uploaded[number] = etag
+
+        parts = [{'PartNumber': n, 'ETag': uploaded[n]} for n in range(1, total_parts + 1)]
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=target, UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+        os.remove(checkpoint)
+
+    def can_copy_from(self, storage):
+        return storage is self or (
+            storage.type == self.type and
+            (storage.endpoint, storage.access_key) == (self.endpoint, self.access_key)
+        )
+
+    def copy_object(self, src_key, dst_key, src_storage=None):
+        resp = {'status': 'success', 'errmsg': ''}
+        src = src_storage or self
+        try:
+            with self.invalidating_meta(dst_key):
+                # 托管复制, 大于 multipart_threshold 的对象使用 UploadPartCopy
+                self.client.copy({'Bucket': src.bucket, 'Key': src_key}, self.bucket, dst_key,
+                                 Config=self.transfer_config())
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
-    def upload_file(self, src, target):
+    def upload_fileobj(self, fileobj, target, size=None, callback=None, **kwargs):
         resp = {'status': 'success', 'errmsg': ''}
         try:
-            self.client.upload_file(Filename=src, Bucket=self.bucket, Key=target)
+            with self.invalidating_meta(target):
+                meter = ProgressMeter(callback, total=size) if callback else None
+                self.client.upload_fileobj(
+                    fileobj, self.bucket, target, Config=self.transfer_config(**kwargs), Callback=meter
+                )
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
-    def download_file(self, src, target):
+    def download_file(self, src, target, callback=None, **kwargs):
         resp = {'status': 'success', 'errmsg': ''}
         try:
             os.makedirs(os.path.dirname(target), 0o755, exist_ok=True)
-            self.client.download_file(self.bucket, src, target)
+            meter = None
+            if callback:
+                size = self.client.head_object(Bucket=self.bucket, Key=src)['ContentLength']
+                meter = ProgressMeter(callback, total=size)
+            self.client.download_file(
+                self.bucket, src, target, Config=self.transfer_config(**kwargs), Callback=meter
+            )
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
     def generate_presigned_url(self, key, expire=3600):
@@ -151,7 +344,7 @@ class S3Storage(ObjectStorage):
             buckets = response.get('Buckets', [])
             resp['data'] = [{'name': b['Name'], 'create_time': b['CreationDate']} for b in buckets if b.get('Name')]
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
     def create_bucket(self, bucket=None, **kwargs):
@@ -160,7 +353,7 @@ class S3Storage(ObjectStorage):
         try:
             self.client.create_bucket(Bucket=bucket, **kwargs)
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
     def delete_bucket(self, bucket=None):
@@ -169,7 +362,7 @@ class S3Storage(ObjectStorage):
         try:
             self.client.delete_bucket(Bucket=bucket)
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
     def get_bucket(self, bucket=None):
@@ -178,7 +371,7 @@ class S3Storage(ObjectStorage):
         try:
             resp['data'] = self.client.head_bucket(Bucket=bucket)
         except Exception as e:
-            resp = {'status': 'failure', 'errmsg': str(e)}
+            resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
         return resp
 
     @property
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+#
+import fnmatch
+import hashlib
+import inspect
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from .utils import bounded_map
+
+MD5_ETAG = re.compile(r'^[0-9a-f]{32}$')
+
+
+class RateLimiter(object):
+    """
+    令牌桶, 所有线程共享 rate 字节每秒的带宽
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Manifest(object):
+    """
+    上次同步后每个文件的 size, mtime, md5 和远端 etag, size 和 mtime 没变时不需要重新计算 md5
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = {}
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def set(self, name, entry):
+        with self.lock:
+            self.entries[name] = entry
+
+    def discard(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), 0o755, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            with self.lock:
+                json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+
+def manifest_path(storage, local_dir, prefix):
+    name = getattr(storage, 'bucket', None) or getattr(storage, 'container_name', None) or ''
+    location = getattr(storage, 'endpoint', None) or getattr(storage, 'root', None) or ''
+    ident = '%s:%s/%s:%s:%s' % (storage.type, location, name, prefix, os.path.abspath(local_dir))
+    return os.path.join(os.path.expanduser('~'), '.storagekit', 'sync',
+                        hashlib.md5(ident.encode('utf-8')).hexdigest() + '.json')
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def plain_etag(etag):
+    """
+    单次上传的对象 etag 就是 md5, 分片上传或其他后端的 etag 返回 None
+    """
+    etag = (etag or '').strip('"').lower()
+    return etag if MD5_ETAG.match(etag) else None
+
+
+def walk(local_dir, exclude=()):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, local_dir).replace(os.sep, '/')
+            if any(fnmatch.fnmatch(rel, pattern) for pattern in exclude):
+                continue
+            st = os.stat(path)
+            files[rel] = {'size': st.st_size, 'mtime': st.st_mtime}
+    return files
+
+
+def unchanged(local, remote, path, entry):
+    """
+    判断本地文件和远端对象是否相同, 返回 (是否相同, 本地 md5)
+    """
+    if local['size'] != remote.get('size'):
+        return False, None
+    same_stat = entry is not None and (entry.get('size'), entry.get('mtime')) == (local['size'], local['mtime'])
+    if same_stat and entry.get('etag') == remote.get('etag'):
+        return True, entry.get('md5')
+    remote_md5 = plain_etag(remote.get('etag'))
+    if remote_md5 is None:
+        # etag 不是 md5 时无法比较内容, 与 rsync 相同按 size 和 mtime 判断, 下载时 mtime 已设为远端的修改时间
+        modified = remote.get('last_modified')
+        if hasattr(modified, 'timestamp') and abs(modified.timestamp() - local['mtime']) < 1:
+            return True, None
+        return False, None
+    md5 = entry['md5'] if same_stat and entry.get('md5') else file_md5(path)
+    return md5 == remote_md5, md5
+
+
+def sync(storage, local_dir, prefix='', direction='upload', delete=False, dry_run=False,
+         workers=8, bwlimit=None, manifest=None, exclude=()):
+    """
+    增量同步本地目录和 prefix 下的对象:
+    direction 为 upload 时以本地为准, download 时以远端为准, 只传输 size 或内容不同的文件;
+    delete 为 True 时删除目标端多余的文件; dry_run 为 True 时只返回将要执行的操作;
+    bwlimit 为所有线程合计的字节每秒; manifest 为本地记录文件, 默认在 ~/.storagekit/sync 下, False 不使用
+    """
+    if direction not in ('upload', 'download'):
+        raise ValueError("direction must be 'upload' or 'download'")
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    resp = {'status': 'success', 'errmsg': ''}
+    data = {'transferred': [], 'deleted': [], 'skipped': 0, 'bytes': 0, 'errors': [], 'dry_run': dry_run}
+    if manifest is None:
+        manifest = manifest_path(storage, local_dir, prefix)
+    manifest = Manifest(manifest or None)
+    limiter = RateLimiter(bwlimit) if bwlimit else None
+
+    try:
+        os.makedirs(local_dir, 0o755, exist_ok=True)
+        local_files = walk(local_dir, exclude)
+        remote_files = {}
+        for row in storage.iter_objects(prefix=prefix, prefetch_pages=True):
+            name = row['key'][len(prefix):]
+            if 'size' not in row or not name or name.endswith('/'):
+                continue
+            if any(part in ('', '.', '..') for part in name.split('/')):
+                # 不能映射为 local_dir 下的路径
+                data['errors'].append({'key': row['key'], 'errmsg': 'Invalid path'})
+                continue
+            if not any(fnmatch.fnmatch(name, pattern) for pattern in exclude):
+                remote_files[name] = row
+    except Exception as e:
+        return {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+
+    if direction == 'upload':
+        sources, targets = local_files, remote_files
+    else:
+        sources, targets = remote_files, local_files
+    accepts_callback = 'callback' in inspect.signature(
+        storage.upload_file if direction == 'upload' else storage.download_file
+    ).parameters
+
+    def transfer(name):
+        path = os.path.join(local_dir, *name.split('/'))
+        key = prefix + name
+        local, remote = local_files.get(name), remote_files.get(name)
+        entry = manifest.get(name)
+        md5 = None
+        if local is not None and remote is not None:
+            same, md5 = unchanged(local, remote, path, entry)
+            if same:
+                manifest.set(name, dict(local, md5=md5, etag=remote.get('etag')))
+                return None
+        size = sources[name]['size']
+        if dry_run:
+            return name, size, None
+
+        kwargs = {}
+        if limiter is not None and accepts_callback:
+            meter_state = {'last': 0}
+            meter_lock = threading.Lock()
+
+            def throttle(transferred, total, rate):
+                # 分片上传下载时会从多个线程回调
+                with meter_lock:
+                    amount = max(0, transferred - meter_state['last'])
+                    meter_state['last'] = max(meter_state['last'], transferred)
+                if amount:
+                    limiter.consume(amount)
+            kwargs['callback'] = throttle
+        elif limiter is not None:
+            limiter.consume(size)
+
+        if direction == 'upload':
+            ret = storage.upload_file(path, key, **kwargs)
+        else:
+            ret = storage.download_file(key, path, **kwargs)
+        if ret['status'] != 'success':
+            return name, size, ret['errmsg']
+
+        if direction == 'download':
+            if remote.get('last_modified') is not None and hasattr(remote['last_modified'], 'timestamp'):
+                ts = remote['last_modified'].timestamp()
+                os.utime(path, (ts, ts))
+            st = os.stat(path)
+            etag = remote.get('etag')
+        else:
+            st = os.stat(path)
+            try:
+                head = storage.head_object(key)
+                etag = head['data']['etag'] if head['status'] == 'success' else None
+            except NotImplementedError:
+                etag = None
+        manifest.set(name, {'size': st.st_size, 'mtime': st.st_mtime, 'md5': md5, 'etag': etag})
+        return name, size, None
+
+    def remove(name):
+        if dry_run:
+            return name, None
+        if direction == 'upload':
+            ret = storage.delete_object(prefix + name)
+            error = None if ret['status'] == 'success' else ret['errmsg']
+        else:
+            try:
+                os.remove(os.path.join(local_dir, *name.split('/')))
+                error = None
+            except OSError as e:
+                error = str(e)
+        if error is None:
+            manifest.discard(name)
+        return name, error
+
+    try:
+        for result in bounded_map(transfer, sorted(sources), workers=workers, ordered=False):
+            if result is None:
+                data['skipped'] += 1
+                continue
+            name, size, error = result
+            if error is None:
+                data['transferred'].append(name)
+                data['bytes'] += size
+            else:
+                data['errors'].append({'key': name, 'errmsg': error})
+        if delete:
+            extraneous = sorted(set(targets) - set(sources))
+            for name, error in bounded_map(remove, extraneous, workers=workers, ordered=False):
+                if error is None:
+                    data['deleted'].append(name)
+                else:
+                    data['errors'].append({'key': name, 'errmsg': error})
+    except Exception as e:
+        resp = {'status': 'failure', 'errmsg': str(e), 'error': e.__class__.__name__}
+    finally:
+        if not dry_run:
+            manifest.save()
+
+    if resp['status'] == 'success' and data['errors']:
+        resp = {'status': 'failure', 'errmsg': '%d file(s) failed to sync' % len(data['errors'])}
+    resp['data'] = data
+    return resp
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+import bisect
+import collections
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def bounded_map(func, iterable, workers=4, ordered=True, executor=None):
+    """
+    在线程池上对 iterable 逐个执行 func, 在途任务不超过 workers * 2,
+    iterable 可以是生成器, 不会被一次性读完
+    """
+    if workers <= 1 and executor is None:
+        for item in iterable:
+            yield func(item)
+        return
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    max_pending = max(workers, 1) * 2
+    pending = collections.deque()
+
+    def take():
+        if ordered:
+            return [pending.popleft().result()]
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+        return [future.result() for future in done]
+
+    try:
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                for result in take():
+                    yield result
+        while pending:
+            for result in take():
+                yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
+
+
+def prefetch(iterable, size=1):
+    """
+    在后台线程中提前取 iterable 的下 size 个元素, 调用方处理当前元素时下一个已经在获取
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item, error=None):
+        # 调用方提前结束迭代时 stop 会被设置, 生产线程随之退出
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(done)
+        except Exception as e:
+            put(done, e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def make_http_adapter(pool_size, keep_alive=True):
+    """
+    连接池大小为 pool_size 的 requests HTTPAdapter; keep_alive 时对连接开启 TCP keepalive,
+    共享实例长时间空闲后连接不会被 NAT 或负载均衡静默断开
+    """
+    import requests.adapters
+    from urllib3.connection import HTTPConnection
+
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    if keep_alive:
+        options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        adapter.init_poolmanager(pool_size, pool_size, socket_options=options)
+    return adapter
+
+
+class ProgressMeter(object):
+    """
+    累计已传输的字节数, 按 interval 秒回调 callback(transferred, total, bytes_per_second)
+    """
+
+    def __init__(self, callback, total=None, interval=0.5):
+        self.callback = callback
+        self.total = total
+        self.interval = interval
+        self.transferred = 0
+        self.start = time.monotonic()
+        self.last = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        self.update(bytes_amount)
+
+    def update_to(self, consumed, total=None):
+        """
+        用于回调参数是累计字节数的 SDK, 如 oss2 的 progress_callback(consumed, total)
+        """
+        self.update(consumed=consumed, total=total)
+
+    def update(self, bytes_amount=0, consumed=None, total=None):
+        with self.lock:
+            if total is not None:
+                self.total = total
+            if consumed is None:
+                self.transferred += bytes_amount
+            else:
+                # 并发回调的累计值可能乱序到达, 不回退
+                self.transferred = max(self.transferred, consumed)
+            now = time.monotonic()
+            finished = self.total is not None and self.transferred >= self.total
+            if now - self.last < self.interval and not finished:
+                return
+            self.last = now
+            transferred = self.transferred
+            rate = transferred / max(now - self.start, 1e-6)
+        self.callback(transferred, self.total, rate)
+
+
+class MetadataCache(object):
+    """
+    缓存 head 结果 (size, etag, last_modified), 不存在的 key 用较短的 negative_ttl 缓存
+    """
+
+    def __init__(self, ttl=60, negative_ttl=5, capacity=100000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        # 每次失效加一, set 时与 head 开始前的值不同说明期间有写入, 结果可能已经过期
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, backend, key):
+        """
+        返回缓存的 head 响应, 没有缓存或已过期返回 None
+        """
+        with self.lock:
+            entry = self.entries.get((backend, key))
+            if entry is None:
+                return None
+            expires, resp = entry
+            if expires < time.monotonic():
+                del self.entries[(backend, key)]
+                return None
+            self.entries.move_to_end((backend, key))
+        # 返回副本, 调用方修改结果不影响缓存
+        resp = dict(resp)
+        if resp.get('data') is not None:
+            resp['data'] = dict(resp['data'])
+        return resp
+
+    def set(self, backend, key, resp, missing=False, generation=None):
+        ttl = self.negative_ttl if missing else self.ttl
+        if not ttl:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[(backend, key)] = (time.monotonic() + ttl, resp)
+            self.entries.move_to_end((backend, key))
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, backend, key):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop((backend, key), None)
+
+    def invalidate_prefix(self, backend, prefix):
+        with self.lock:
+            self.generation += 1
+            for entry in [e for e in self.entries if e[0] == backend and e[1].startswith(prefix)]:
+                del self.entries[entry]
+
+
+class SortedKeys(object):
+    """
+    有序的 key 列表, 按前缀列举时二分查找起点, 不需要遍历全部 key
+    """
+
+    def __init__(self, keys=()):
+        self.keys = sorted(keys)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        with self.lock:
+            i = bisect.bisect_left(self.keys, key)
+            if i == len(self.keys) or self.keys[i] != key:
+                self.keys.insert(i, key)
+
+    def discard(self, key):
+        with self.lock:
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+
+    def page(self, prefix='', delimiter='', marker='', max_keys=1000):
+        """
+        返回 (keys, 公共前缀, 下一页的 marker), 没有下一页时 marker 为 None
+        """
+        keys, prefixes = [], []
+        with self.lock:
+            if marker and marker >= prefix:
+                i = bisect.bisect_right(self.keys, marker)
+            else:
+                i = bisect.bisect_left(self.keys, prefix)
+            last = None
+            while i < len(self.keys) and self.keys[i].startswith(prefix):
+                if len(keys) + len(prefixes) >= max_keys:
+                    return keys, prefixes, last
+                key = self.keys[i]
+                pos = key.find(delimiter, len(prefix)) if delimiter else -1
+                if pos >= 0:
+                    common = key[:pos + len(delimiter)]
+                    prefixes.append(common)
+                    # 跳过同一个公共前缀下的其余 key
+                    i = bisect.bisect_left(self.keys, common + '\U0010ffff')
+                    last = common + '\U0010ffff'
+                    continue
+                keys.append(key)
+                last = key
+                i += 1
+        return keys, prefixes, None
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from storagekit.memory import MemoryStorage
+from storagekit.utils import MetadataCache, ProgressMeter
+
+
+class CachedMemoryStorage(MemoryStorage):
+    """
+    与 S3/OSS/Azure 相同的方式使用元数据缓存, put_object 在 gate 打开前不会完成
+    """
+
+    def __init__(self, config):
+        MemoryStorage.__init__(self, config)
+        self.init_meta_cache(config)
+        self.writing = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def head_object(self, key):
+        resp = self.get_cached_meta(key)
+        if resp is not None:
+            return resp
+        generation = self.meta_generation()
+        resp = MemoryStorage.head_object(self, key)
+        self.set_cached_meta(key, resp, missing=resp['status'] != 'success', generation=generation)
+        return resp
+
+    def put_object(self, key, data):
+        with self.invalidating_meta(key):
+            self.writing.set()
+            self.gate.wait()
+            return MemoryStorage.put_object(self, key, data)
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def test_ttl(self):
+        cache = MetadataCache(ttl=60, negative_ttl=0.01)
+        cache.set('b', 'k', {'status': 'success', 'data': {'size': 1}})
+        cache.set('b', 'missing', {'status': 'failure'}, missing=True)
+        self.assertEqual(cache.get('b', 'k')['data'], {'size': 1})
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('b', 'missing'))
+
+    def test_copy(self):
+        cache = MetadataCache()
+        cache.set('b', 'k', {'status': 'success', 'data': {'size': 1}})
+        cache.get('b', 'k')['data']['size'] = 2
+        self.assertEqual(cache.get('b', 'k')['data']['size'], 1)
+
+    def test_capacity(self):
+        cache = MetadataCache(capacity=2)
+        for key in ('a', 'b', 'c'):
+            cache.set('b', key, {'status': 'success'})
+        self.assertIsNone(cache.get('b', 'a'))
+        self.assertIsNotNone(cache.get('b', 'c'))
+
+    def test_invalidate_prefix(self):
+        cache = MetadataCache()
+        for key in ('p/1', 'p/2', 'q/1'):
+            cache.set('b', key, {'status': 'success'})
+        cache.invalidate_prefix('b', 'p/')
+        self.assertEqual([cache.get('b', k) is None for k in ('p/1', 'p/2', 'q/1')], [True, True, False])
+
+    def test_stale_generation(self):
+        cache = MetadataCache()
+        generation = cache.generation
+        cache.invalidate('b', 'k')
+        cache.set('b', 'k', {'status': 'failure'}, missing=True, generation=generation)
+        self.assertIsNone(cache.get('b', 'k'))
+
+    def test_head_during_write(self):
+        storage = CachedMemoryStorage({'METADATA_CACHE_TTL': 60, 'METADATA_NEGATIVE_TTL': 60})
+        storage.gate.clear()
+        writer = threading.Thread(target=storage.put_object, args=('new', b'x'))
+        writer.start()
+        storage.writing.wait()
+        self.assertEqual(storage.exists_object('new')['status'], 'failure')
+        storage.gate.set()
+        writer.join()
+        self.assertEqual(storage.exists_object('new')['status'], 'success')
+
+    def test_delete_invalidates(self):
+        storage = CachedMemoryStorage({'METADATA_CACHE_TTL': 60})
+        for key in ('p/1', 'p/2', 'q'):
+            storage.put_object(key, b'x')
+            self.assertEqual(storage.exists_object(key)['status'], 'success')
+        storage.delete_keys(['q'])
+        self.assertEqual(storage.exists_object('q')['status'], 'failure')
+        storage.delete_prefix('p/')
+        self.assertEqual([storage.exists_object(k)['status'] for k in ('p/1', 'p/2')], ['failure'] * 2)
+
+
+class TestProgressMeter(unittest.TestCase):
+
+    def test_update_to(self):
+        calls = []
+        meter = ProgressMeter(lambda *args: calls.append(args[:2]), interval=60)
+        meter.update_to(10, 100)
+        meter.update_to(5)
+        meter(20)
+        meter.update_to(100)
+        self.assertEqual(meter.transferred, 100)
+        self.assertEqual(calls, [(10, 100), (100, 100)])
+
+    def test_concurrent(self):
+        meter = ProgressMeter(lambda *args: None, interval=0)
+
+        def report(offset):
+            for consumed in range(offset, 20000, 4):
+                meter.update_to(consumed)
+
+        threads = [threading.Thread(target=report, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(meter.transferred, 19999)
+
+
+if __name__ == '__main__':
+    unittest.main()